@@ -21,6 +21,57 @@ function bootstrapAngular() {
   angular.bootstrap(document.body,['BillingExport']);
 }
 
+// Returns the local Date with the UTC fields of the supplied milliseconds since
+// the epoch, matching the Date(...) values of the standard json response.
+function decodeCompactDate(millis) {
+  var utc = new Date(millis);
+  return new Date(utc.getUTCFullYear(), utc.getUTCMonth(), utc.getUTCDate(),
+                  utc.getUTCHours(), utc.getUTCMinutes(), utc.getUTCSeconds(),
+                  utc.getUTCMilliseconds());
+}
+
+// Builds a google.visualization.DataTable from the compact json returned by
+// '/chart?tqx=out:compact'. Each row is a flat list of column index and value
+// pairs with null cells left out, a row with properties is an object of the
+// list 'c' and the properties 'p'. dates are milliseconds since the epoch.
+function decodeCompactDataTable(table) {
+  var dataTable = new google.visualization.DataTable({cols: table.cols,
+                                                      p: table.p});
+  var isDate = table.cols.map(function(col) {
+    return col.type == 'date' || col.type == 'datetime';
+  });
+  var rows = new Array(table.rows.length);
+  for (var i = 0; i < table.rows.length; i++) {
+    var cells = table.rows[i].c || table.rows[i];
+    var row = new Array(table.cols.length);
+    for (var col = 0; col < row.length; col++) {
+      row[col] = null;
+    }
+    for (var j = 0; j < cells.length; j += 2) {
+      var value = cells[j + 1];
+      // cell objects have a formatted value or properties as well.
+      var cell = (value !== null && typeof value == 'object' &&
+                  !(value instanceof Array)) ? value : null;
+      if (isDate[cells[j]]) {
+        if (cell) {
+          cell.v = cell.v === null ? null : decodeCompactDate(cell.v);
+        } else {
+          value = decodeCompactDate(value);
+        }
+      }
+      row[cells[j]] = cell || value;
+    }
+    rows[i] = row;
+  }
+  dataTable.addRows(rows);
+  for (var i = 0; i < table.rows.length; i++) {
+    if (table.rows[i].p) {
+      dataTable.setRowProperties(i, table.rows[i].p);
+    }
+  }
+  return dataTable;
+}
+
 // Angular application and configuration.
 var app = angular.module('BillingExport', ['ngRoute']);
 
@@ -298,24 +349,26 @@ app.controller('BillingExportController', function ($scope,$http,$location,
     // when project changes, show the spinner.
     // as operation can take time if chart is not cached.
     showLoading(true);
-    var query = new google.visualization.Query('/chart?project=' + $scope.project);
-    query.send(function(response){
-      handleQueryResponse(response);
-
-      // change the url location so it can be bookmarked.
-      if($routeParams.project != $scope.project){
-        $location.path('/Project/' + $scope.project);
-      }
+    // request the compact chart data, it's much smaller for sparse sku data.
+    $http.get('/chart', {params: {project: $scope.project,
+                                  tqx: 'out:compact'}})
+      .success(function(data){
+        handleChartData(decodeCompactDataTable(data));
 
-      // we aren't in a UI thread, so need to invoke angular sync manually.
-      $scope.$apply();
-    });
+        // change the url location so it can be bookmarked.
+        if($routeParams.project != $scope.project){
+          $location.path('/Project/' + $scope.project);
+        }
+      })
+      .error(function(){
+        handleChartData(null);
+      });
   };
 
-  // get dataSource response from app engine. draw chart.
-  function handleQueryResponse(response){
+  // draw chart from the DataTable loaded from app engine.
+  function handleChartData(dataTable){
     showLoading(false);
-    chartData = response.getDataTable();
+    chartData = dataTable;
 
     // must have failed
     if(typeof chartData == 'undefined' || chartData == null){
@@ -3,6 +3,7 @@
 
 
 
+from .api_utils import get_retry_stats
 from .api_utils import RetryParams
 from .api_utils import set_default_retry_params
 from cloudstorage_api import *
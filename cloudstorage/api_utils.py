@@ -4,15 +4,19 @@
 
 
 
-__all__ = ['set_default_retry_params',
+__all__ = ['get_retry_stats',
+           'set_default_retry_params',
            'RetryParams',
           ]
 
+import collections
 import copy
 import httplib
 import logging
 import math
 import os
+import random
+import re
 import threading
 import time
 import urllib
@@ -21,6 +25,7 @@ import urllib
 try:
   from google.appengine.api import urlfetch
   from google.appengine.datastore import datastore_rpc
+  from google.appengine.ext import ndb
   from google.appengine.ext.ndb import eventloop
   from google.appengine.ext.ndb import utils
   from google.appengine import runtime
@@ -30,6 +35,7 @@ except ImportError:
   from google.appengine.datastore import datastore_rpc
   from google.appengine import runtime
   from google.appengine.runtime import apiproxy_errors
+  from google.appengine.ext import ndb
   from google.appengine.ext.ndb import eventloop
   from google.appengine.ext.ndb import utils
 
@@ -59,6 +65,159 @@ def _get_default_retry_params():
     return copy.copy(default)
 
 
+class _RetryStats(object):
+  """Retry accounting of GCS requests for one request and thread."""
+
+  def __init__(self):
+    self.request_id = os.getenv('REQUEST_LOG_ID')
+    # GCS requests made, not counting their retries.
+    self.requests = 0
+    # retries of the requests and the seconds spent waiting before them.
+    self.retries = 0
+    self.retry_delay = 0.0
+    # requests that still failed once they ran out of retries.
+    self.exhausted = 0
+    # duplicate GETs issued for requests slower than the hedge percentile.
+    self.hedges = 0
+
+
+def _get_retry_stats():
+  """Get the _RetryStats of the current request and thread."""
+  stats = getattr(_thread_local_settings, 'retry_stats', None)
+  if stats is None or stats.request_id != os.getenv('REQUEST_LOG_ID'):
+    stats = _RetryStats()
+    _thread_local_settings.retry_stats = stats
+  return stats
+
+
+def get_retry_stats():
+  """Get retry metrics of GCS requests for current request current thread.
+
+  Returns:
+    A dict with the number of GCS 'requests' made, their 'retries', the
+    seconds of 'retry_delay' waited before the retries, the number of
+    requests 'exhausted', that failed after their last retry, and the
+    number of 'hedges', duplicate requests made for slow reads.
+  """
+  stats = _get_retry_stats()
+  return {'requests': stats.requests,
+          'retries': stats.retries,
+          'retry_delay': stats.retry_delay,
+          'exhausted': stats.exhausted,
+          'hedges': stats.hedges}
+
+
+class _LatencyTracker(object):
+  """Recent latencies of one kind of GCS read, for hedged requests."""
+
+  WINDOW = 200
+  MIN_SAMPLES = 20
+
+  def __init__(self):
+    self._latencies = collections.deque(maxlen=self.WINDOW)
+
+  def add(self, latency):
+    self._latencies.append(latency)
+
+  def percentile(self, percentile):
+    """Returns the latency at percentile, None without enough samples."""
+    latencies = sorted(self._latencies)
+    if len(latencies) < self.MIN_SAMPLES:
+      return None
+    return latencies[int(len(latencies) * percentile / 100.0)]
+
+
+# _LatencyTracker of this process by _latency_key.
+_read_latencies = {}
+
+
+def _latency_key(url, method='GET', headers=None, **unused_kwds):
+  """Returns the key of the reads with latencies comparable to a read.
+
+  HEADs, bucket listings and object reads are kept apart, and object reads
+  by the size of their range, in buckets growing 4 times, so small reads
+  aren't hedged after the latency of large segments, or the reverse.
+
+  Args:
+    url: url of the read.
+    method: HTTP method of the read.
+    headers: HTTP headers of the read.
+
+  Returns:
+    A hashable key.
+  """
+  size_bucket = None
+  match = re.match(r'bytes=(\d+)-(\d+)$', (headers or {}).get('Range', ''))
+  if match:
+    size = int(match.group(2)) - int(match.group(1)) + 1
+    size_bucket = int(math.log(max(size, 1), 4))
+  return method, '?' in url, size_bucket
+
+
+def _get_latency_tracker(key):
+  """Get the _LatencyTracker of the reads of key."""
+  tracker = _read_latencies.get(key)
+  if tracker is None:
+    tracker = _read_latencies.setdefault(key, _LatencyTracker())
+  return tracker
+
+
+def _first_done(futures):
+  """Returns a future fulfilled with the first of futures to complete."""
+  first = ndb.Future()
+
+  def on_done(future):
+    if not first.done():
+      first.set_result(future)
+
+  for future in futures:
+    future.add_immediate_callback(on_done, future)
+  return first
+
+
+@ndb.tasklet
+def _hedged(retry_params, tasklet, **kwds):
+  """Run a read tasklet, and a duplicate of it if the first is slow.
+
+  The duplicate is issued once the first has taken longer than the
+  retry_params.hedge_percentile of recent latencies of the same kind of
+  read, see _latency_key, and counts against the retry budget. The first
+  of them to succeed wins, the other is left to complete unobserved.
+
+  Args:
+    retry_params: an instance of RetryParams.
+    tasklet: the read tasklet to run, e.g. a GET urlfetch.
+    **kwds: keywords arguments to run the tasklet.
+
+  Returns:
+    The result from the first successful run of the tasklet.
+
+  Raises:
+    The exception from running the tasklet, if no run succeeded.
+  """
+  start_time = time.time()
+  latencies = _get_latency_tracker(_latency_key(**kwds))
+  pending = [tasklet(**kwds)]
+  hedge_after = None
+  if retry_params.hedge_percentile is not None:
+    hedge_after = latencies.percentile(retry_params.hedge_percentile)
+  if hedge_after is not None and not retry_params.budget_spent():
+    hedge_timer = ndb.sleep(hedge_after)
+    done = yield _first_done(pending + [hedge_timer])
+    if done is hedge_timer and not retry_params.budget_spent():
+      _get_retry_stats().hedges += 1
+      pending.append(tasklet(**kwds))
+
+  while True:
+    done = yield _first_done(pending)
+    pending.remove(done)
+    if done.get_exception() is None or not pending:
+      break
+  result = done.get_result()
+  latencies.add(time.time() - start_time)
+  raise ndb.Return(result)
+
+
 def _quote_filename(filename):
   """Quotes filename to use as a valid URI path.
 
@@ -73,7 +232,9 @@ def _quote_filename(filename):
 
 def _should_retry(resp):
   """Given a urlfetch response, decide whether to retry that request."""
+  # 429 Too Many Requests, GCS throttling, isn't in httplib.
   return (resp.status_code == httplib.REQUEST_TIMEOUT or
+          resp.status_code == 429 or
           (resp.status_code >= 500 and
            resp.status_code < 600))
 
@@ -90,7 +251,10 @@ class RetryParams(object):
                max_retries=5,
                max_retry_period=30.0,
                urlfetch_timeout=None,
-               save_access_token=False):
+               save_access_token=False,
+               jitter=False,
+               retry_budget=None,
+               hedge_percentile=None):
     """Init.
 
     This object is unique per request per thread.
@@ -114,6 +278,15 @@ class RetryParams(object):
         excessive usage of GetAccessToken API. Usually the token is cached
         in process and in memcache. In some cases, memcache isn't very
         reliable.
+      jitter: use full jitter backoff, a random delay between 0 and the
+        exponential backoff delay, so retries of concurrent requests
+        don't happen in lockstep.
+      retry_budget: max number of retries and hedged requests shared by
+        all GCS requests of the current request. None for no limit. Once
+        it's spent, requests fail without retrying and aren't hedged.
+      hedge_percentile: percentile of recent latencies of the same kind of
+        read in this process after which a duplicate GET or HEAD is issued,
+        the first response wins. None for no hedged requests.
     """
     self.backoff_factor = self._check('backoff_factor', backoff_factor)
     self.initial_delay = self._check('initial_delay', initial_delay)
@@ -129,6 +302,16 @@ class RetryParams(object):
       self.urlfetch_timeout = self._check('urlfetch_timeout', urlfetch_timeout)
     self.save_access_token = self._check('save_access_token', save_access_token,
                                          True, bool)
+    self.jitter = self._check('jitter', jitter, True, bool)
+    self.retry_budget = None
+    if retry_budget is not None:
+      self.retry_budget = self._check('retry_budget', retry_budget, True, int)
+    self.hedge_percentile = None
+    if hedge_percentile is not None:
+      self.hedge_percentile = self._check('hedge_percentile', hedge_percentile)
+      if self.hedge_percentile >= 100:
+        raise ValueError(
+            'Value for parameter hedge_percentile has to be less than 100')
 
     self._request_id = os.getenv('REQUEST_LOG_ID')
 
@@ -189,69 +372,108 @@ class RetryParams(object):
         (n > self.min_retries and
          time.time() - start_time > self.max_retry_period)):
       return -1
-    return min(
+    delay = min(
         math.pow(self.backoff_factor, n-1) * self.initial_delay,
         self.max_delay)
+    if self.jitter:
+      delay = random.uniform(0, delay)
+    return delay
 
+  def budget_spent(self):
+    """Whether the current request has no retry budget left.
 
-def _retry_fetch(url, retry_params, **kwds):
-  """A blocking fetch function similar to urlfetch.fetch.
+    Both the retries and the hedged requests are charged to the budget.
+    """
+    if self.retry_budget is None:
+      return False
+    stats = _get_retry_stats()
+    return stats.retries + stats.hedges >= self.retry_budget
 
-  This function should be used when a urlfetch has timed out or the response
-  shows http request timeout. This function will put current thread to
-  sleep between retry backoffs.
 
-  Args:
-    url: url to fetch.
-    retry_params: an instance of RetryParams.
-    **kwds: keyword arguments for urlfetch. If deadline is specified in kwds,
-      it precedes the one in RetryParams. If none is specified, it's up to
-      urlfetch to use its own default.
+class _RetryWrapper(object):
+  """A wrapper that wraps retry logic around any tasklet."""
 
-  Returns:
-    A urlfetch response from the last retry. None if no retry was attempted.
+  def __init__(self,
+               retry_params,
+               retriable_exceptions=_RETRIABLE_EXCEPTIONS,
+               should_retry=lambda r: False):
+    """Init.
 
-  Raises:
-    Whatever exception encountered during the last retry.
-  """
-  n = 1
-  start_time = time.time()
-  delay = retry_params.delay(n, start_time)
-  if delay <= 0:
-    return
-
-  logging.info('Will retry request to %s.', url)
-  while delay > 0:
-    resp = None
-    try:
+    Args:
+      retry_params: an instance of RetryParams.
+      retriable_exceptions: a tuple of exception classes that are retriable.
+      should_retry: a function that takes a result from the tasklet and
+        returns a boolean. True if the result should be retried.
+    """
+    self.retry_params = retry_params
+    self.retriable_exceptions = retriable_exceptions
+    self.should_retry = should_retry
+
+  @ndb.tasklet
+  def run(self, tasklet, **kwds):
+    """Run a tasklet with retry.
+
+    The retry should be transparent to the caller: if no results
+    are successful, the exception or result from the last retry is returned
+    to the caller. Between retries, the wrapper sleeps on an ndb future
+    rather than blocking the thread, so other tasklets keep progressing.
+
+    Args:
+      tasklet: the tasklet to run.
+      **kwds: keywords arguments to run the tasklet.
+
+    Raises:
+      The exception from running the tasklet.
+
+    Returns:
+      The result from running the tasklet.
+    """
+    stats = _get_retry_stats()
+    stats.requests += 1
+    start_time = time.time()
+    n = 1
+
+    while True:
+      e = None
+      result = None
+      got_result = False
+
+      try:
+        result = yield tasklet(**kwds)
+        got_result = True
+        if not self.should_retry(result):
+          raise ndb.Return(result)
+      except runtime.DeadlineExceededError:
+        logging.info(
+            'Tasklet has exceeded request deadline after %s seconds total',
+            time.time() - start_time)
+        raise
+      except self.retriable_exceptions, e:
+        pass
+
+      delay = self.retry_params.delay(n, start_time)
+      if self.retry_params.budget_spent():
+        delay = -1
+
+      if delay < 0:
+        if n > 1:
+          stats.exhausted += 1
+          logging.info(
+              'Tasklet failed after %s attempts and %s seconds in total',
+              n, time.time() - start_time)
+        if got_result:
+          raise ndb.Return(result)
+        raise e
+
+      if got_result:
+        logging.info('Got status %s from GCS.', result.status_code)
+      else:
+        logging.info('Got exception "%r" while contacting GCS.', e)
       logging.info('Retry in %s seconds.', delay)
-      time.sleep(delay)
-      resp = urlfetch.fetch(url, **kwds)
-    except runtime.DeadlineExceededError:
-      logging.info(
-          'Urlfetch retry %s will exceed request deadline '
-          'after %s seconds total', n, time.time() - start_time)
-      raise
-    except _RETRIABLE_EXCEPTIONS, e:
-      pass
-
-    n += 1
-    delay = retry_params.delay(n, start_time)
-    if resp and not _should_retry(resp):
-      break
-    elif resp:
-      logging.info(
-          'Got status %s from GCS.', resp.status_code)
-    else:
-      logging.info(
-          'Got exception "%r" while contacting GCS.', e)
-
-  if resp:
-    return resp
-
-  logging.info('Urlfetch failed after %s retries and %s seconds in total.',
-               n - 1, time.time() - start_time)
-  raise
+      stats.retries += 1
+      stats.retry_delay += delay
+      n += 1
+      yield ndb.sleep(delay)
 
 
 def _run_until_rpc():
@@ -14,6 +14,8 @@ __all__ = ['delete',
            'stat',
           ]
 
+import collections
+import heapq
 import logging
 import StringIO
 import urllib
@@ -31,6 +33,9 @@ def open(filename,
          options=None,
          read_buffer_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
          retry_params=None,
+         file_stat=None,
+         whole_object=False,
+         parallel_upload=False,
          _account_id=None):
   """Opens a Google Cloud Storage file and returns it as a File-like object.
 
@@ -53,6 +58,17 @@ def open(filename,
       small files, set a large buffer size. Max is 30MB.
     retry_params: An instance of api_utils.RetryParams for subsequent calls
       to GCS from this file handle. If None, the default one is used.
+    file_stat: A known GCSFileStat of the file, e.g. one yielded by
+      listbucket. Its size and etag save a round trip to GCS on open.
+      Only valid in reading mode.
+    whole_object: Read the whole file when opened, with a single request
+      for files up to 30MB and parallel requests for larger ones, instead
+      of a buffer at a time. Best for files consumed by one read().
+      Only valid in reading mode.
+    parallel_upload: Upload the file in parts of 8MB, up to 4 at a time,
+      and compose them on close, instead of one resumable upload request
+      after another. Best for large files. The file has no MD5 etag.
+      Only valid in writing mode.
     _account_id: Internal-use only.
 
   Returns:
@@ -62,23 +78,38 @@ def open(filename,
   Raises:
     errors.AuthorizationError: if authorization failed.
     errors.NotFoundError: if an object that's expected to exist doesn't.
-    ValueError: invalid open mode or if content_type or options are specified
-      in reading mode.
+    ValueError: invalid open mode, if content_type or options are specified
+      in reading mode, if file_stat or whole_object are specified in
+      writing mode, if parallel_upload is specified in reading mode, or if
+      file_stat is not the stat of filename.
   """
   common.validate_file_path(filename)
   api = _get_storage_api(retry_params=retry_params, account_id=_account_id)
   filename = api_utils._quote_filename(filename)
 
   if mode == 'w':
+    if file_stat or whole_object:
+      raise ValueError('file_stat and whole_object can only be specified '
+                       'for reading mode.')
     common.validate_options(options)
+    if parallel_upload:
+      return storage_api.ParallelUploadBuffer(api, filename, content_type,
+                                              options)
     return storage_api.StreamingBuffer(api, filename, content_type, options)
   elif mode == 'r':
-    if content_type or options:
-      raise ValueError('Options and content_type can only be specified '
-                       'for writing mode.')
+    if content_type or options or parallel_upload:
+      raise ValueError('Options, content_type and parallel_upload can only '
+                       'be specified for writing mode.')
+    if file_stat and (file_stat.is_dir or
+                      api_utils._quote_filename(file_stat.filename) !=
+                      filename):
+      raise ValueError('file_stat %r is not the stat of file %s.' %
+                       (file_stat, filename))
     return storage_api.ReadBuffer(api,
                                   filename,
-                                  buffer_size=read_buffer_size)
+                                  buffer_size=read_buffer_size,
+                                  file_stat=file_stat,
+                                  whole_object=whole_object)
   else:
     raise ValueError('Invalid mode %s.' % mode)
 
@@ -161,7 +192,8 @@ def _copy2(src, dst, retry_params=None):
 
 
 def listbucket(path_prefix, marker=None, prefix=None, max_keys=None,
-               delimiter=None, retry_params=None, _account_id=None):
+               delimiter=None, retry_params=None, partitions=None,
+               names_only=False, _account_id=None):
   """Returns a GCSFileStat iterator over a bucket.
 
   Optional arguments can limit the result to a subset of files under bucket.
@@ -193,6 +225,13 @@ def listbucket(path_prefix, marker=None, prefix=None, max_keys=None,
       that your bucket uses as its directory separator.
     retry_params: An api_utils.RetryParams for this call to GCS. If None,
       the default one is used.
+    partitions: A sorted list of paths of format "/bucket/name" to split
+      the listing at. The parts are listed concurrently, which speeds up
+      listing a large bucket when the names are spread across the parts.
+      Can't be used with max_keys.
+    names_only: Yield the filenames of the matched files and directories
+      instead of GCSFileStat objects. Lighter for callers that only need
+      names, no stat is built.
     _account_id: Internal-use only.
 
   Examples:
@@ -222,7 +261,15 @@ def listbucket(path_prefix, marker=None, prefix=None, max_keys=None,
     name. The iterator returns GCSFileStat objects. For directories,
     only the filename and is_dir fields are set.
 
+    Names only mode:
+    A str iterator over the filenames of matched files, and directories in
+    directory emulation mode, ordered by name.
+
     The last name yielded can be used as next call's marker.
+
+  Raises:
+    ValueError: if partitions are not sorted, are not in the bucket or are
+      used with max_keys.
   """
   if prefix:
     common.validate_bucket_path(path_prefix)
@@ -244,185 +291,292 @@ def listbucket(path_prefix, marker=None, prefix=None, max_keys=None,
   if delimiter:
     options['delimiter'] = delimiter
 
-  return _Bucket(api, bucket, options)
+  if partitions:
+    if max_keys:
+      raise ValueError('max_keys can not be used with partitions.')
+    if list(partitions) != sorted(partitions):
+      raise ValueError('partitions %r are not sorted.' % (partitions,))
+    markers = []
+    for partition in partitions:
+      if not partition.startswith(bucket + '/'):
+        raise ValueError('partition %s is not in bucket %s.' %
+                         (partition, bucket))
+      markers.append(partition[len(bucket) + 1:])
+    return _PartitionedBucket(api, bucket, options, markers, names_only)
+  return _Bucket(api, bucket, options, names_only)
 
 
 class _Bucket(object):
   """A wrapper for a GCS bucket as the return value of listbucket."""
 
-  def __init__(self, api, path, options):
+  def __init__(self, api, path, options, names_only=False, end=None):
     """Initialize.
 
     Args:
       api: storage_api instance.
       path: bucket path of form '/bucket'.
       options: a dict of listbucket options. Please see listbucket doc.
+      names_only: yield filenames instead of GCSFileStat objects.
+      end: a name relative to the bucket, no batch is requested after a
+        batch ending at or past it.
     """
-    self._init(api, path, options)
+    self._init(api, path, options, names_only, end)
 
-  def _init(self, api, path, options):
+  def _init(self, api, path, options, names_only=False, end=None):
     self._api = api
     self._path = path
     self._options = options.copy()
+    # the marker the listing resumes from when nothing has been yielded,
+    # _options['marker'] may be past batches parsed ahead of the iteration.
+    self._start_marker = self._options.get('marker')
+    self._names_only = names_only
+    self._end = end
     self._get_bucket_fut = self._api.get_bucket_async(
         self._path + '?' + urllib.urlencode(self._options))
+    # batches parsed ahead of the iteration, see _prefetch.
+    self._batches = collections.deque()
     self._last_yield = None
     self._new_max_keys = self._options.get('max-keys')
 
   def __getstate__(self):
-    options = self._options
+    options = self._options.copy()
+    options.pop('marker', None)
     if self._last_yield:
-      options['marker'] = self._last_yield.filename[len(self._path) + 1:]
+      last_name = self._last_yield
+      if not self._names_only:
+        last_name = last_name.filename
+      options['marker'] = last_name[len(self._path) + 1:]
+    elif self._start_marker is not None:
+      options['marker'] = self._start_marker
     if self._new_max_keys is not None:
       options['max-keys'] = self._new_max_keys
     return {'api': self._api,
             'path': self._path,
-            'options': options}
+            'options': options,
+            'names_only': self._names_only,
+            'end': self._end}
 
   def __setstate__(self, state):
-    self._init(state['api'], state['path'], state['options'])
+    self._init(state['api'], state['path'], state['options'],
+               state.get('names_only', False), state.get('end'))
 
   def __iter__(self):
     """Iter over the bucket.
 
     Yields:
       GCSFileStat: a GCSFileStat for an object in the bucket.
-        They are ordered by GCSFileStat.filename.
+        They are ordered by GCSFileStat.filename. In names only mode,
+        the filenames instead.
     """
     total = 0
     max_keys = self._options.get('max-keys')
 
-    while self._get_bucket_fut:
-      status, resp_headers, content = self._get_bucket_fut.get_result()
-      errors.check_status(status, [200], self._path, resp_headers=resp_headers,
-                          extras=self._options)
-
-      if self._should_get_another_batch(content):
-        self._get_bucket_fut = self._api.get_bucket_async(
-            self._path + '?' + urllib.urlencode(self._options))
+    while self._batches or self._get_bucket_fut:
+      if self._batches:
+        files, dirs = self._batches.popleft()
       else:
-        self._get_bucket_fut = None
-
-      root = ET.fromstring(content)
-      dirs = self._next_dir_gen(root)
-      files = self._next_file_gen(root)
-      next_file = files.next()
-      next_dir = dirs.next()
-
-      while ((max_keys is None or total < max_keys) and
-             not (next_file is None and next_dir is None)):
+        files, dirs = self._next_batch()
+      for stat in heapq.merge(files, dirs):
+        if max_keys is not None and total >= max_keys:
+          return
         total += 1
-        if next_file is None:
-          self._last_yield = next_dir
-          next_dir = dirs.next()
-        elif next_dir is None:
-          self._last_yield = next_file
-          next_file = files.next()
-        elif next_dir < next_file:
-          self._last_yield = next_dir
-          next_dir = dirs.next()
-        elif next_file < next_dir:
-          self._last_yield = next_file
-          next_file = files.next()
-        else:
-          logging.error(
-              'Should never reach. next file is %r. next dir is %r.',
-              next_file, next_dir)
+        self._last_yield = stat
         if self._new_max_keys:
           self._new_max_keys -= 1
         yield self._last_yield
 
-  def _next_file_gen(self, root):
-    """Generator for next file element in the document.
+  def _next_batch(self):
+    """Wait for the pending GET bucket call and parse its batch."""
+    status, resp_headers, content = self._get_bucket_fut.get_result()
+    errors.check_status(status, [200], self._path, resp_headers=resp_headers,
+                        extras=self._options)
+    self._get_bucket_fut = None
+    return self._parse_batch(content)
 
-    Args:
-      root: root element of the XML tree.
+  def _prefetch(self, max_batches):
+    """Parse the batches that already arrived, without waiting.
 
-    Yields:
-      GCSFileStat for the next file.
-    """
-    for e in root.getiterator(common._T_CONTENTS):
-      st_ctime, size, etag, key = None, None, None, None
-      for child in e.getiterator('*'):
-        if child.tag == common._T_LAST_MODIFIED:
-          st_ctime = common.dt_str_to_posix(child.text)
-        elif child.tag == common._T_ETAG:
-          etag = child.text
-        elif child.tag == common._T_SIZE:
-          size = child.text
-        elif child.tag == common._T_KEY:
-          key = child.text
-      yield common.GCSFileStat(self._path + '/' + key,
-                               size, etag, st_ctime)
-      e.clear()
-    yield None
-
-  def _next_dir_gen(self, root):
-    """Generator for next directory element in the document.
+    Parsing a batch requests the next one, so a listing that isn't being
+    iterated yet keeps fetching, up to max_batches batches ahead. Failed
+    calls are left for the iteration to raise.
 
     Args:
-      root: root element in the XML tree.
-
-    Yields:
-      GCSFileStat for the next directory.
+      max_batches: the most batches to hold parsed ahead of the iteration.
     """
-    for e in root.getiterator(common._T_COMMON_PREFIXES):
-      yield common.GCSFileStat(
-          self._path + '/' + e.find(common._T_PREFIX).text,
-          st_size=None, etag=None, st_ctime=None, is_dir=True)
-      e.clear()
-    yield None
-
-  def _should_get_another_batch(self, content):
-    """Whether to issue another GET bucket call.
+    while (self._get_bucket_fut is not None and
+           self._get_bucket_fut.done() and
+           len(self._batches) < max_batches):
+      if (self._get_bucket_fut.get_exception() is not None or
+          self._get_bucket_fut.get_result()[0] != 200):
+        return
+      self._batches.append(self._next_batch())
+
+  def _parse_batch(self, content):
+    """Parse a GET bucket response and request the next batch early.
+
+    The response is parsed once, incrementally. The next GET bucket call is
+    issued as soon as the elements deciding it are parsed, usually near the
+    beginning of the document, so it runs while the rest of this batch is
+    parsed and yielded. Parsed elements are dropped from the tree right
+    away, the tree never holds more than one entry.
 
     Args:
       content: response XML.
 
     Returns:
-      True if should, also update self._options for the next request.
-      False otherwise.
+      A tuple of two lists of GCSFileStat, for the files and for the
+      directories of the batch, each ordered by filename. In names only
+      mode, lists of filenames instead.
     """
-    if ('max-keys' in self._options and
-        self._options['max-keys'] <= common._MAX_GET_BUCKET_RESULT):
-      return False
-
-    elements = self._find_elements(
-        content, set([common._T_IS_TRUNCATED,
-                      common._T_NEXT_MARKER]))
-    if elements.get(common._T_IS_TRUNCATED, 'false').lower() != 'true':
-      return False
+    files = []
+    dirs = []
+    is_truncated = None
+    next_marker = None
+    decided = ('max-keys' in self._options and
+               self._options['max-keys'] <= common._MAX_GET_BUCKET_RESULT)
+    root = None
+    for event, e in ET.iterparse(StringIO.StringIO(content),
+                                 events=('start', 'end')):
+      if event == 'start':
+        if root is None:
+          root = e
+        continue
+      if e.tag == common._T_CONTENTS:
+        if self._names_only:
+          files.append(self._path + '/' + e.findtext(common._T_KEY))
+        else:
+          files.append(self._file_stat(e))
+        root.clear()
+      elif e.tag == common._T_COMMON_PREFIXES:
+        name = self._path + '/' + e.findtext(common._T_PREFIX)
+        if self._names_only:
+          dirs.append(name)
+        else:
+          dirs.append(common.GCSFileStat(
+              name, st_size=None, etag=None, st_ctime=None, is_dir=True))
+        root.clear()
+      elif e.tag == common._T_IS_TRUNCATED:
+        is_truncated = e.text.lower() == 'true'
+      elif e.tag == common._T_NEXT_MARKER:
+        next_marker = e.text
+      else:
+        continue
+      if not decided and (is_truncated is False or
+                          (is_truncated and next_marker is not None)):
+        decided = True
+        self._get_another_batch(is_truncated, next_marker)
+    if not decided:
+      self._get_another_batch(is_truncated, next_marker)
+    return files, dirs
+
+  def _file_stat(self, e):
+    """Returns the GCSFileStat of a Contents element."""
+    st_ctime, size, etag, key = None, None, None, None
+    for child in e.getiterator('*'):
+      if child.tag == common._T_LAST_MODIFIED:
+        st_ctime = common.dt_str_to_posix(child.text)
+      elif child.tag == common._T_ETAG:
+        etag = child.text
+      elif child.tag == common._T_SIZE:
+        size = child.text
+      elif child.tag == common._T_KEY:
+        key = child.text
+    return common.GCSFileStat(self._path + '/' + key,
+                              size, etag, st_ctime)
+
+  def _get_another_batch(self, is_truncated, next_marker):
+    """Issue another GET bucket call if the listing was truncated.
 
-    next_marker = elements.get(common._T_NEXT_MARKER)
+    Args:
+      is_truncated: whether the response was truncated.
+      next_marker: the NextMarker of the response, None if it had none.
+        Updates self._options['marker'] for the next request.
+    """
+    if not is_truncated:
+      return
     if next_marker is None:
       self._options.pop('marker', None)
-      return False
+      return
+    if self._end is not None and next_marker >= self._end:
+      return
     self._options['marker'] = next_marker
-    return True
+    self._get_bucket_fut = self._api.get_bucket_async(
+        self._path + '?' + urllib.urlencode(self._options))
+
+
+class _PartitionedBucket(object):
+  """Concurrent listings of the parts of a bucket, as one listing.
+
+  Part i lists the names after its start marker and up to, inclusive, the
+  start marker of part i + 1, so the parts neither overlap nor miss names.
+  Every part issues its first GET bucket call right away, and while a part
+  is iterated the later parts keep fetching up to MAX_PREFETCHED_BATCHES
+  batches each.
+  """
 
-  def _find_elements(self, result, elements):
-    """Find interesting elements from XML.
+  MAX_PREFETCHED_BATCHES = 10
 
-    This function tries to only look for specified elements
-    without parsing the entire XML. The specified elements is better
-    located near the beginning.
+  def __init__(self, api, path, options, partitions, names_only=False):
+    """Initialize.
 
     Args:
-      result: response XML.
-      elements: a set of interesting element tags.
+      api: storage_api instance.
+      path: bucket path of form '/bucket'.
+      options: a dict of listbucket options, without max-keys.
+      partitions: a sorted list of markers, relative to the bucket, to
+        start the listing of each part after, except the first part.
+      names_only: yield filenames instead of GCSFileStat objects.
+    """
+    marker = options.get('marker')
+    self._bounds = ([marker] + [p for p in partitions if p > marker] +
+                    [None])
+    self._buckets = []
+    for marker, end in zip(self._bounds[:-1], self._bounds[1:]):
+      part_options = options.copy()
+      if marker:
+        part_options['marker'] = marker
+      self._buckets.append(_Bucket(api, path, part_options, names_only, end))
+    self._path = path
+    self._names_only = names_only
+    # index of the part being iterated.
+    self._part = 0
 
-    Returns:
-      A dict from element tag to element value.
+  def __getstate__(self):
+    """Store the part being iterated and the parts after it."""
+    return {'bounds': self._bounds[self._part:],
+            'buckets': self._buckets[self._part:],
+            'path': self._path,
+            'names_only': self._names_only}
+
+  def __setstate__(self, state):
+    self._bounds = state['bounds']
+    self._buckets = state['buckets']
+    self._path = state['path']
+    self._names_only = state['names_only']
+    self._part = 0
+
+  def __iter__(self):
+    """Iter over the parts of the bucket in order.
+
+    Yields:
+      GCSFileStat: a GCSFileStat for an object in the bucket.
+        They are ordered by GCSFileStat.filename. In names only mode,
+        the filenames instead.
     """
-    element_mapping = {}
-    result = StringIO.StringIO(result)
-    for _, e in ET.iterparse(result, events=('end',)):
-      if not elements:
-        break
-      if e.tag in elements:
-        element_mapping[e.tag] = e.text
-        elements.remove(e.tag)
-    return element_mapping
+    for i in range(self._part, len(self._buckets)):
+      self._part = i
+      bucket = self._buckets[i]
+      start, end = self._bounds[i], self._bounds[i + 1]
+      for stat in bucket:
+        name = stat if self._names_only else stat.filename
+        name = name[len(self._path) + 1:]
+        if start is not None and name <= start:
+          continue
+        if end is not None and name > end:
+          break
+        for later_bucket in self._buckets[i + 1:]:
+          later_bucket._prefetch(self.MAX_PREFETCHED_BATCHES)
+        yield stat
 
 
 def _get_storage_api(retry_params, account_id=None):
@@ -435,15 +589,17 @@ def _get_storage_api(retry_params, account_id=None):
   Returns:
     A storage_api instance to handle urlfetch work to GCS.
     On dev appserver, this instance by default will talk to a local stub
-    unless common.ACCESS_TOKEN is set. That token will be used to talk
-    to the real GCS.
+    unless common.ACCESS_TOKEN or an access token maker is set. That token,
+    or the tokens of the maker, will be used to talk to the real GCS.
   """
 
 
   api = storage_api._StorageApi(storage_api._StorageApi.full_control_scope,
                                 service_account_id=account_id,
+                                token_maker=common.get_access_token_maker(),
                                 retry_params=retry_params)
-  if common.local_run() and not common.get_access_token():
+  if (common.local_run() and not common.get_access_token() and
+      not common.get_access_token_maker()):
     api.api_url = common.local_api_url()
   if common.get_access_token():
     api.token = common.get_access_token()
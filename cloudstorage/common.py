@@ -13,6 +13,7 @@ __all__ = ['CS_XML_NS',
            'LOCAL_GCS_ENDPOINT',
            'local_run',
            'get_access_token',
+           'get_access_token_maker',
            'get_metadata',
            'GCSFileStat',
            'http_time_to_posix',
@@ -20,6 +21,7 @@ __all__ = ['CS_XML_NS',
            'posix_time_to_http',
            'posix_to_dt_str',
            'set_access_token',
+           'set_access_token_maker',
            'validate_options',
            'validate_bucket_name',
            'validate_bucket_path',
@@ -53,6 +55,7 @@ _GCS_OPTIONS = _GCS_METADATA + ['x-goog-acl']
 CS_XML_NS = 'http://doc.s3.amazonaws.com/2006-03-01'
 LOCAL_GCS_ENDPOINT = '/_ah/gcs'
 _access_token = ''
+_access_token_maker = None
 
 
 _MAX_GET_BUCKET_RESULT = 1000
@@ -82,6 +85,27 @@ def get_access_token():
   return _access_token
 
 
+def set_access_token_maker(token_maker):
+  """Set a function making the tokens to authenticate with Google Cloud Storage.
+
+  Like set_access_token, when set the library will always communicate with
+  the real Google Cloud Storage, but tokens are only made on first use, and
+  are cached and renewed before they expire like app_identity tokens.
+
+  Args:
+    token_maker: an asynchronous function of the form
+      (scopes, service_account_id) -> (token, expires), where expires is
+      seconds since the epoch. None to unset.
+  """
+  global _access_token_maker
+  _access_token_maker = token_maker
+
+
+def get_access_token_maker():
+  """Returns the shared access token maker."""
+  return _access_token_maker
+
+
 class GCSFileStat(object):
   """Container for GCS file stat."""
 
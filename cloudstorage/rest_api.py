@@ -8,7 +8,11 @@
 
 __all__ = ['add_sync_methods']
 
+import functools
 import httplib
+import os
+import thread
+import threading
 import time
 
 from . import api_utils
@@ -89,6 +93,96 @@ def _make_token_async(scopes, service_account_id):
   raise ndb.Return((token, expires_at))
 
 
+# Seconds before expiration when a token is no longer used.
+_TOKEN_EXPIRY_MARGIN = 60
+
+
+class _TokenCache(object):
+  """In process cache of authentication tokens, shared by all _RestApi.
+
+  A token is renewed ahead of its expiration, once refresh_fraction of its
+  lifetime has passed. The renewal runs in the background, requests keep
+  using the current token meanwhile. Concurrent fetches of a token in a
+  request are collapsed into one. ndb futures can't be shared across
+  threads, so each thread fetches its own.
+  """
+
+  def __init__(self, refresh_fraction=0.75):
+    """Constructor.
+
+    Args:
+      refresh_fraction: fraction of a token's lifetime after which it is
+        renewed in the background.
+    """
+    self.refresh_fraction = refresh_fraction
+    self._lock = threading.Lock()
+    # key -> (token, expiration time, renewal time).
+    self._tokens = {}
+    # (key, thread id) -> (request id, future of the token in flight).
+    self._flights = {}
+
+  @ndb.tasklet
+  def get_token_async(self, key, load_token_async, refresh=False):
+    """Get a token, renewing it in the background when it's due.
+
+    Args:
+      key: the key of the token.
+      load_token_async: an async function of the form
+        (key, min_expires) -> (token, expires), see
+        _RestApi._load_token_async.
+      refresh: If True, ignore a cached token; default False.
+
+    Returns:
+      An authentication token.
+    """
+    now = time.time()
+    with self._lock:
+      entry = self._tokens.get(key)
+    if refresh or entry is None or entry[1] < now + _TOKEN_EXPIRY_MARGIN:
+      min_expires = None if refresh else now + _TOKEN_EXPIRY_MARGIN
+      token = yield self._fetch(key, load_token_async, min_expires,
+                                join=not refresh)
+      raise ndb.Return(token)
+    token, expires, renew_at = entry
+    if now >= renew_at:
+      self._fetch(key, load_token_async, expires + 1)
+    raise ndb.Return(token)
+
+  def _fetch(self, key, load_token_async, min_expires, join=True):
+    """Returns a future of a token, joining a fetch in flight if any.
+
+    Args:
+      key: the key of the token.
+      load_token_async: see get_token_async.
+      min_expires: the minimum expiration time of the token fetched.
+      join: whether to join a fetch of the token in flight.
+    """
+    flight_key = (key, thread.get_ident())
+    request_id = os.getenv('REQUEST_LOG_ID')
+    with self._lock:
+      flight = self._flights.get(flight_key)
+      if (join and flight is not None and flight[0] == request_id and
+          not flight[1].done()):
+        return flight[1]
+    future = self._fetch_async(key, load_token_async, min_expires)
+    if not future.done():
+      with self._lock:
+        self._flights[flight_key] = (request_id, future)
+    return future
+
+  @ndb.tasklet
+  def _fetch_async(self, key, load_token_async, min_expires):
+    token, expires = yield load_token_async(key, min_expires)
+    now = time.time()
+    renew_at = now + (expires - now) * self.refresh_fraction
+    with self._lock:
+      self._tokens[key] = (token, expires, renew_at)
+    raise ndb.Return(token)
+
+
+_token_cache = _TokenCache()
+
+
 class _RestApi(object):
   """Base class for REST-based API wrapper classes.
 
@@ -148,8 +242,25 @@ class _RestApi(object):
 
     This is an async wrapper around urlfetch(). It adds an authentication
     header and retries on a 401 status code. Upon other retriable errors,
-    it performs blocking retries.
+    it retries with backoff without blocking other tasklets. Reads are
+    hedged when retry_params.hedge_percentile is set.
     """
+    fetch = self._authorized_urlfetch_async
+    if (method in ('GET', 'HEAD') and
+        self.retry_params.hedge_percentile is not None):
+      fetch = functools.partial(api_utils._hedged, self.retry_params, fetch)
+    retry_wrapper = api_utils._RetryWrapper(
+        self.retry_params, should_retry=api_utils._should_retry)
+    resp = yield retry_wrapper.run(
+        fetch, url=url, method=method,
+        headers=headers, payload=payload, deadline=deadline,
+        callback=callback)
+    raise ndb.Return((resp.status_code, resp.headers, resp.content))
+
+  @ndb.tasklet
+  def _authorized_urlfetch_async(self, url, method, headers, payload,
+                                 deadline, callback):
+    """Make one authenticated urlfetch() call, refreshing a stale token."""
     headers = {} if headers is None else dict(headers)
     if self.token is None:
       self.token = yield self.get_token_async()
@@ -157,39 +268,24 @@ class _RestApi(object):
 
     deadline = deadline or self.retry_params.urlfetch_timeout
 
-    retry = False
-    resp = None
-    try:
-      resp = yield self.urlfetch_async(url, payload=payload, method=method,
-                                       headers=headers, follow_redirects=False,
-                                       deadline=deadline, callback=callback)
-      if resp.status_code == httplib.UNAUTHORIZED:
-        self.token = yield self.get_token_async(refresh=True)
-        headers['authorization'] = 'OAuth ' + self.token
-        resp = yield self.urlfetch_async(
-            url, payload=payload, method=method, headers=headers,
-            follow_redirects=False, deadline=deadline, callback=callback)
-    except api_utils._RETRIABLE_EXCEPTIONS:
-      retry = True
-    else:
-      retry = api_utils._should_retry(resp)
-
-    if retry:
-      retry_resp = api_utils._retry_fetch(
-          url, retry_params=self.retry_params, payload=payload, method=method,
-          headers=headers, follow_redirects=False, deadline=deadline)
-      if retry_resp:
-        resp = retry_resp
-      elif not resp:
-        raise
-
-    raise ndb.Return((resp.status_code, resp.headers, resp.content))
+    resp = yield self.urlfetch_async(url, payload=payload, method=method,
+                                     headers=headers, follow_redirects=False,
+                                     deadline=deadline, callback=callback)
+    if resp.status_code == httplib.UNAUTHORIZED:
+      self.token = yield self.get_token_async(refresh=True)
+      headers['authorization'] = 'OAuth ' + self.token
+      resp = yield self.urlfetch_async(
+          url, payload=payload, method=method, headers=headers,
+          follow_redirects=False, deadline=deadline, callback=callback)
+    raise ndb.Return(resp)
 
   @ndb.tasklet
   def get_token_async(self, refresh=False):
     """Get an authentication token.
 
-    The token is cached in memcache, keyed by the scopes argument.
+    The token is cached in process, shared by all instances, and in
+    memcache, keyed by the scopes argument. Tokens of a custom token_maker
+    are cached apart, keyed by its name too.
 
     Args:
       refresh: If True, ignore a cached token; default False.
@@ -200,12 +296,31 @@ class _RestApi(object):
     if self.token is not None and not refresh:
       raise ndb.Return(self.token)
     key = '%s,%s' % (self.service_account_id, ','.join(self.scopes))
+    if self.make_token_async != _make_token_async:
+      key = '%s:%s' % (getattr(self.make_token_async, '__name__', ''), key)
+    self.token = yield _token_cache.get_token_async(
+        key, self._load_token_async, refresh=refresh)
+    raise ndb.Return(self.token)
+
+  @ndb.tasklet
+  def _load_token_async(self, key, min_expires):
+    """Get a token from memcache, or a fresh one stored to memcache.
+
+    Args:
+      key: key of the token in memcache.
+      min_expires: ignore a token in memcache that expires before this
+        time. If None, don't look in memcache.
+
+    Returns:
+      A tuple (token, expiration_time) where expiration_time is
+      seconds since the epoch.
+    """
     ts = None
-    if not refresh:
+    if min_expires is not None:
       ts = yield _AE_TokenStorage_.get_by_id_async(
           key, use_cache=True, use_memcache=True,
           use_datastore=self.retry_params.save_access_token)
-    if ts is None or ts.expires < (time.time() + 60):
+    if ts is None or ts.expires < min_expires:
       token, expires_at = yield self.make_token_async(
           self.scopes, self.service_account_id)
       timeout = int(expires_at - time.time())
@@ -214,8 +329,7 @@ class _RestApi(object):
         yield ts.put_async(memcache_timeout=timeout,
                            use_datastore=self.retry_params.save_access_token,
                            use_cache=True, use_memcache=True)
-    self.token = ts.token
-    raise ndb.Return(self.token)
+    raise ndb.Return((ts.token, ts.expires))
 
   def urlfetch_async(self, url, **kwds):
     """Make an async urlfetch() call.
@@ -6,14 +6,17 @@
 
 
 
-__all__ = ['ReadBuffer',
+__all__ = ['ParallelUploadBuffer',
+           'ReadBuffer',
            'StreamingBuffer',
           ]
 
 import collections
 import logging
 import os
+import urllib
 import urlparse
+from xml.sax import saxutils
 
 from . import api_utils
 from . import errors
@@ -145,9 +148,22 @@ class ReadBuffer(object):
                api,
                path,
                buffer_size=DEFAULT_BUFFER_SIZE,
-               max_request_size=MAX_REQUEST_SIZE):
+               max_request_size=MAX_REQUEST_SIZE,
+               file_stat=None,
+               whole_object=False):
     """Constructor.
 
+    The size and etag of the object are taken from file_stat when given,
+    so no request is made until the first buffer is prefetched. Otherwise
+    the first buffer is read right away and the size is taken from its
+    Content-Range, falling back to a HEAD request only when the response
+    doesn't carry it.
+
+    In whole object mode the entire object is read into the buffer right
+    away, with one GET for objects up to max_request_size and parallel GETs
+    of max_request_size for larger ones. A single read() then returns it
+    without copying.
+
     Args:
       api: A StorageApi instance.
       path: Path to the object, e.g. '/mybucket/myfile'.
@@ -155,6 +171,9 @@ class ReadBuffer(object):
         one buffer. But there may be a pending future that contains
         a second buffer. This size must be less than max_request_size.
       max_request_size: Max bytes to request in one urlfetch.
+      file_stat: Optional known common.GCSFileStat of the object, e.g.
+        one yielded by listbucket.
+      whole_object: Whether to read the entire object when constructed.
     """
     self._api = api
     self.name = path
@@ -167,15 +186,23 @@ class ReadBuffer(object):
     self._buffer = _Buffer()
     self._etag = None
 
+    if file_stat is not None:
+      self._file_size = long(file_stat.st_size)
+      self._check_etag(file_stat.etag)
+      if whole_object:
+        self._buffer.reset(self._join(self._get_segments(0,
+                                                         self._file_size)))
+    elif whole_object:
+      self._read_first_buffer(max_request_size)
+      buffered = self._buffer.remaining()
+      if buffered < self._file_size:
+        self._buffer.reset(self._join(
+            [self._buffer.read()] +
+            self._get_segments(buffered, self._file_size - buffered)))
+    else:
+      self._read_first_buffer(buffer_size)
     self._request_next_buffer()
 
-    status, headers, _ = self._api.head_object(path)
-    errors.check_status(status, [200], path, resp_headers=headers)
-    self._file_size = long(headers['content-length'])
-    self._check_etag(headers.get('etag'))
-    if self._file_size == 0:
-      self._buffer_future = None
-
   def __getstate__(self):
     """Store state as part of serialization/pickling.
 
@@ -326,9 +353,70 @@ class ReadBuffer(object):
       self._request_next_buffer()
     return ''.join(data_list)
 
+  def readinto(self, b):
+    """Read up to len(b) bytes into b, like io.RawIOBase.readinto.
+
+    Bytes are copied from the fetched buffers straight into b. A streaming
+    parser reusing b consumes the file without a string per read, holding
+    no more than the read buffer and its prefetched successor.
+
+    Args:
+      b: a writable buffer, like a bytearray.
+
+    Returns:
+      Number of bytes read. 0 at EOF.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    size = min(len(b), self._remaining())
+    read = 0
+    while read < size:
+      if not self._buffer.remaining():
+        self._buffer.reset(self._buffer_future.get_result())
+        self._request_next_buffer()
+      copied = self._buffer.readinto(b, read)
+      self._offset += copied
+      read += copied
+    return read
+
   def _remaining(self):
     return self._file_size - self._offset
 
+  def _read_first_buffer(self, request_size):
+    """Read the first buffer and learn the file size from its response.
+
+    A 206 response has the file size in its Content-Range header, a 200
+    response is the whole file. An empty file can't satisfy the range and
+    its size is learned from a HEAD request.
+
+    Args:
+      request_size: number of bytes to request.
+    """
+    headers = {'Range': 'bytes=0-%d' % (request_size - 1)}
+    status, resp_headers, content = self._api.get_object(
+        self.name, headers=headers)
+    if status != 416:
+      errors.check_status(status, [200, 206], self.name, headers,
+                          resp_headers)
+    file_size = None
+    if status == 206:
+      file_size = _content_range_size(resp_headers.get('content-range'))
+    elif status == 200:
+      file_size = len(content)
+
+    if file_size is None:
+      status, resp_headers, _ = self._api.head_object(self.name)
+      errors.check_status(status, [200], self.name, resp_headers=resp_headers)
+      self._file_size = long(resp_headers['content-length'])
+      self._check_etag(resp_headers.get('etag'))
+      return
+
+    self._file_size = long(file_size)
+    self._check_etag(resp_headers.get('etag'))
+    self._buffer.reset(content)
+
   def _request_next_buffer(self):
     """Request next buffer.
 
@@ -336,7 +424,7 @@ class ReadBuffer(object):
     """
     self._buffer_future = None
     next_offset = self._offset + self._buffer.remaining()
-    if not hasattr(self, '_file_size') or next_offset != self._file_size:
+    if next_offset != self._file_size:
       self._buffer_future = self._get_segment(next_offset,
                                               self._buffer_size)
 
@@ -368,6 +456,13 @@ class ReadBuffer(object):
       futures.append(self._get_segment(start, end-start))
     return [fut.get_result() for fut in futures]
 
+  @staticmethod
+  def _join(segments):
+    """Join segments of the file, without a copy when there is only one."""
+    if len(segments) == 1:
+      return segments[0]
+    return ''.join(segments)
+
   @ndb.tasklet
   def _get_segment(self, start, request_size):
     """Get a segment of the file from Google Storage.
@@ -400,8 +495,9 @@ class ReadBuffer(object):
     If self._etag is None, set it. If etag is set, check that the new
     etag equals the old one.
 
-    In the __init__ method, we fire one HEAD and one GET request using
-    ndb tasklet. One of them would return first and set the first value.
+    The first value comes from the file stat given to __init__ or from the
+    response to the first request. HTTP responses quote their etag while a
+    GCSFileStat doesn't, so quotes are ignored.
 
     Args:
       etag: etag from a GCS HTTP response. None if etag is not part of the
@@ -413,7 +509,8 @@ class ReadBuffer(object):
     """
     if etag is None:
       return
-    elif self._etag is None:
+    etag = etag.strip('"')
+    if self._etag is None:
       self._etag = etag
     elif self._etag != etag:
       raise ValueError('File on GCS has changed while reading.')
@@ -490,6 +587,21 @@ class ReadBuffer(object):
     return False
 
 
+def _content_range_size(content_range):
+  """Returns the complete length of a Content-Range header, or None.
+
+  Args:
+    content_range: Content-Range header value, e.g. 'bytes 0-1023/4096'.
+      Can be None.
+  """
+  if not content_range or '/' not in content_range:
+    return None
+  length = content_range.rsplit('/', 1)[1].strip()
+  if not length.isdigit():
+    return None
+  return long(length)
+
+
 class _Buffer(object):
   """In memory buffer."""
 
@@ -498,6 +610,7 @@ class _Buffer(object):
 
   def reset(self, content='', offset=0):
     self._buffer = content
+    self._view = None
     self._offset = offset
 
   def read(self, size=-1):
@@ -530,6 +643,27 @@ class _Buffer(object):
     self._offset += len(result)
     return result
 
+  def readinto(self, b, start=0):
+    """Copy bytes from self._buffer into b and update related offsets.
+
+    The bytes are copied through a memoryview of the buffer, without an
+    intermediate string.
+
+    Args:
+      b: a writable buffer, like a bytearray.
+      start: offset in b to copy to.
+
+    Returns:
+      Number of bytes copied, as many as fit in b after start.
+    """
+    size = min(len(b) - start, self.remaining())
+    if size > 0:
+      if self._view is None:
+        self._view = memoryview(self._buffer)
+      b[start:start + size] = self._view[self._offset:self._offset + size]
+      self._offset += size
+    return size
+
   def remaining(self):
     return len(self._buffer) - self._offset
 
@@ -782,3 +916,215 @@ class StreamingBuffer(object):
 
   def writable(self):
     return True
+
+
+class ParallelUploadBuffer(object):
+  """A class for creating large objects from parts uploaded in parallel.
+
+  Written data is cut into parts of part_size bytes. Each part is uploaded
+  as a temporary object with a single PUT while writing continues. At most
+  max_pending_parts uploads are in flight, which bounds memory to about
+  (max_pending_parts + 1) * part_size. close() composes the parts into the
+  object and deletes them. Composite objects have no MD5 etag.
+
+  An object smaller than a part is uploaded with one PUT on close().
+  """
+
+  PART_SIZE = 8 * 1024 * 1024
+  MAX_PENDING_PARTS = 4
+  MAX_COMPOSE_COMPONENTS = 32
+
+  def __init__(self,
+               api,
+               path,
+               content_type=None,
+               gcs_headers=None,
+               part_size=PART_SIZE,
+               max_pending_parts=MAX_PENDING_PARTS):
+    """Constructor.
+
+    Args:
+      api: A StorageApi instance.
+      path: Path to the object, e.g. '/mybucket/myfile'.
+      content_type: Optional content-type; Default value is
+        delegate to Google Cloud Storage.
+      gcs_headers: additional gs headers as a str->str dict, e.g
+        {'x-goog-acl': 'private', 'x-goog-meta-foo': 'foo'}.
+      part_size: bytes in each part but the last. It must fit in one
+        urlfetch request.
+      max_pending_parts: max number of part uploads in flight.
+    """
+    assert part_size > 0 and max_pending_parts > 0
+
+    self._api = api
+    self.name = path
+    self.closed = False
+
+    self._headers = {}
+    if content_type:
+      self._headers['content-type'] = content_type
+    if gcs_headers:
+      self._headers.update(gcs_headers)
+    self._part_size = part_size
+    self._max_pending_parts = max_pending_parts
+
+    self._buffer = collections.deque()
+    self._buffered = 0
+    self._offset = 0
+    self._temp_prefix = '%s.part-%s-' % (path, os.urandom(8).encode('hex'))
+    self._temps = []
+    self._pending = collections.deque()
+
+  def write(self, data):
+    """Write some bytes.
+
+    Args:
+      data: data to write. str.
+
+    Raises:
+      TypeError: if data is not of type str.
+    """
+    self._check_open()
+    if not isinstance(data, str):
+      raise TypeError('Expected str but got %s.' % type(data))
+    if not data:
+      return
+    self._buffer.append(data)
+    self._buffered += len(data)
+    self._offset += len(data)
+    while self._buffered >= self._part_size:
+      self._upload_part(self._take(self._part_size))
+
+  def flush(self):
+    """Dummy API, parts are uploaded as soon as they are complete."""
+    self._check_open()
+
+  def tell(self):
+    """Return the total number of bytes passed to write() so far."""
+    self._check_open()
+    return self._offset
+
+  def close(self):
+    """Upload the last part, compose the parts and delete them.
+
+    When this returns the new file is available for reading.
+    """
+    if self.closed:
+      return
+    self.closed = True
+    if not self._temps:
+      status, resp_headers, _ = self._api.put_object(
+          self.name, payload=self._take(self._buffered),
+          headers=self._headers)
+      errors.check_status(status, [200], self.name, self._headers,
+                          resp_headers)
+    else:
+      try:
+        if self._buffered:
+          self._upload_part(self._take(self._buffered))
+        while self._pending:
+          self._check_response(*self._pending.popleft())
+        self._compose()
+      finally:
+        self._delete_temps()
+    self._buffer = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, atype, value, traceback):
+    self.close()
+    return False
+
+  def _take(self, size):
+    """Take size bytes off the front of the buffer as one str."""
+    data = []
+    taken = 0
+    while taken < size:
+      buf = self._buffer.popleft()
+      if taken + len(buf) > size:
+        self._buffer.appendleft(buf[size - taken:])
+        buf = buf[:size - taken]
+      data.append(buf)
+      taken += len(buf)
+    self._buffered -= size
+    return ''.join(data)
+
+  def _upload_part(self, data):
+    """Start the upload of a part, waiting for the oldest if too many."""
+    path = '%s%05d' % (self._temp_prefix, len(self._temps))
+    self._temps.append(path)
+    self._pending.append(
+        (path, self._api.put_object_async(path, payload=data)))
+    while len(self._pending) > self._max_pending_parts:
+      self._check_response(*self._pending.popleft())
+
+  def _check_response(self, path, future):
+    status, resp_headers, _ = future.get_result()
+    errors.check_status(status, [200], path, resp_headers=resp_headers)
+
+  def _compose(self):
+    """Compose the parts into the object.
+
+    GCS composes at most MAX_COMPOSE_COMPONENTS objects at a time, more
+    parts are composed in levels of temporary objects.
+    """
+    components = self._temps[:]
+    level = 0
+    while len(components) > self.MAX_COMPOSE_COMPONENTS:
+      level += 1
+      futures = []
+      for i in range(0, len(components), self.MAX_COMPOSE_COMPONENTS):
+        path = '%sl%d-%05d' % (self._temp_prefix, level, len(futures))
+        self._temps.append(path)
+        futures.append((path, self._compose_async(
+            components[i:i + self.MAX_COMPOSE_COMPONENTS], path, {})))
+      for path, future in futures:
+        self._check_response(path, future)
+      components = [path for path, _ in futures]
+    self._check_response(
+        self.name, self._compose_async(components, self.name, self._headers))
+
+  def _compose_async(self, components, path, headers):
+    """Compose objects of the same bucket into path."""
+    xml = ['<ComposeRequest>']
+    for component in components:
+      object_name = urllib.unquote(component).split('/', 2)[2]
+      xml.append('<Component><Name>%s</Name></Component>' %
+                 saxutils.escape(object_name))
+    xml.append('</ComposeRequest>')
+    return self._api.put_object_async(path + '?compose',
+                                      payload=''.join(xml), headers=headers)
+
+  def _delete_temps(self):
+    """Delete the temporary objects, logging the ones left behind."""
+    # cleanup runs in a finally clause, it must not replace the exception of
+    # a failed upload with one of its own.
+    cleanup_errors = (errors.Error,) + api_utils._RETRIABLE_EXCEPTIONS
+    futures = []
+    for path in self._temps:
+      try:
+        futures.append((path, self._api.delete_object_async(path)))
+      except cleanup_errors, e:
+        logging.warning('Failed to delete temporary object %s: %s', path, e)
+    for path, future in futures:
+      try:
+        status, _, _ = future.get_result()
+      except cleanup_errors, e:
+        status = e
+      if status not in (204, 404):
+        logging.warning('Failed to delete temporary object %s: %s',
+                        path, status)
+
+  def _check_open(self):
+    if self.closed:
+      raise IOError('Buffer is closed.')
+
+  def seekable(self):
+    return False
+
+  def readable(self):
+    return False
+
+  def writable(self):
+    return True
@@ -26,6 +26,7 @@ Google Visualization API.
 
 __author__ = "Amit Weinstein, Misha Seltzer, Jacob Baskin"
 
+import calendar
 import cgi
 import cStringIO
 import csv
@@ -69,6 +70,17 @@ class DataTableJSONEncoder(json.JSONEncoder):
       return super(DataTableJSONEncoder, self).default(o)
 
 
+class _RecodingWriter(object):
+  """File-like object writing UTF-8 strings to another in a new encoding."""
+
+  def __init__(self, out, encoding):
+    self._out = out
+    self._encoding = encoding
+
+  def write(self, data):
+    self._out.write(data.decode("utf-8").encode(self._encoding))
+
+
 class DataTable(object):
   """Wraps the data to convert to a Google Visualization API DataTable.
 
@@ -266,6 +278,90 @@ class DataTable(object):
     # supported types.
     raise DataTableException("Unsupported type %s" % value_type)
 
+  @staticmethod
+  def CoerceFunction(value_type):
+    """Returns a function coercing values for a column of the given type.
+
+    Internal helper method. The returned function is equivalent to
+    CoerceValue(value, value_type), but the type dispatch is resolved once so
+    the function can be applied to every cell of a column. Values of the
+    expected Python type are returned directly, anything else (tuples, values
+    needing conversion or invalid values) goes through CoerceValue.
+
+    Args:
+      value_type: One of "string", "number", "boolean", "date", "datetime" or
+                  "timeofday".
+
+    Returns:
+      A function of a single value, returning the coerced value.
+    """
+    coerce_value = DataTable.CoerceValue
+    if value_type == "boolean":
+      def CoerceBoolean(value):
+        if value is None or isinstance(value, tuple):
+          return coerce_value(value, value_type)
+        return bool(value)
+      return CoerceBoolean
+
+    native_types = {"number": (float, int, long),
+                    "string": (unicode,),
+                    "date": (datetime.date,),
+                    "datetime": (datetime.datetime,),
+                    "timeofday": (datetime.time,)}.get(value_type, ())
+
+    def Coerce(value):
+      if value is None or type(value) in native_types:
+        return value
+      return coerce_value(value, value_type)
+    return Coerce
+
+  @staticmethod
+  def JSonEncodeFunction(encoder, value_type):
+    """Returns a function JSON encoding coerced values of the given type.
+
+    Internal helper method. The returned function produces the same string as
+    encoder.encode(value) for a value returned by CoerceValue(), with the
+    formatting of the column's native type resolved once.
+
+    Args:
+      encoder: A DataTableJSONEncoder, used for values of other types.
+      value_type: The type of the column the values belong to.
+
+    Returns:
+      A function of a single coerced (non tuple) value, returning its JSON.
+    """
+    encode = encoder.encode
+    if value_type == "number":
+      float_repr = float.__repr__
+      def EncodeNumber(value):
+        # JSON encodes finite floats using their repr.
+        if type(value) is float and value - value == 0:
+          return float_repr(value)
+        return encode(value)
+      return EncodeNumber
+
+    if value_type == "datetime":
+      def EncodeDateTime(value):
+        if type(value) is not datetime.datetime:
+          return encode(value)
+        if value.microsecond == 0:
+          return "\"Date(%d,%d,%d,%d,%d,%d)\"" % (
+              value.year, value.month - 1, value.day, value.hour,
+              value.minute, value.second)
+        return "\"Date(%d,%d,%d,%d,%d,%d,%d)\"" % (
+            value.year, value.month - 1, value.day, value.hour,
+            value.minute, value.second, value.microsecond / 1000)
+      return EncodeDateTime
+
+    if value_type == "date":
+      def EncodeDate(value):
+        if type(value) is not datetime.date:
+          return encode(value)
+        return "\"Date(%d,%d,%d)\"" % (value.year, value.month - 1, value.day)
+      return EncodeDate
+
+    return encode
+
   @staticmethod
   def EscapeForJSCode(encoder, value):
     if value is None:
@@ -683,6 +779,33 @@ class DataTable(object):
 
     return sorted(self.__data, cmp=SortCmpFunc)
 
+  def _ColumnCoerceFunctions(self, columns_order, data):
+    """Returns the coercion function of each column, resolved once per column.
+
+    Number columns holding only floats and None values are checked once as a
+    whole, and get None instead of a function since their values need neither
+    coercion nor validation.
+
+    Args:
+      columns_order: The IDs of the columns, in output order.
+      data: The prepared data, as returned by _PreparedData().
+
+    Returns:
+      A list with a function returned by CoerceFunction(), or None, for each
+      column in columns_order.
+    """
+    col_dict = dict([(col["id"], col) for col in self.__columns])
+    float_types = (float, types.NoneType)
+    coerce_funcs = []
+    for col in columns_order:
+      col_type = col_dict[col]["type"]
+      if col_type == "number" and all(type(row.get(col)) in float_types
+                                      for row, unused_cp in data):
+        coerce_funcs.append(None)
+      else:
+        coerce_funcs.append(self.CoerceFunction(col_type))
+    return coerce_funcs
+
   def ToJSCode(self, name, columns_order=None, order_by=()):
     """Writes the data table as a JS code string.
 
@@ -747,12 +870,22 @@ class DataTable(object):
     jscode += "%s.addRows(%d);\n" % (name, len(self.__data))
 
     # We now go over the data and add each row
-    for (i, (row, cp)) in enumerate(self._PreparedData(order_by)):
+    data = self._PreparedData(order_by)
+    columns = zip(columns_order,
+                  self._ColumnCoerceFunctions(columns_order, data))
+    encode_number = self.JSonEncodeFunction(encoder, "number")
+    for (i, (row, cp)) in enumerate(data):
       # We add all the elements of this row by their order
-      for (j, col) in enumerate(columns_order):
-        if col not in row or row[col] is None:
+      for (j, (col, coerce)) in enumerate(columns):
+        value = row.get(col)
+        if value is None:
+          continue
+        if not coerce:
+          # A float column, see _ColumnCoerceFunctions().
+          jscode += "%s.setCell(%d, %d, %s);\n" % (
+              name, i, j, encode_number(value))
           continue
-        value = self.CoerceValue(row[col], col_dict[col]["type"])
+        value = coerce(value)
         if isinstance(value, tuple):
           cell_cp = ""
           if len(value) == 3:
@@ -815,14 +948,24 @@ class DataTable(object):
 
     rows_list = []
     # We now go over the data and add each row
-    for row, unused_cp in self._PreparedData(order_by):
+    data = self._PreparedData(order_by)
+    columns = zip(columns_order,
+                  self._ColumnCoerceFunctions(columns_order, data))
+    for row, unused_cp in data:
       cells_list = []
       # We add all the elements of this row by their order
-      for col in columns_order:
-        # For empty string we want empty quotes ("").
-        value = ""
-        if col in row and row[col] is not None:
-          value = self.CoerceValue(row[col], col_dict[col]["type"])
+      for col, coerce in columns:
+        value = row.get(col)
+        if not coerce:
+          # A float column, see _ColumnCoerceFunctions().
+          cells_list.append(
+              cell_template % (u"" if value is None else unicode(value)))
+          continue
+        if value is None:
+          # For empty string we want empty quotes ("").
+          value = ""
+        else:
+          value = coerce(value)
         if isinstance(value, tuple):
           # We have a formatted value and we're going to use it
           cells_list.append(cell_template % cgi.escape(self.ToString(value[1])))
@@ -861,23 +1004,54 @@ class DataTable(object):
     """
 
     csv_buffer = cStringIO.StringIO()
-    writer = csv.writer(csv_buffer, delimiter=separator)
+    self.WriteCsv(csv_buffer, columns_order, order_by, separator)
+    return csv_buffer.getvalue()
+
+  def WriteCsv(self, out, columns_order=None, order_by=(), separator=",",
+               header=True):
+    """Writes the CSV string returned by ToCsv() to a file-like object.
+
+    Each row is written as soon as it is formatted, so the whole CSV string is
+    never held in memory. Tables with the same columns can be written one after
+    the other to the same object, writing the header for the first only.
+
+    Args:
+      out: A file-like object with a write() method, e.g. a webapp2 response.
+      columns_order: Optional. Passed straight to self.ToCsv().
+      order_by: Optional. Passed straight to self.ToCsv().
+      separator: Optional. Passed straight to self.ToCsv().
+      header: Optional. Whether to write the row of column labels.
+
+    Raises:
+      DataTableException: The data does not match the type.
+    """
+    writer = csv.writer(out, delimiter=separator)
 
     if columns_order is None:
       columns_order = [col["id"] for col in self.__columns]
     col_dict = dict([(col["id"], col) for col in self.__columns])
 
-    writer.writerow([col_dict[col]["label"].encode("utf-8")
-                     for col in columns_order])
+    if header:
+      writer.writerow([col_dict[col]["label"].encode("utf-8")
+                       for col in columns_order])
 
     # We now go over the data and add each row
-    for row, unused_cp in self._PreparedData(order_by):
+    data = self._PreparedData(order_by)
+    columns = zip(columns_order,
+                  self._ColumnCoerceFunctions(columns_order, data))
+    for row, unused_cp in data:
       cells_list = []
       # We add all the elements of this row by their order
-      for col in columns_order:
-        value = ""
-        if col in row and row[col] is not None:
-          value = self.CoerceValue(row[col], col_dict[col]["type"])
+      for col, coerce in columns:
+        value = row.get(col)
+        if not coerce:
+          # A float column, see _ColumnCoerceFunctions().
+          cells_list.append("" if value is None else str(value))
+          continue
+        if value is None:
+          value = ""
+        else:
+          value = coerce(value)
         if isinstance(value, tuple):
           # We have a formatted value. Using it only for date/time types.
           if col_dict[col]["type"] in ["date", "datetime", "timeofday"]:
@@ -887,7 +1061,6 @@ class DataTable(object):
         else:
           cells_list.append(self.ToString(value).encode("utf-8"))
       writer.writerow(cells_list)
-    return csv_buffer.getvalue()
 
   def ToTsvExcel(self, columns_order=None, order_by=()):
     """Returns a file in tab-separated-format readable by MS Excel.
@@ -905,6 +1078,46 @@ class DataTable(object):
     return (self.ToCsv(columns_order, order_by, separator="\t")
             .decode("utf-8").encode("UTF-16LE"))
 
+  def WriteTsvExcel(self, out, columns_order=None, order_by=(), header=True):
+    """Writes the file returned by ToTsvExcel() to a file-like object.
+
+    Like WriteCsv(), each row is written as soon as it is formatted.
+
+    Args:
+      out: A file-like object with a write() method, e.g. a webapp2 response.
+      columns_order: Delegated to WriteCsv.
+      order_by: Delegated to WriteCsv.
+      header: Delegated to WriteCsv.
+
+    Raises:
+      DataTableException: The data does not match the type.
+    """
+    self.WriteCsv(_RecodingWriter(out, "UTF-16LE"), columns_order, order_by,
+                  separator="\t", header=header)
+
+  def _JSonColumnObjs(self, columns_order):
+    """Returns the list of column objects for the JSON output."""
+    col_dict = dict([(col["id"], col) for col in self.__columns])
+    col_objs = []
+    for col_id in columns_order:
+      col_obj = {"id": col_dict[col_id]["id"],
+                 "label": col_dict[col_id]["label"],
+                 "type": col_dict[col_id]["type"]}
+      if col_dict[col_id]["custom_properties"]:
+        col_obj["p"] = col_dict[col_id]["custom_properties"]
+      col_objs.append(col_obj)
+    return col_objs
+
+  @staticmethod
+  def _JSonCellObj(value):
+    """Returns the JSON object of a coerced (value, formatted[, cp]) tuple."""
+    cell_obj = {"v": value[0]}
+    if len(value) > 1 and value[1] is not None:
+      cell_obj["f"] = value[1]
+    if len(value) == 3:
+      cell_obj["p"] = value[2]
+    return cell_obj
+
   def _ToJSonObj(self, columns_order=None, order_by=()):
     """Returns an object suitable to be converted to JSON.
 
@@ -923,14 +1136,7 @@ class DataTable(object):
     col_dict = dict([(col["id"], col) for col in self.__columns])
 
     # Creating the column JSON objects
-    col_objs = []
-    for col_id in columns_order:
-      col_obj = {"id": col_dict[col_id]["id"],
-                 "label": col_dict[col_id]["label"],
-                 "type": col_dict[col_id]["type"]}
-      if col_dict[col_id]["custom_properties"]:
-        col_obj["p"] = col_dict[col_id]["custom_properties"]
-      col_objs.append(col_obj)
+    col_objs = self._JSonColumnObjs(columns_order)
 
     # Creating the rows jsons
     row_objs = []
@@ -941,11 +1147,7 @@ class DataTable(object):
         if value is None:
           cell_obj = None
         elif isinstance(value, tuple):
-          cell_obj = {"v": value[0]}
-          if len(value) > 1 and value[1] is not None:
-            cell_obj["f"] = value[1]
-          if len(value) == 3:
-            cell_obj["p"] = value[2]
+          cell_obj = self._JSonCellObj(value)
         else:
           cell_obj = {"v": value}
         cell_objs.append(cell_obj)
@@ -960,6 +1162,116 @@ class DataTable(object):
 
     return json_obj
 
+  @staticmethod
+  def _IterEncodeDict(encoder, obj, key, value_chunks):
+    """Yields the JSON encoding of a dictionary, streaming one of its values.
+
+    The items are encoded in the dictionary's iteration order, the same order
+    used by the JSON encoder, so joining the chunks gives encoder.encode(obj)
+    with obj[key] replaced by the joined value_chunks.
+
+    Args:
+      encoder: The DataTableJSONEncoder to encode the other items with.
+      obj: The dictionary to encode. The value of key is ignored.
+      key: The key whose encoded value is given by value_chunks.
+      value_chunks: An iterable of strings encoding the value of key.
+    """
+    separator = "{"
+    for item_key, item_value in obj.iteritems():
+      yield "%s%s:" % (separator, encoder.encode(item_key))
+      separator = ","
+      if item_key == key:
+        for chunk in value_chunks:
+          yield chunk
+      else:
+        yield encoder.encode(item_value)
+    yield "}"
+
+  def _JSonRowChunks(self, encoder, columns_order, order_by, rows_per_chunk):
+    """Yields the JSON encoding of the table rows list in chunks of rows.
+
+    Each cell is coerced and encoded using functions resolved once per column
+    by _ColumnCoerceFunctions() and JSonEncodeFunction(), instead of building
+    the cell objects of _ToJSonObj().
+    """
+    col_dict = dict([(col["id"], col) for col in self.__columns])
+    data = self._PreparedData(order_by)
+    col_funcs = zip(columns_order,
+                    self._ColumnCoerceFunctions(columns_order, data),
+                    [self.JSonEncodeFunction(encoder, col_dict[col]["type"])
+                     for col in columns_order])
+
+    rows_list = []
+    separator = "["
+    for row, cp in data:
+      cells_list = []
+      for col, coerce, encode in col_funcs:
+        value = row.get(col)
+        if coerce:
+          value = coerce(value)
+        if value is None:
+          cells_list.append("null")
+        elif isinstance(value, tuple):
+          cells_list.append(encoder.encode(self._JSonCellObj(value)))
+        else:
+          cells_list.append("{\"v\":%s}" % encode(value))
+      cells = "[%s]" % ",".join(cells_list)
+      if cp:
+        rows_list.append("".join(self._IterEncodeDict(
+            encoder, {"c": None, "p": cp}, "c", [cells])))
+      else:
+        rows_list.append("{\"c\":%s}" % cells)
+      if len(rows_list) >= rows_per_chunk:
+        yield separator + ",".join(rows_list)
+        separator = ","
+        rows_list = []
+    if rows_list:
+      yield separator + ",".join(rows_list)
+      separator = ","
+    if separator == "[":
+      # There were no rows at all.
+      yield "[]"
+    else:
+      yield "]"
+
+  def _JSonChunks(self, encoder, columns_order=None, order_by=(),
+                  rows_per_chunk=100):
+    """Yields the JSON encoding of the table, as returned by ToJSon().
+
+    The result is the same as encoding the object returned by _ToJSonObj(),
+    but the rows are encoded as they are enumerated, rows_per_chunk rows at a
+    time, without building the intermediate object.
+    """
+    if columns_order is None:
+      columns_order = [col["id"] for col in self.__columns]
+
+    json_obj = {"cols": self._JSonColumnObjs(columns_order), "rows": None}
+    if self.custom_properties:
+      json_obj["p"] = self.custom_properties
+
+    return self._IterEncodeDict(
+        encoder, json_obj, "rows",
+        self._JSonRowChunks(encoder, columns_order, order_by, rows_per_chunk))
+
+  def _JSonResponseChunks(self, columns_order, order_by, req_id,
+                          response_handler):
+    """Yields the UTF-8 encoded response returned by ToJSonResponse()."""
+    encoder = DataTableJSONEncoder()
+    response_obj = {
+        "version": "0.6",
+        "reqId": str(req_id),
+        "table": None,
+        "status": "ok"
+    }
+    yield "%s(" % response_handler
+    for chunk in self._IterEncodeDict(
+        encoder, response_obj, "table",
+        self._JSonChunks(encoder, columns_order, order_by)):
+      if isinstance(chunk, unicode):
+        chunk = chunk.encode("utf-8")
+      yield chunk
+    yield ");"
+
   def ToJSon(self, columns_order=None, order_by=()):
     """Returns a string that can be used in a JS DataTable constructor.
 
@@ -999,8 +1311,30 @@ class DataTable(object):
     """
 
     encoder = DataTableJSONEncoder()
-    return encoder.encode(
-        self._ToJSonObj(columns_order, order_by)).encode("utf-8")
+    return "".join(self._JSonChunks(encoder, columns_order,
+                                    order_by)).encode("utf-8")
+
+  def WriteJSon(self, out, columns_order=None, order_by=()):
+    """Writes the string returned by ToJSon() to a file-like object.
+
+    The output is written a few rows at a time as it is encoded, so the whole
+    JSON string is never held in memory. Note that if the data does not match
+    the type, part of the output may already have been written when the
+    exception is raised.
+
+    Args:
+      out: A file-like object with a write() method, e.g. a webapp2 response.
+      columns_order: Optional. Passed straight to self.ToJSon().
+      order_by: Optional. Passed straight to self.ToJSon().
+
+    Raises:
+      DataTableException: The data does not match the type.
+    """
+    encoder = DataTableJSONEncoder()
+    for chunk in self._JSonChunks(encoder, columns_order, order_by):
+      if isinstance(chunk, unicode):
+        chunk = chunk.encode("utf-8")
+      out.write(chunk)
 
   def ToJSonResponse(self, columns_order=None, order_by=(), req_id=0,
                      response_handler="google.visualization.Query.setResponse"):
@@ -1031,15 +1365,199 @@ class DataTable(object):
           Visualization Gadgets or from JS code.
     """
 
-    response_obj = {
-        "version": "0.6",
-        "reqId": str(req_id),
-        "table": self._ToJSonObj(columns_order, order_by),
-        "status": "ok"
-    }
+    return "".join(self._JSonResponseChunks(columns_order, order_by, req_id,
+                                            response_handler))
+
+  def WriteJSonResponse(
+      self, out, columns_order=None, order_by=(), req_id=0,
+      response_handler="google.visualization.Query.setResponse"):
+    """Writes the string returned by ToJSonResponse() to a file-like object.
+
+    Like WriteJSon(), the response is written a few rows at a time as it is
+    encoded.
+
+    Args:
+      out: A file-like object with a write() method, e.g. a webapp2 response.
+      columns_order: Optional. Passed straight to self.ToJSon().
+      order_by: Optional. Passed straight to self.ToJSon().
+      req_id: Optional. The response id, as retrieved by the request.
+      response_handler: Optional. The response handler, as retrieved by the
+          request.
+
+    Raises:
+      DataTableException: The data does not match the type.
+    """
+    for chunk in self._JSonResponseChunks(columns_order, order_by, req_id,
+                                          response_handler):
+      out.write(chunk)
+
+  @staticmethod
+  def CompactJSonEncodeFunction(encoder, value_type, precision=None):
+    """Returns a function encoding coerced values for the compact JSON output.
+
+    Internal helper method. Dates and datetimes are encoded as milliseconds
+    since the epoch of their (naive) fields, and numbers are rounded to
+    precision decimal places, dropping trailing zeros. Non finite numbers are
+    encoded as null. Other values are encoded as by JSonEncodeFunction().
+
+    Args:
+      encoder: A DataTableJSONEncoder, used for values of other types.
+      value_type: The type of the column the values belong to.
+      precision: Optional. Number of decimal places to round numbers to.
+
+    Returns:
+      A function of a single coerced (non tuple) value, returning its JSON.
+    """
+    encode = DataTable.JSonEncodeFunction(encoder, value_type)
+    if value_type == "number":
+      def EncodeNumber(value):
+        if type(value) is not float:
+          return encode(value)
+        if value - value != 0:
+          return "null"
+        if precision is None:
+          return float.__repr__(value)
+        value_str = "%.*f" % (precision, value)
+        if "." in value_str:
+          value_str = value_str.rstrip("0").rstrip(".")
+        if value_str == "-0":
+          value_str = "0"
+        return value_str
+      return EncodeNumber
+
+    if value_type in ("date", "datetime"):
+      timegm = calendar.timegm
+      def EncodeDate(value):
+        if not isinstance(value, datetime.date):
+          return encode(value)
+        millis = timegm(value.timetuple()) * 1000
+        if isinstance(value, datetime.datetime):
+          millis += value.microsecond / 1000
+        return str(millis)
+      return EncodeDate
+
+    return encode
+
+  def _CompactJSonRowChunks(self, encoder, columns_order, order_by, precision,
+                            rows_per_chunk):
+    """Yields the rows list of the compact JSON output in chunks of rows."""
+    col_dict = dict([(col["id"], col) for col in self.__columns])
+    data = self._PreparedData(order_by)
+    col_funcs = zip(range(len(columns_order)),
+                    columns_order,
+                    self._ColumnCoerceFunctions(columns_order, data),
+                    [self.CompactJSonEncodeFunction(
+                        encoder, col_dict[col]["type"], precision)
+                     for col in columns_order])
+
+    rows_list = []
+    separator = "["
+    for row, cp in data:
+      cells_list = []
+      for index, col, coerce, encode in col_funcs:
+        value = row.get(col)
+        if coerce:
+          value = coerce(value)
+        if value is None:
+          continue
+        if isinstance(value, tuple):
+          cell = "".join(self._IterEncodeDict(
+              encoder, self._JSonCellObj(value), "v",
+              [value[0] is None and "null" or encode(value[0])]))
+        else:
+          cell = encode(value)
+          if cell == "null":
+            continue
+        cells_list.append("%d,%s" % (index, cell))
+      cells = "[%s]" % ",".join(cells_list)
+      if cp:
+        rows_list.append("".join(self._IterEncodeDict(
+            encoder, {"c": None, "p": cp}, "c", [cells])))
+      else:
+        rows_list.append(cells)
+      if len(rows_list) >= rows_per_chunk:
+        yield separator + ",".join(rows_list)
+        separator = ","
+        rows_list = []
+    if rows_list:
+      yield separator + ",".join(rows_list)
+      separator = ","
+    if separator == "[":
+      # There were no rows at all.
+      yield "[]"
+    else:
+      yield "]"
+
+  def _CompactJSonChunks(self, columns_order, order_by, precision,
+                         rows_per_chunk=100):
+    """Yields the UTF-8 encoded string returned by ToCompactJSon()."""
     encoder = DataTableJSONEncoder()
-    return "%s(%s);" % (response_handler,
-                        encoder.encode(response_obj).encode("utf-8"))
+    if columns_order is None:
+      columns_order = [col["id"] for col in self.__columns]
+
+    json_obj = {"cols": self._JSonColumnObjs(columns_order), "rows": None}
+    if self.custom_properties:
+      json_obj["p"] = self.custom_properties
+
+    for chunk in self._IterEncodeDict(
+        encoder, json_obj, "rows",
+        self._CompactJSonRowChunks(encoder, columns_order, order_by,
+                                   precision, rows_per_chunk)):
+      if isinstance(chunk, unicode):
+        chunk = chunk.encode("utf-8")
+      yield chunk
+
+  def ToCompactJSon(self, columns_order=None, order_by=(), precision=None):
+    """Returns a compact JSON string of the table for sparse numeric data.
+
+    The output has the same "cols" and "p" as ToJSon(), but each row is a
+    flat list of column index and value pairs, where null cells are omitted.
+    Dates and datetimes are given as milliseconds since the epoch of their
+    fields in UTC, and numbers may be rounded. Cells with a formatted value or
+    custom properties are given as a cell object, and rows with custom
+    properties as an object of the list "c" and the properties "p".
+
+    This is not a format understood by the Google Visualization API, the
+    client needs to build the DataTable from it.
+
+    Args:
+      columns_order: Optional. Passed straight to self.ToJSon().
+      order_by: Optional. Passed straight to self.ToJSon().
+      precision: Optional. Number of decimal places to round numbers to. Non
+                 finite numbers are always given as null and omitted.
+
+    Returns:
+      A compact JSON string representing the table.
+      Example result (the result is without the newlines):
+       {"cols": [{"id":"t","label":"t","type":"datetime"},
+                 {"id":"a","label":"a","type":"number"},
+                 {"id":"b","label":"b","type":"number"}],
+        "rows": [[0,1391212800000,2,0.5],
+                 [0,1391299200000,1,3,2,{"v":1.25,"f":"$1.25"}]]}
+
+    Raises:
+      DataTableException: The data does not match the type.
+    """
+    return "".join(self._CompactJSonChunks(columns_order, order_by, precision))
+
+  def WriteCompactJSon(self, out, columns_order=None, order_by=(),
+                       precision=None):
+    """Writes the string returned by ToCompactJSon() to a file-like object.
+
+    Like WriteJSon(), the output is written a few rows at a time as it is
+    encoded.
+
+    Args:
+      out: A file-like object with a write() method, e.g. a webapp2 response.
+      columns_order: Optional. Passed straight to self.ToJSon().
+      order_by: Optional. Passed straight to self.ToJSon().
+      precision: Optional. Passed straight to self.ToCompactJSon().
+
+    Raises:
+      DataTableException: The data does not match the type.
+    """
+    for chunk in self._CompactJSonChunks(columns_order, order_by, precision):
+      out.write(chunk)
 
   def ToResponse(self, columns_order=None, order_by=(), tqx=""):
     """Writes the right response according to the request string passed in tqx.
@@ -1048,9 +1566,9 @@ class DataTable(object):
     the documentation for implementing a data source of Google Visualization),
     and returns the right response according to the request.
     It parses out the "out" parameter of tqx, calls the relevant response
-    (ToJSonResponse() for "json", ToCsv() for "csv", ToHtml() for "html",
-    ToTsvExcel() for "tsv-excel") and passes the response function the rest of
-    the relevant request keys.
+    (ToJSonResponse() for "json", ToCompactJSon() for "compact", ToCsv() for
+    "csv", ToHtml() for "html", ToTsvExcel() for "tsv-excel") and passes the
+    response function the rest of the relevant request keys.
 
     Args:
       columns_order: Optional. Passed as is to the relevant response function.
@@ -1080,6 +1598,8 @@ class DataTable(object):
       return self.ToJSonResponse(columns_order, order_by,
                                  req_id=tqx_dict.get("reqId", 0),
                                  response_handler=response_handler)
+    elif tqx_dict["out"] == "compact":
+      return self.ToCompactJSon(columns_order, order_by)
     elif tqx_dict["out"] == "html":
       return self.ToHtml(columns_order, order_by)
     elif tqx_dict["out"] == "csv":
@@ -43,6 +43,11 @@ import calendar
 import time
 import random
 import errno
+import threading
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = None
 try:
     from hashlib import sha1 as _sha, md5 as _md5
 except ImportError:
@@ -107,7 +112,7 @@ __all__ = [
     'RedirectLimit', 'FailedToDecompressContent',
     'UnimplementedDigestAuthOptionError',
     'UnimplementedHmacDigestAuthOptionError',
-    'debuglevel', 'ProxiesUnavailableError']
+    'debuglevel', 'ProxiesUnavailableError', 'ConnectionPool', 'LRUCache']
 
 
 # The httplib debug level, set to a non-zero value to get debug output
@@ -721,6 +726,107 @@ class FileCache(object):
         if os.path.exists(cacheFullPath):
             os.remove(cacheFullPath)
 
+class LRUCache(object):
+    """Keeps cached responses in memory, safe to share between threads.
+
+    The least recently used entries are evicted once the keys and values
+    take more than 'max_bytes'. An entry expires after the max-age of its
+    Cache-Control header, or at its Expires header, or after 'default_ttl'
+    seconds when it has neither. None means no expiration. Requires
+    Python 2.7.
+    """
+    def __init__(self, max_bytes=10 * 1024 * 1024, default_ttl=None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        # key -> (expiration time or None, value), least recently used first.
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                       'expirations': 0}
+
+    def _expires(self, value):
+        """Returns the expiration time of a cached response."""
+        head = value.split('\r\n\r\n', 1)[0]
+        cache_control = re.search(r'(?im)^cache-control:([^\r\n]*)', head)
+        if cache_control:
+            cc = _parse_cache_control({'cache-control': cache_control.group(1)})
+            if cc.has_key('max-age'):
+                try:
+                    return time.time() + int(cc['max-age'])
+                except ValueError:
+                    return time.time()
+        expires = re.search(r'(?im)^expires:([^\r\n]*)', head)
+        if expires:
+            parsed = email.Utils.parsedate_tz(expires.group(1).strip())
+            return parsed and email.Utils.mktime_tz(parsed) or time.time()
+        if self.default_ttl is not None:
+            return time.time() + self.default_ttl
+        return None
+
+    def _remove(self, key):
+        expires, value = self._entries.pop(key)
+        self._bytes -= len(key) + len(value)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            expires, value = entry
+            self._remove(key)
+            if expires is not None and expires <= time.time():
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            # reinserted as the most recently used.
+            self._entries[key] = entry
+            self._bytes += len(key) + len(value)
+            self._stats['hits'] += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        size = len(key) + len(value)
+        expires = self._expires(value)
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            while self._bytes + size > self.max_bytes:
+                self._remove(iter(self._entries).next())
+                self._stats['evictions'] += 1
+            self._entries[key] = (expires, value)
+            self._bytes += size
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """Returns a dict of the cache 'hits' and 'misses', the entries
+        dropped to make room ('evictions') or found expired
+        ('expirations'), and the 'entries' and 'bytes' cached now."""
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        finally:
+            self._lock.release()
+        return stats
+
 class Credentials(object):
     def __init__(self):
         self.credentials = []
@@ -1122,6 +1228,121 @@ except (ImportError, AttributeError):
     pass
 
 
+class ConnectionPool(object):
+    """A thread-safe pool of connections, keyed by scheme:authority.
+
+    At most 'max_per_host' connections to a host are open at once, other
+    threads wait for one to be released. A thread already holding a
+    connection to the host, e.g. following a redirect, doesn't wait.
+    Connections idle for more than 'idle_timeout' seconds are closed
+    rather than reused.
+    """
+    def __init__(self, max_per_host=10, idle_timeout=60):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        # conn_key -> list of (release time, connection), oldest first.
+        self._idle = {}
+        # conn_key -> number of open connections, idle or in use.
+        self._open = {}
+        self._stats = {'created': 0, 'reused': 0, 'expired': 0, 'waits': 0}
+
+    def _held(self):
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def acquire(self, conn_key, connect):
+        """Returns a connection to conn_key, calling connect() to open a
+        new one when none is idle."""
+        held = self._held()
+        self._cond.acquire()
+        try:
+            while True:
+                idle = self._idle.get(conn_key)
+                now = time.time()
+                while idle and now - idle[0][0] > self.idle_timeout:
+                    idle.pop(0)[1].close()
+                    self._open[conn_key] -= 1
+                    self._stats['expired'] += 1
+                if idle:
+                    # the most recently used connection is the likeliest
+                    # to still be alive.
+                    conn = idle.pop()[1]
+                    self._stats['reused'] += 1
+                    held[conn_key] = held.get(conn_key, 0) + 1
+                    return conn
+                if (self._open.get(conn_key, 0) < self.max_per_host or
+                    held.get(conn_key)):
+                    self._open[conn_key] = self._open.get(conn_key, 0) + 1
+                    self._stats['created'] += 1
+                    break
+                self._stats['waits'] += 1
+                self._cond.wait()
+        finally:
+            self._cond.release()
+        try:
+            conn = connect()
+        except:
+            self._forget(conn_key)
+            raise
+        held[conn_key] = held.get(conn_key, 0) + 1
+        return conn
+
+    def release(self, conn_key, conn):
+        """Returns a connection acquired from the pool, to be reused."""
+        self._held()[conn_key] -= 1
+        self._cond.acquire()
+        try:
+            self._idle.setdefault(conn_key, []).append((time.time(), conn))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def discard(self, conn_key, conn):
+        """Closes a connection acquired from the pool, e.g. after an
+        error left it in an unknown state."""
+        self._held()[conn_key] -= 1
+        conn.close()
+        self._forget(conn_key)
+
+    def _forget(self, conn_key):
+        self._cond.acquire()
+        try:
+            self._open[conn_key] -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """Closes all idle connections."""
+        self._cond.acquire()
+        try:
+            for conn_key, idle in self._idle.items():
+                for _, conn in idle:
+                    conn.close()
+                self._open[conn_key] -= len(idle)
+            self._idle = {}
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def get_stats(self):
+        """Returns a dict of the connections 'created', 'reused', closed
+        after being idle too long ('expired'), the times a thread 'waits'
+        for a connection, and the 'open' and 'idle' connections now."""
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['open'] = sum(self._open.values())
+            stats['idle'] = sum([len(idle) for idle in self._idle.values()])
+        finally:
+            self._cond.release()
+        return stats
+
+
 class Http(object):
     """An HTTP client that handles:
 
@@ -1138,7 +1359,8 @@ class Http(object):
     """
     def __init__(self, cache=None, timeout=None,
                  proxy_info=proxy_info_from_environment,
-                 ca_certs=None, disable_ssl_certificate_validation=False):
+                 ca_certs=None, disable_ssl_certificate_validation=False,
+                 connection_pool=None):
         """If 'cache' is a string then it is used as a directory name for
         a disk cache. Otherwise it must be an object that supports the
         same interface as FileCache.
@@ -1161,14 +1383,22 @@ class Http(object):
 
         If disable_ssl_certificate_validation is true, SSL cert validation will
         not be performed.
+
+        `connection_pool` is a ConnectionPool, which can be shared by several
+        Http objects. By default, each Http object has its own pool. Only
+        connection reuse is safe across threads, each request takes its own
+        connection from the pool. The credentials and authorizations of an
+        Http object, and a FileCache, are not locked.
         """
         self.proxy_info = proxy_info
         self.ca_certs = ca_certs
         self.disable_ssl_certificate_validation = \
                 disable_ssl_certificate_validation
 
-        # Map domain name to an httplib connection
-        self.connections = {}
+        # Pool of httplib connections by scheme and authority.
+        if connection_pool is None:
+            connection_pool = ConnectionPool()
+        self.connection_pool = connection_pool
         # The location of the cache, for now a directory
         # where cached responses are held.
         if cache and isinstance(cache, basestring):
@@ -1211,13 +1441,13 @@ class Http(object):
         # credentials which handle auth
         if 'request' in state_dict:
             del state_dict['request']
-        if 'connections' in state_dict:
-            del state_dict['connections']
+        if 'connection_pool' in state_dict:
+            del state_dict['connection_pool']
         return state_dict
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        self.connections = {}
+        self.connection_pool = ConnectionPool()
 
     def _auth_from_challenge(self, host, request_uri, headers, response, content):
         """A generator that creates Authorization objects
@@ -1376,6 +1606,17 @@ class Http(object):
 
         return (response, content)
 
+    def _pooled_request(self, conn_key, connect, *args):
+        """Calls _request with a connection of the pool."""
+        conn = self.connection_pool.acquire(conn_key, connect)
+        try:
+            result = self._request(conn, *args)
+        except:
+            self.connection_pool.discard(conn_key, conn)
+            raise
+        self.connection_pool.release(conn_key, conn)
+        return result
+
     def _normalize_headers(self, headers):
         return _normalize_headers(headers)
 
@@ -1426,15 +1667,14 @@ class Http(object):
             proxy_info = self._get_proxy_info(scheme, authority)
 
             conn_key = scheme+":"+authority
-            if conn_key in self.connections:
-                conn = self.connections[conn_key]
-            else:
-                if not connection_type:
-                    connection_type = SCHEME_TO_CONNECTION[scheme]
-                certs = list(self.certificates.iter(authority))
+            if not connection_type:
+                connection_type = SCHEME_TO_CONNECTION[scheme]
+            certs = list(self.certificates.iter(authority))
+
+            def connect():
                 if scheme == 'https':
                     if certs:
-                        conn = self.connections[conn_key] = connection_type(
+                        conn = connection_type(
                                 authority, key_file=certs[0][0],
                                 cert_file=certs[0][1], timeout=self.timeout,
                                 proxy_info=proxy_info,
@@ -1442,17 +1682,18 @@ class Http(object):
                                 disable_ssl_certificate_validation=
                                         self.disable_ssl_certificate_validation)
                     else:
-                        conn = self.connections[conn_key] = connection_type(
+                        conn = connection_type(
                                 authority, timeout=self.timeout,
                                 proxy_info=proxy_info,
                                 ca_certs=self.ca_certs,
                                 disable_ssl_certificate_validation=
                                         self.disable_ssl_certificate_validation)
                 else:
-                    conn = self.connections[conn_key] = connection_type(
+                    conn = connection_type(
                             authority, timeout=self.timeout,
                             proxy_info=proxy_info)
                 conn.set_debuglevel(debuglevel)
+                return conn
 
             if 'range' not in headers and 'accept-encoding' not in headers:
                 headers['accept-encoding'] = 'gzip, deflate'
@@ -1537,7 +1778,7 @@ class Http(object):
                     elif entry_disposition == "TRANSPARENT":
                         pass
 
-                    (response, new_content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
+                    (response, new_content) = self._pooled_request(conn_key, connect, authority, uri, request_uri, method, body, headers, redirections, cachekey)
 
                 if response.status == 304 and method == "GET":
                     # Rewrite the cache entry with the new end-to-end headers
@@ -1567,7 +1808,7 @@ class Http(object):
                     response = Response(info)
                     content = ""
                 else:
-                    (response, content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
+                    (response, content) = self._pooled_request(conn_key, connect, authority, uri, request_uri, method, body, headers, redirections, cachekey)
         except Exception, e:
             if self.force_exception_to_status_code:
                 if isinstance(e, HttpLib2ErrorWithResponse):
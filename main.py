@@ -25,24 +25,24 @@ https://support.google.com/cloud/answer/4524336?hl=en
 
 """
 
+import calendar
+import collections
+import cStringIO
 from datetime import date, datetime, timedelta
+import gzip
+import hashlib
 import json
 import logging
 import re
 import sys
 import os
+import threading
+import time
 
-import jinja2
 import webapp2
-import gviz_api
-import httplib2
 import cloudstorage as gcs
 from cloudstorage import common as gcs_common
 from protorpc import messages
-from google.appengine.api import app_identity
-from google.appengine.ext import deferred
-from google.appengine.api import mail
-from google.appengine.api import users
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 
@@ -52,26 +52,82 @@ import config
 def UseLocalGCS():
     """Use the local GCS stub, great for testing locally.."""
     gcs_common.set_access_token(None)
+    gcs_common.set_access_token_maker(None)
 
 
 def UseRemoteGCS():
-    """Use remote GCS via a signed certificate."""
+    """Use remote GCS via a signed certificate.
+
+    Tokens are only made on first use of GCS, see MakeRemoteGCSTokenAsync.
+    """
     logging.debug('Using remote gcs.')
-    try:
-        from oauth2client.client import SignedJwtAssertionCredentials
-    except ImportError:
-        logging.error('For local testing with remote GCS, install pycrypto.')
-        return
-    http_object = httplib2.Http(timeout=60)
-    service_account = config.service_account
-    private_key_pem_file = config.private_key_pem_file
-    scope = 'https://www.googleapis.com/auth/devstorage.full_control'
-    private_key = file(private_key_pem_file, 'rb').read()
-    certificate = SignedJwtAssertionCredentials(service_account,
-                                                private_key,
-                                                scope)
-    certificate.refresh(http_object)
-    gcs_common.set_access_token(certificate.access_token)
+    gcs_common.set_access_token(None)
+    gcs_common.set_access_token_maker(MakeRemoteGCSTokenAsync)
+
+
+# The service account credentials of remote GCS by scopes, shared by all
+# threads, see GetRemoteGCSCredentials.
+_remote_gcs_credentials = {}
+_remote_gcs_credentials_lock = threading.Lock()
+
+
+def GetRemoteGCSCredentials(scopes):
+    """Returns the credentials of the service account in config for scopes.
+
+    The credentials of each scopes are made once, the first thread to need
+    them signs for all.
+
+    Args:
+      scopes: a list of scopes of the credentials.
+    """
+    key = tuple(scopes)
+    with _remote_gcs_credentials_lock:
+        if key not in _remote_gcs_credentials:
+            try:
+                from oauth2client.client import SignedJwtAssertionCredentials
+            except ImportError:
+                logging.error(
+                    'For local testing with remote GCS, install pycrypto.')
+                raise
+            private_key = file(config.private_key_pem_file, 'rb').read()
+            _remote_gcs_credentials[key] = SignedJwtAssertionCredentials(
+                config.service_account, private_key, list(scopes))
+        return _remote_gcs_credentials[key]
+
+
+@ndb.tasklet
+def MakeRemoteGCSTokenAsync(scopes, service_account_id):
+    """Make a token of the service account in config for remote GCS.
+
+    The cloudstorage library caches the token in process and in memcache,
+    and renews it in the background before it expires. The signed assertion
+    is posted with ndb's async urlfetch, so a renewal doesn't block the
+    request that triggered it. The token is also saved in the datastore,
+    which the dev appserver keeps on disk, so restarts reuse it, see
+    UseBillingRetryParams.
+
+    Args:
+      scopes: a list of scopes of the token.
+      service_account_id: unused, the account is config.service_account.
+    Returns:
+      A tuple (token, expiration_time) where expiration_time is seconds
+      since the epoch.
+    Raises:
+      AccessTokenRefreshError: when no token was granted.
+    """
+    from oauth2client.client import AccessTokenRefreshError
+    credentials = GetRemoteGCSCredentials(scopes)
+    response = yield ndb.get_context().urlfetch(
+        credentials.token_uri, method='POST',
+        payload=credentials._generate_refresh_request_body(),
+        headers=credentials._generate_refresh_request_headers(),
+        deadline=60)
+    if response.status_code != 200:
+        raise AccessTokenRefreshError('Invalid response %s: %s' % (
+            response.status_code, response.content))
+    token_response = json.loads(response.content)
+    raise ndb.Return((token_response['access_token'],
+                      time.time() + int(token_response['expires_in'])))
 
 
 # Do convolutions to speak to remote cloud storage even when on a local
@@ -85,22 +141,52 @@ if config.use_remote_gcs_when_local:
 
 # Bucket containing billing export data.
 BUCKET = config.bucket
-# Email template.
-TEMPLATE_ENV = jinja2.Environment(loader=jinja2.FileSystemLoader('.'),
-                                  autoescape=True)
-EMAIL_TEMPLATE = TEMPLATE_ENV.get_template('project_email.html')
+# Names to split the listing of the whole bucket at, the parts are listed
+# concurrently. Project ids start with a lowercase letter, spreading the parts.
+BUCKET_PARTITIONS = [BUCKET + '/' + letter for letter in 'dhlpt']
+# Retries of GCS requests shared by all the reads of one request, and the
+# percentile of recent read latencies after which a read is hedged, see
+# UseBillingRetryParams.
+GCS_RETRY_BUDGET = 20
+GCS_HEDGE_PERCENTILE = 95
+# Decimal places of charges in compact chart data, see GetChartData.
+COMPACT_CHART_PRECISION = 6
+# Content type and file extension of the export formats of GetChartData.
+EXPORT_FORMATS = {'csv': ('text/csv; charset=utf-8', 'csv'),
+                  'tsv-excel': ('text/tab-separated-values; charset=utf-16le',
+                                'tsv')}
+# Export objects whose reads are in flight at once, see OpenBillingObjects.
+EXPORT_READ_AHEAD = 20
+# Limits of an export, see WriteBillingExport: the total size of the export
+# objects read for it, and the size of the export, which is buffered in the
+# response like any response of App Engine and must fit in its 32MB limit.
+MAX_EXPORT_READ_BYTES = 256 * 1024 * 1024
+MAX_EXPORT_BYTES = 32 * 1024 * 1024 - 64 * 1024
+# Email template, compiled on first use, see GetEmailTemplate.
+EMAIL_TEMPLATE_NAME = 'project_email.html'
+# Memcache key prefix of compiled templates, see CreateTemplateEnvironment.
+TEMPLATE_BYTECODE_PREFIX = 'jinja2/bytecode/'
+_email_template = None
 
 
 class ChartData(ndb.Model):
 
     """Cache the resulting TableData object parsed from the json files."""
     data_table = ndb.PickleProperty()
+    # gzipped compact json of data_table, served by GetChartData.
+    compact_json_gz = ndb.BlobProperty()
+    # when the cache was built, the version of the data.
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 
 class Projects(ndb.Model):
 
     """Cache a list of all project exports in the bucket."""
     projects = ndb.PickleProperty()
+    # gzipped json of projects, served by GetProjectList.
+    projects_json_gz = ndb.BlobProperty()
+    # when the cache was built, the version of the data.
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 
 class AlertTrigger(messages.Enum):
@@ -249,17 +335,105 @@ def MatchProjectDate(object_name):
     return None, None
 
 
-def GetBillingProjects():
-    """return a list of all projects we have billing export informaiton for."""
+def GzipString(value):
+    """Returns the gzip compressed value."""
+    gzip_buffer = cStringIO.StringIO()
+    gzip_file = gzip.GzipFile(fileobj=gzip_buffer, mode='wb', mtime=0)
+    gzip_file.write(value)
+    gzip_file.close()
+    return gzip_buffer.getvalue()
+
+
+def GunzipString(value):
+    """Returns the decompressed gzip value."""
+    return gzip.GzipFile(fileobj=cStringIO.StringIO(value)).read()
+
+
+def DataVersion(updated):
+    """Returns a string identifying the cache built at the updated datetime."""
+    return '%d%06d' % (calendar.timegm(updated.utctimetuple()),
+                       updated.microsecond)
+
+
+def IsNotModified(handler, updated, etag):
+    """Handles conditional requests for cached data.
+
+    Sets the ETag and Last-Modified headers of the response, and its 304 status
+    when the client already has the current version.
+
+    Args:
+      handler: the webapp2.RequestHandler responding.
+      updated: datetime the cached data was built.
+      etag: quoted entity tag of the response body.
+    Returns:
+      True if the client copy is current and no body should be written.
+    """
+    last_modified = calendar.timegm(updated.utctimetuple())
+    handler.response.headers['ETag'] = etag
+    handler.response.headers['Last-Modified'] = \
+        gcs_common.posix_time_to_http(last_modified)
+    handler.response.headers['Vary'] = 'Accept-Encoding'
+    not_modified = False
+    if_none_match = handler.request.headers.get('If-None-Match')
+    if_modified_since = handler.request.headers.get('If-Modified-Since')
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is present.
+        client_etags = [client_etag.strip().replace('W/', '', 1)
+                        for client_etag in if_none_match.split(',')]
+        not_modified = '*' in client_etags or etag in client_etags
+    elif if_modified_since is not None:
+        try:
+            not_modified = (gcs_common.http_time_to_posix(if_modified_since)
+                            >= last_modified)
+        except TypeError:
+            logging.debug('invalid If-Modified-Since: ' + if_modified_since)
+    if not_modified:
+        handler.response.set_status(304)
+    return not_modified
+
+
+def WriteCachedResponse(handler, updated, name, body_gz, content_type):
+    """Writes a body compressed when the cache was built.
+
+    The body is sent compressed if the client accepts gzip, and not at all if
+    the client already has it.
+
+    Args:
+      handler: the webapp2.RequestHandler responding.
+      updated: datetime the cached data was built.
+      name: distinguishes the etag of different bodies of the same cache.
+      body_gz: the gzipped body.
+      content_type: the content type of the body.
+    """
+    # webob accepts any encoding when there is no Accept-Encoding header.
+    gzipped = ('Accept-Encoding' in handler.request.headers and
+               'gzip' in handler.request.accept_encoding)
+    etag = '"%s-%s%s"' % (name, DataVersion(updated),
+                          '-gzip' if gzipped else '')
+    if IsNotModified(handler, updated, etag):
+        return
+    handler.response.content_type = content_type
+    if gzipped:
+        handler.response.headers['Content-Encoding'] = 'gzip'
+        handler.response.write(body_gz)
+    else:
+        handler.response.write(GunzipString(body_gz))
+
+
+def GetBillingProjectsCache():
+    """Returns the Projects entity caching the list of all projects."""
     projects = Projects.get_by_id('Projects')
-    if projects is not None:
+    if projects is not None and projects.projects_json_gz is not None:
         logging.debug('using cached projects')
-        return projects.projects
+        return projects
+    UseBillingRetryParams()
     project_list = []
     current_project = None
-    for billing_object in gcs.listbucket(BUCKET,
-                                         delimiter='/'):
-        project_match = MatchProjectDate(billing_object.filename)
+    for object_name in gcs.listbucket(BUCKET,
+                                      delimiter='/',
+                                      partitions=BUCKET_PARTITIONS,
+                                      names_only=True):
+        project_match = MatchProjectDate(object_name)
         if not project_match:
             continue
         project_name = project_match[0]
@@ -268,8 +442,14 @@ def GetBillingProjects():
             current_project = project_name
     projects = Projects(id='Projects')
     projects.projects = project_list
+    projects.projects_json_gz = GzipString(json.dumps(project_list))
     projects.put()
-    return project_list
+    return projects
+
+
+def GetBillingProjects():
+    """return a list of all projects we have billing export informaiton for."""
+    return GetBillingProjectsCache().projects
 
 
 class DataTableData(object):
@@ -294,6 +474,53 @@ class DataTableData(object):
         return target_amount
 
 
+def UseBillingRetryParams():
+    """Use jittered, budgeted retries and hedged reads for GCS requests.
+
+    Many export objects are read per request, so retries share a budget
+    and the few slow reads are hedged rather than waited on. Remote GCS
+    tokens are saved in the datastore to outlive the dev appserver.
+    """
+    gcs.set_default_retry_params(
+        gcs.RetryParams(jitter=True, retry_budget=GCS_RETRY_BUDGET,
+                        hedge_percentile=GCS_HEDGE_PERCENTILE,
+                        save_access_token=(
+                            gcs_common.get_access_token_maker() is not None)))
+
+
+def ReadBillingObject(billing_object, line_items, date_hash):
+    """Parse a billing export json file from cloud storage.
+
+    Args:
+      billing_object: GCSFileStat of the export object to read, as listed
+      by gcs.listbucket, its size and etag save a request to open it.
+      line_items: a list of sku names, new skus are appended to it.
+      date_hash: a map of end time datetime objects to a list of charges for
+      each line_item, the charges of the object are added to it.
+    """
+    billing_file = gcs.open(billing_object.filename,
+                            file_stat=billing_object, whole_object=True)
+    ParseBillingFile(billing_file, line_items, date_hash)
+
+
+def ParseBillingFile(billing_file, line_items, date_hash):
+    """Parse an opened billing export json file, see ReadBillingObject."""
+    biling_data = json.loads(billing_file.read())
+    for item in biling_data:
+        end_time = datetime.strptime(
+            item['endTime'][:-6], '%Y-%m-%dT%H:%M:%S')
+        line_item = GetCanonicalLineItem(item['lineItemId'])
+        if line_item not in line_items:
+            line_items.append(line_item)
+        row = date_hash.get(end_time, [])
+        date_hash[end_time] = row
+        coli = line_items.index(line_item)
+        for _ in range(len(row), coli + 1):
+            row.append(None)
+        row[coli] = float(item['cost']['amount'])
+    billing_file.close()
+
+
 def GetDataTableData(project_name, table_date=None):
     """Read json files from cloud storage for project and an optional date.
 
@@ -304,6 +531,7 @@ def GetDataTableData(project_name, table_date=None):
     Returns:
       A DataTableData object of all the parsed data with product totals.
     """
+    UseBillingRetryParams()
     line_items = []
     date_hash = dict()
     object_prefix = os.path.join(BUCKET, project_name)
@@ -320,22 +548,9 @@ def GetDataTableData(project_name, table_date=None):
     for billing_object in gcs.listbucket(object_prefix,
                                          marker=object_marker,
                                          delimiter='/'):
-        billing_file = gcs.open(billing_object.filename)
-        biling_data = json.loads(billing_file.read())
-        for item in biling_data:
-            end_time = datetime.strptime(
-                item['endTime'][:-6], '%Y-%m-%dT%H:%M:%S')
-            line_item = GetCanonicalLineItem(item['lineItemId'])
-            if line_item not in line_items:
-                line_items.append(line_item)
-            row = date_hash.get(end_time, [])
-            date_hash[end_time] = row
-            coli = line_items.index(line_item)
-            for _ in range(len(row), coli + 1):
-                row.append(None)
-            row[coli] = float(item['cost']['amount'])
-        billing_file.close()
+        ReadBillingObject(billing_object, line_items, date_hash)
 
+    logging.debug('gcs retry stats: %r', gcs.get_retry_stats())
     # Add product totals to the parsed sku amounts.
     AddCloudProductSums(line_items, date_hash)
     data_table_data = [[bill_date] + row for bill_date, row in
@@ -343,34 +558,178 @@ def GetDataTableData(project_name, table_date=None):
     return DataTableData(data_table_data, line_items)
 
 
-def GetAllBillingDataTable(project_name):
-    """Returns gviz_api.DataTable containing last 90 days of data.
+def ListBillingObjects(project_name, start_date, end_date):
+    """Returns stats of the project's export objects between two dates.
+
+    Args:
+      project_name: name of the project to list objects of.
+      start_date: date of the first object to list.
+      end_date: date of the last object to list.
+    Returns:
+      A list of GCSFileStat objects, in date order.
+    """
+    object_prefix = os.path.join(BUCKET, project_name)
+    # start listing after the object of the day before start_date.
+    object_marker = object_prefix + \
+        (start_date + timedelta(-1)).strftime('-%Y-%m-%d.json')
+    billing_objects = []
+    for billing_object in gcs.listbucket(object_prefix,
+                                         marker=object_marker,
+                                         delimiter='/'):
+        object_project, object_date = MatchProjectDate(
+            billing_object.filename)
+        # skip projects sharing the prefix, like <project_name>-staging.
+        if object_project != project_name:
+            continue
+        if object_date > end_date:
+            break
+        billing_objects.append(billing_object)
+    return billing_objects
+
+
+class ExportTooLargeError(Exception):
+    """The export of a date range would exceed its limits."""
+
+
+class LimitedWriter(object):
+    """Writes to a file-like object up to a number of bytes."""
+
+    def __init__(self, out, max_bytes):
+        self.out = out
+        self.max_bytes = max_bytes
+        self.written = 0
+
+    def write(self, data):
+        """Writes data, raises ExportTooLargeError past max_bytes."""
+        self.written += len(data)
+        if self.written > self.max_bytes:
+            raise ExportTooLargeError(
+                'the export is larger than %d bytes, export a shorter date '
+                'range' % self.max_bytes)
+        self.out.write(data)
+
+
+def OpenBillingObjects(billing_objects):
+    """Yields the export objects opened, while the next ones are being read.
+
+    Opening an object with its stat and a read buffer as large as the object
+    starts fetching all of it, so the reads of up to EXPORT_READ_AHEAD objects
+    are in flight at once rather than one after the other.
+
+    Args:
+      billing_objects: GCSFileStat of the export objects to read.
+    Yields:
+      The opened objects, in the order of billing_objects.
+    """
+    opened = collections.deque()
+    for billing_object in billing_objects:
+        buffer_size = min(max(long(billing_object.st_size), 1),
+                          gcs.ReadBuffer.MAX_REQUEST_SIZE)
+        opened.append(gcs.open(billing_object.filename,
+                               file_stat=billing_object,
+                               read_buffer_size=buffer_size))
+        if len(opened) >= EXPORT_READ_AHEAD:
+            yield opened.popleft()
+    while opened:
+        yield opened.popleft()
+
+
+def WriteBillingExport(out, project_name, start_date, end_date, out_format):
+    """Write billing data between two dates as CSV or TSV.
+
+    Each export object is read once, many at a time, see OpenBillingObjects.
+    The charges of the whole date range are held until they are written, and
+    as webapp2 buffers responses so is the whole export, which must fit in
+    the 32MB response size limit.
+
+    Raises:
+      ExportTooLargeError: the export objects of the date range are larger
+      than MAX_EXPORT_READ_BYTES, checked before any is read, or the export
+      is larger than MAX_EXPORT_BYTES. Part of the export may have been
+      written to out.
+
+    Args:
+      out: file-like object to write to, like a webapp2 response.
+      project_name: name of the project to export data of.
+      start_date: date of the first day to export.
+      end_date: date of the last day to export.
+      out_format: 'csv' or 'tsv-excel', see gviz_api.DataTable.ToResponse.
+    """
+    UseBillingRetryParams()
+    billing_objects = ListBillingObjects(project_name, start_date, end_date)
+    read_bytes = sum(long(billing_object.st_size)
+                     for billing_object in billing_objects)
+    if read_bytes > MAX_EXPORT_READ_BYTES:
+        raise ExportTooLargeError(
+            'the billing data of the date range is %d bytes, more than the '
+            '%d bytes an export can read, export a shorter date range' %
+            (read_bytes, MAX_EXPORT_READ_BYTES))
+    line_items = []
+    date_hash = dict()
+    for billing_file in OpenBillingObjects(billing_objects):
+        ParseBillingFile(billing_file, line_items, date_hash)
+    AddCloudProductSums(line_items, date_hash)
+    rows = [[bill_date] + row for bill_date, row in date_hash.iteritems()]
+    data_table = CreateDataTable(DataTableData(rows, line_items))
+    columns_order = ['Time'] + line_items
+    out = LimitedWriter(out, MAX_EXPORT_BYTES)
+    if out_format == 'csv':
+        data_table.WriteCsv(out, columns_order, order_by='Time')
+    else:
+        data_table.WriteTsvExcel(out, columns_order, order_by='Time')
+
+
+def CreateDataTable(data_table_data):
+    """Returns a gviz_api.DataTable loaded with the supplied DataTableData."""
+    import gviz_api
+    data_table = gviz_api.DataTable([('Time', 'datetime', 'Time')] +
+                                    [(li, 'number', li.split('/')[1])
+                                     for li in data_table_data.columns])
+    data_table.LoadData(data_table_data.rows)
+    return data_table
+
+
+def GetChartDataCache(project_name):
+    """Returns the ChartData entity of the last 90 days of data.
     Will try to use datastore/memcached data if available.
 
     Args:
       project_name: string name of the project
     Returns:
-      A gviz_api.DataTable instance.
+      A ChartData instance.
     """
     # first example datastore cache.
     cached_data_table = ChartData.get_by_id(project_name)
-    if cached_data_table is not None:
-        return cached_data_table.data_table
+    if (cached_data_table is not None and
+            cached_data_table.compact_json_gz is not None):
+        return cached_data_table
 
     # read billing data from cloud storage
     data_table_data = GetDataTableData(project_name)
 
     # create gviz data table from data
-    data_table = gviz_api.DataTable([('Time', 'datetime', 'Time')] +
-                                    [(li, 'number', li.split('/')[1])
-                                     for li in data_table_data.columns])
-    data_table.LoadData(data_table_data.rows)
+    data_table = CreateDataTable(data_table_data)
     # create the ChartData entity to be cached in memcache and datatore
     cached_data_table = ChartData(id=project_name)
     # persist the DataTable object to it.
     cached_data_table.data_table = data_table
+    # compress the compact json once rather then on each request.
+    cached_data_table.compact_json_gz = GzipString(
+        data_table.ToCompactJSon(order_by='Time',
+                                 precision=COMPACT_CHART_PRECISION))
     cached_data_table.put()
-    return data_table
+    return cached_data_table
+
+
+def GetAllBillingDataTable(project_name):
+    """Returns gviz_api.DataTable containing last 90 days of data.
+
+    Args:
+      project_name: string name of the project
+    Returns:
+      A gviz_api.DataTable instance.
+    """
+    return GetChartDataCache(project_name).data_table
 
 
 class GetChartData(webapp2.RequestHandler):
@@ -378,18 +737,117 @@ class GetChartData(webapp2.RequestHandler):
     """Returns json parsable by Google Visualization javascript library."""
 
     def get(self):
-        """Calls GetAllBillingDataTable.
+        """Calls GetChartDataCache.
         Returns: response in a format acceptible to google javascript
         visualization
-        library.
+        library, or when the 'out:compact' tqx option is supplied, the
+        compact json decoded by decodeCompactDataTable in chart.js. The number
+        of decimal places of compact charges can be set with the 'precision'
+        parameter.
+
+        The 'out:csv' and 'out:tsv-excel' tqx options export the data from
+        the 'start' to the 'end' YYYY-MM-DD date parameters instead of the
+        last 90 days, see WriteExport.
         """
-        data_table = GetAllBillingDataTable(self.request.get('project'))
-        tqx = self.request.get('tqx')
-        req_id = int(tqx[tqx.find('reqId'):].split(':')[1])
-        json_response = data_table.ToJSonResponse(req_id=req_id,
-                                                  columns_order=None,
-                                                  order_by='Time')
-        self.response.write(json_response)
+        try:
+            tqx_dict = self.GetTqxOptions()
+        except ValueError:
+            self.abort(400, 'tqx options must be name:value pairs')
+        if tqx_dict.get('out') in EXPORT_FORMATS:
+            self.WriteExport(tqx_dict['out'])
+            return
+        try:
+            precision = int(self.request.get('precision',
+                                             COMPACT_CHART_PRECISION))
+            req_id = int(tqx_dict.get('reqId', 0))
+        except ValueError:
+            self.abort(400, 'precision and reqId must be integers')
+        chart_data = GetChartDataCache(self.request.get('project'))
+        if tqx_dict.get('out') == 'compact':
+            if precision == COMPACT_CHART_PRECISION:
+                WriteCachedResponse(self, chart_data.updated, 'compact',
+                                    chart_data.compact_json_gz,
+                                    'application/json')
+                return
+        # other responses depend on the request parameters. The reqId the
+        # visualization library changes with every query is only part of the
+        # json response, the compact response doesn't depend on it.
+        parameters = sorted((name, value)
+                            for name, value in self.request.GET.items()
+                            if name != 'tqx')
+        parameters += sorted((name, value)
+                             for name, value in tqx_dict.items()
+                             if name != 'reqId' or
+                             tqx_dict.get('out') != 'compact')
+        etag = '"%s-%s"' % (DataVersion(chart_data.updated),
+                            hashlib.md5(json.dumps(parameters)).hexdigest())
+        if IsNotModified(self, chart_data.updated, etag):
+            return
+        # only unpickle the data table when the response is built from it.
+        data_table = chart_data.data_table
+        if tqx_dict.get('out') == 'compact':
+            self.response.content_type = 'application/json'
+            data_table.WriteCompactJSon(self.response,
+                                        order_by='Time',
+                                        precision=precision)
+            return
+        # stream the response rather then building the whole json string.
+        data_table.WriteJSonResponse(self.response,
+                                     req_id=req_id,
+                                     columns_order=None,
+                                     order_by='Time')
+
+    def WriteExport(self, out_format):
+        """Writes an export of the uncached billing data of any date range.
+
+        Defaults to the last 90 days. The whole export is built before it is
+        sent, exports over the limits of WriteBillingExport are refused with
+        a 413.
+
+        Args:
+          out_format: a key of EXPORT_FORMATS.
+        """
+        project_name = self.request.get('project')
+        try:
+            end_date = self.GetDateParameter('end', date.today())
+            start_date = self.GetDateParameter('start',
+                                               end_date + timedelta(-90))
+        except ValueError:
+            self.abort(400, 'start and end dates must be YYYY-MM-DD')
+        content_type, extension = EXPORT_FORMATS[out_format]
+        self.response.content_type = content_type
+        self.response.headers['Content-Disposition'] = str(
+            'attachment; filename=%s-%s-%s.%s' % (
+                project_name, start_date.isoformat(), end_date.isoformat(),
+                extension))
+        try:
+            WriteBillingExport(self.response, project_name, start_date,
+                               end_date, out_format)
+        except ExportTooLargeError as e:
+            self.abort(413, str(e))
+
+    def GetTqxOptions(self):
+        """Returns the name:value options of the tqx parameter as a dict.
+
+        Raises:
+          ValueError: an option is not a name:value pair.
+        """
+        tqx_dict = {}
+        for option in self.request.get('tqx').split(';'):
+            if not option:
+                continue
+            name, separator, value = option.partition(':')
+            if not separator:
+                raise ValueError('invalid tqx option: ' + option)
+            tqx_dict[name] = value
+        return tqx_dict
+
+    def GetDateParameter(self, name, default):
+        """Returns the YYYY-MM-DD date parameter or default if it's not set."""
+        value = self.request.get(name)
+        if not value:
+            return default
+        return datetime.strptime(value, '%Y-%m-%d').date()
 
 
 def FlushAllCaches():
@@ -402,6 +860,7 @@ def FlushAllCaches():
 
 def PopulateCaches():
     """Loads all data into caches for faster initial page renders."""
+    from google.appengine.ext import deferred
     billing_projects = GetBillingProjects()
     for project in billing_projects:
         deferred.defer(GetAllBillingDataTable, project)
@@ -421,6 +880,7 @@ class GetProfileInformation(webapp2.RequestHandler):
 
     def get(self):
         """Returns logged in user information."""
+        from google.appengine.api import users
         user = users.get_current_user()
         profile_information = {'email': user.email(),
                                'logoutUrl': users.create_logout_url('/')}
@@ -500,9 +960,10 @@ class GetAlertList(webapp2.RequestHandler):
 class GetProjectList(webapp2.RequestHandler):
 
     def get(self):
-        """Returns logged in user information."""
-        project_list = GetBillingProjects()
-        self.response.out.write(json.dumps(project_list))
+        """Returns the list of projects."""
+        projects = GetBillingProjectsCache()
+        WriteCachedResponse(self, projects.updated, 'projects',
+                            projects.projects_json_gz, 'application/json')
 
 
 class Subscription(ndb.Model):
@@ -544,9 +1005,43 @@ class EditSubscription(webapp2.RequestHandler):
         self.response.write(json.dumps(subscription.to_dict()))
 
 
+def CreateTemplateEnvironment(bytecode_cache=True):
+    """Returns a jinja2 environment loading templates from the app directory.
+
+    Args:
+      bytecode_cache: whether to share compiled templates across instances in
+      memcache. The bytecode is keyed by a checksum of the template source,
+      so a deploy with a changed template compiles it again.
+    """
+    import jinja2
+    from google.appengine.api import memcache
+    cache = None
+    if bytecode_cache:
+        cache = jinja2.MemcachedBytecodeCache(memcache,
+                                              prefix=TEMPLATE_BYTECODE_PREFIX)
+    return jinja2.Environment(loader=jinja2.FileSystemLoader('.'),
+                              autoescape=True, bytecode_cache=cache)
+
+
+def GetEmailTemplate():
+    """Returns the email template, compiling it on first use.
+
+    Only the notification handler sends emails, other requests don't pay
+    for importing jinja2 and compiling the template. New instances load it
+    from the bytecode cache rather than compiling it.
+    """
+    global _email_template
+    if _email_template is None:
+        _email_template = CreateTemplateEnvironment().get_template(
+            EMAIL_TEMPLATE_NAME)
+    return _email_template
+
+
 def SendEmail(context, recipients):
     """Send alert/daily summary email."""
-    emailbody = EMAIL_TEMPLATE.render(context)
+    from google.appengine.api import app_identity
+    from google.appengine.api import mail
+    emailbody = GetEmailTemplate().render(context)
 
     if not recipients:
         logging.info('no recipients for email, using configured default: ' +
@@ -679,9 +1174,22 @@ class ObjectChangeNotification(webapp2.RequestHandler):
         # Clear caches so project data is reread.
         FlushAllCaches()
         # Refresh project list and project data in a new task queue.
+        from google.appengine.ext import deferred
         deferred.defer(PopulateCaches)
 
 
+class Warmup(webapp2.RequestHandler):
+
+    """Prepare a new instance before it serves user requests."""
+
+    def get(self):
+        """Imports the modules and fills the caches most requests need."""
+        # cached chart data unpickles to gviz_api.DataTable objects.
+        import gviz_api
+        # the projects listing also gets a GCS token into the token cache.
+        GetBillingProjectsCache()
+
+
 app = webapp2.WSGIApplication(
     [('/chart', GetChartData),
      ('/projectList', GetProjectList),
@@ -694,5 +1202,6 @@ app = webapp2.WSGIApplication(
      ('/flushCache', FlushCache),
      ('/getSubscription', GetSubscription),
      ('/editSubscription', EditSubscription),
-     ('/objectChangeNofication', ObjectChangeNotification)],
+     ('/objectChangeNofication', ObjectChangeNotification),
+     ('/_ah/warmup', Warmup)],
     debug=True)
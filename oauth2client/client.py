@@ -23,10 +23,14 @@ import base64
 import clientsecrets
 import copy
 import datetime
+import httplib
 import httplib2
 import logging
 import os
+import re
+import socket
 import sys
+import threading
 import time
 import urllib
 import urlparse
@@ -66,6 +70,10 @@ OOB_CALLBACK_URN = 'urn:ietf:wg:oauth:2.0:oob'
 # Google Data client libraries may need to set this to [401, 403].
 REFRESH_STATUS_CODES = [401]
 
+# Seconds before the access_token expires when requests start refreshing it,
+# see OAuth2Credentials.authorize.
+REFRESH_AHEAD_SECS = 300
+
 
 class Error(Exception):
   """Base error for this module."""
@@ -129,7 +137,7 @@ class Credentials(object):
   string as input and returns an instaniated Credentials object.
   """
 
-  NON_SERIALIZED_MEMBERS = ['store']
+  NON_SERIALIZED_MEMBERS = ['store', '_refresh_lock']
 
   def authorize(self, http):
     """Take an httplib2.Http instance (or equivalent) and authorizes it.
@@ -436,12 +444,17 @@ class OAuth2Credentials(Credentials):
     # refreshed.
     self.invalid = False
 
+    # Held while refreshing the access_token, see _refresh_unless_updated.
+    self._refresh_lock = threading.Lock()
+
   def authorize(self, http):
     """Authorize an httplib2.Http instance with these credentials.
 
     The modified http.request method will add authentication headers to each
     request and will refresh access_tokens when a 401 is received on a
-    request. In addition the http.request method has a credentials property,
+    request, or ahead of their expiry, see REFRESH_AHEAD_SECS. Threads
+    needing a refresh at the same time wait for a single refresh request.
+    In addition the http.request method has a credentials property,
     http.request.credentials, which is the Credentials object that authorized
     it.
 
@@ -472,7 +485,9 @@ class OAuth2Credentials(Credentials):
                     connection_type=None):
       if not self.access_token:
         logger.info('Attempting refresh to obtain initial access_token')
-        self._refresh(request_orig)
+        self._refresh_unless_updated(request_orig, self.access_token)
+      elif self._access_token_expires_soon():
+        self._refresh_ahead(request_orig)
 
       # Modify the request headers to add the appropriate
       # Authorization header.
@@ -486,12 +501,14 @@ class OAuth2Credentials(Credentials):
         else:
           headers['user-agent'] = self.user_agent
 
+      # the token actually sent, another thread may have refreshed it since.
+      access_token = headers['Authorization'].split(' ', 1)[-1]
       resp, content = request_orig(uri, method, body, clean_headers(headers),
                                    redirections, connection_type)
 
       if resp.status in REFRESH_STATUS_CODES:
         logger.info('Refreshing due to a %s' % str(resp.status))
-        self._refresh(request_orig)
+        self._refresh_unless_updated(request_orig, access_token)
         self.apply(headers)
         return request_orig(uri, method, body, clean_headers(headers),
                             redirections, connection_type)
@@ -513,7 +530,7 @@ class OAuth2Credentials(Credentials):
       http: httplib2.Http, an http object to be used to make the refresh
         request.
     """
-    self._refresh(http.request)
+    self._refresh_unless_updated(http.request, self.access_token)
 
   def revoke(self, http):
     """Revokes a refresh_token and makes the credentials void.
@@ -607,12 +624,14 @@ class OAuth2Credentials(Credentials):
     """Trim the state down to something that can be pickled."""
     d = copy.copy(self.__dict__)
     del d['store']
+    d.pop('_refresh_lock', None)
     return d
 
   def __setstate__(self, state):
     """Reconstitute the state of the object from being pickled."""
     self.__dict__.update(state)
     self.store = None
+    self._refresh_lock = threading.Lock()
 
   def _generate_refresh_request_body(self):
     """Generate the body that will be used in the refresh request."""
@@ -635,6 +654,61 @@ class OAuth2Credentials(Credentials):
 
     return headers
 
+  def _access_token_expires_soon(self):
+    """True if the access_token expires within REFRESH_AHEAD_SECS."""
+    if not self.token_expiry:
+      return False
+    refresh_at = self.token_expiry - datetime.timedelta(
+        seconds=REFRESH_AHEAD_SECS)
+    return datetime.datetime.utcnow() >= refresh_at
+
+  def _refresh_unless_updated(self, http_request, access_token):
+    """Refreshes the access_token, unless it changed from access_token.
+
+    Concurrent callers seeing the same stale access_token wait for the
+    first one's refresh, rather than each making a refresh request.
+
+    Args:
+      http_request: callable, a callable that matches the method signature of
+        httplib2.Http.request, used to make the refresh request.
+      access_token: string, the access_token found stale.
+
+    Raises:
+      AccessTokenRefreshError: When the refresh fails.
+    """
+    self._refresh_lock.acquire()
+    try:
+      if self.access_token == access_token:
+        self._refresh(http_request)
+    finally:
+      self._refresh_lock.release()
+
+  def _refresh_ahead(self, http_request):
+    """Refreshes an access_token that expires soon, without waiting.
+
+    Only one thread refreshes, the others keep using the current
+    access_token meanwhile, or wait when it has expired.
+
+    Args:
+      http_request: callable, a callable that matches the method signature of
+        httplib2.Http.request, used to make the refresh request.
+    """
+    if self.access_token_expired:
+      self._refresh_unless_updated(http_request, self.access_token)
+      return
+    if not self._refresh_lock.acquire(False):
+      return
+    try:
+      if self._access_token_expires_soon():
+        logger.info('Refreshing access_token ahead of its expiry')
+        self._refresh(http_request)
+    except (AccessTokenRefreshError, AccessTokenCredentialsError,
+            httplib2.HttpLib2Error, httplib.HTTPException, socket.error), e:
+      # the current access_token is still valid, a 401 retries the refresh.
+      logger.info('Failed to refresh access_token ahead: %s', e)
+    finally:
+      self._refresh_lock.release()
+
   def _refresh(self, http_request):
     """Refreshes the access_token.
 
@@ -942,6 +1016,22 @@ if HAS_CRYPTO:
       self.private_key_password = private_key_password
       self.service_account_name = service_account_name
       self.kwargs = kwargs
+      # The parsed private key, see _get_signer.
+      self._signer = None
+
+    def to_json(self):
+      return self._to_json(Credentials.NON_SERIALIZED_MEMBERS + ['_signer'])
+
+    def __getstate__(self):
+      """Trim the state down to something that can be pickled."""
+      d = super(SignedJwtAssertionCredentials, self).__getstate__()
+      d.pop('_signer', None)
+      return d
+
+    def __setstate__(self, state):
+      """Reconstitute the state of the object from being pickled."""
+      super(SignedJwtAssertionCredentials, self).__setstate__(state)
+      self._signer = None
 
     @classmethod
     def from_json(cls, s):
@@ -972,13 +1062,49 @@ if HAS_CRYPTO:
       payload.update(self.kwargs)
       logger.debug(str(payload))
 
-      private_key = base64.b64decode(self.private_key)
-      return crypt.make_signed_jwt(crypt.Signer.from_string(
-          private_key, self.private_key_password), payload)
+      return crypt.make_signed_jwt(self._get_signer(), payload)
+
+    def _get_signer(self):
+      """Returns the Signer of the private key, parsing the key only once."""
+      if self._signer is None:
+        self._signer = crypt.Signer.from_string(
+            base64.b64decode(self.private_key), self.private_key_password)
+      return self._signer
 
   # Only used in verify_id_token(), which is always calling to the same URI
-  # for the certs.
-  _cached_http = httplib2.Http(MemoryCache())
+  # for the certs. The cache is shared by all threads, and its entries expire
+  # with the certs' Cache-Control max-age.
+  _cached_http = httplib2.Http(httplib2.LRUCache(max_bytes=1024 * 1024))
+
+  # Parsed certs by cert_uri, as (expiration time, certs), see _get_certs.
+  _certs_cache = {}
+
+  def _get_certs(http, cert_uri):
+    """Returns the certs at cert_uri, fetching them once per max-age.
+
+    Args:
+      http: httplib2.Http, instance to use to make the HTTP request.
+      cert_uri: string, URI of the certificates in JSON format.
+
+    Returns:
+      dict, the PEM certs by key id.
+
+    Raises:
+      VerifyJwtTokenError if the certs can't be fetched.
+    """
+    cached = _certs_cache.get(cert_uri)
+    if cached is not None and cached[0] > time.time():
+      return cached[1]
+
+    resp, content = http.request(cert_uri)
+
+    if resp.status != 200:
+      raise VerifyJwtTokenError('Status code: %d' % resp.status)
+    certs = simplejson.loads(content)
+    max_age = re.search(r'max-age=(\d+)', resp.get('cache-control', ''))
+    if max_age:
+      _certs_cache[cert_uri] = (time.time() + int(max_age.group(1)), certs)
+    return certs
 
   @util.positional(2)
   def verify_id_token(id_token, audience, http=None,
@@ -1005,13 +1131,8 @@ if HAS_CRYPTO:
     if http is None:
       http = _cached_http
 
-    resp, content = http.request(cert_uri)
-
-    if resp.status == 200:
-      certs = simplejson.loads(content)
-      return crypt.verify_signed_jwt_with_certs(id_token, certs, audience)
-    else:
-      raise VerifyJwtTokenError('Status code: %d' % resp.status)
+    certs = _get_certs(http, cert_uri)
+    return crypt.verify_signed_jwt_with_certs(id_token, certs, audience)
 
 
 def _urlsafe_b64decode(b64string):
@@ -26,6 +26,7 @@ from anyjson import simplejson
 CLOCK_SKEW_SECS = 300  # 5 minutes in seconds
 AUTH_TOKEN_LIFETIME_SECS = 300  # 5 minutes in seconds
 MAX_TOKEN_LIFETIME_SECS = 86400  # 1 day in seconds
+MAX_CACHED_VERIFIERS = 32
 
 
 logger = logging.getLogger(__name__)
@@ -271,6 +272,11 @@ def _json_encode(data):
   return simplejson.dumps(data, separators = (',', ':'))
 
 
+# The first segment of all the JWTs of make_signed_jwt, encoded once.
+_JWT_HEADER_SEGMENT = _urlsafe_b64encode(
+    _json_encode({'typ': 'JWT', 'alg': 'RS256'}))
+
+
 def make_signed_jwt(signer, payload):
   """Make a signed JWT.
 
@@ -283,10 +289,8 @@ def make_signed_jwt(signer, payload):
   Returns:
     string, The JWT for the payload.
   """
-  header = {'typ': 'JWT', 'alg': 'RS256'}
-
   segments = [
-          _urlsafe_b64encode(_json_encode(header)),
+          _JWT_HEADER_SEGMENT,
           _urlsafe_b64encode(_json_encode(payload)),
   ]
   signing_input = '.'.join(segments)
@@ -299,6 +303,30 @@ def make_signed_jwt(signer, payload):
   return '.'.join(segments)
 
 
+# Verifiers of the certs seen, by (key id, PEM), see _get_verifier.
+_verifiers = {}
+
+
+def _get_verifier(keyname, pem):
+  """Returns a Verifier of an X509 cert, parsing each cert only once."""
+  verifier = _verifiers.get((keyname, pem))
+  if verifier is None:
+    verifier = Verifier.from_string(pem, True)
+    # certs are rotated, forget the old ones.
+    if len(_verifiers) >= MAX_CACHED_VERIFIERS:
+      _verifiers.clear()
+    _verifiers[(keyname, pem)] = verifier
+  return verifier
+
+
+def _key_id(header_segment):
+  """Returns the key id of a JWT header segment, None if it has none."""
+  try:
+    return simplejson.loads(_urlsafe_b64decode(header_segment)).get('kid')
+  except Exception:
+    return None
+
+
 def verify_signed_jwt_with_certs(jwt, certs, audience):
   """Verify a JWT against public certs.
 
@@ -332,10 +360,11 @@ def verify_signed_jwt_with_certs(jwt, certs, audience):
   except:
     raise AppIdentityError('Can\'t parse token: %s' % json_body)
 
-  # Check signature.
+  # Check signature, with the cert of the token's key id first.
+  kid = _key_id(segments[0])
   verified = False
-  for (keyname, pem) in certs.items():
-    verifier = Verifier.from_string(pem, True)
+  for (keyname, pem) in sorted(certs.items(), key=lambda item: item[0] != kid):
+    verifier = _get_verifier(keyname, pem)
     if (verifier.verify(signed, signature)):
       verified = True
       break
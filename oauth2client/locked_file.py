@@ -17,6 +17,9 @@
 This module first tries to use fcntl locking to ensure serialized access
 to a file, then falls back on a lock file if that is unavialable.
 
+With fcntl, waiting for a contended lock blocks in the kernel until the lock
+is released or the timeout passes, instead of polling for it.
+
 Usage:
     f = LockedFile('filename', 'r+b', 'rb')
     f.open_and_lock()
@@ -33,6 +36,10 @@ __author__ = 'cache@google.com (David T McWherter)'
 import errno
 import logging
 import os
+import select
+import stat
+import tempfile
+import threading
 import time
 
 from oauth2client import util
@@ -54,6 +61,47 @@ def validate_file(filename):
     raise CredentialsFileSymbolicLinkError(
         'File: %s is a symbolic link.' % filename)
 
+
+def _write_temp_file(filename, fh, data):
+  """Write data to a new temporary file next to filename.
+
+  The temporary file gets the permissions of the open file fh, and is synced
+  to disk so that it can be renamed over filename.
+
+  Args:
+    filename: string, The path of the file that will be replaced.
+    fh: file, The open handle of that file.
+    data: string, The contents to write.
+
+  Returns:
+    (fd, temp_filename) for the written file. The caller owns fd.
+  """
+  dirname, basename = os.path.split(filename)
+  fd, temp_filename = tempfile.mkstemp(prefix='.%s.' % basename,
+                                       dir=dirname or os.curdir)
+  try:
+    os.chmod(temp_filename, stat.S_IMODE(os.fstat(fh.fileno()).st_mode))
+    while data:
+      data = data[os.write(fd, data):]
+    os.fsync(fd)
+  except:
+    os.close(fd)
+    os.unlink(temp_filename)
+    raise
+  return fd, temp_filename
+
+
+def _owns_file(fh):
+  """Whether the open file fh is owned by the effective user.
+
+  A file renamed over fh would belong to the effective user, so a file of
+  another user is rewritten in place to keep its owner.
+  """
+  if not hasattr(os, 'geteuid'):
+    return True
+  return os.fstat(fh.fileno()).st_uid == os.geteuid()
+
+
 class _Opener(object):
   """Base class for different locking primitives."""
 
@@ -70,6 +118,8 @@ class _Opener(object):
     self._mode = mode
     self._fallback_mode = fallback_mode
     self._fh = None
+    self._stats = {'acquired': 0, 'contended': 0, 'timeouts': 0,
+                   'lock_wait': 0.0, 'max_lock_wait': 0.0}
 
   def is_locked(self):
     """Was the file locked."""
@@ -96,6 +146,45 @@ class _Opener(object):
     """Unlock and close the file."""
     pass
 
+  def replace_contents(self, data):
+    """Replace the contents of the opened file.
+
+    This rewrites the file in place; openers that can do better override it.
+
+    Args:
+      data: string, The new contents of the file.
+    """
+    self._fh.seek(0)
+    self._fh.write(data)
+    self._fh.truncate()
+    self._fh.flush()
+
+  def get_stats(self):
+    """Statistics about attempts to lock the file."""
+    return dict(self._stats)
+
+  def _record_lock(self, start_time, contended):
+    """Update the statistics after an attempt to lock the file.
+
+    Args:
+      start_time: float, When the attempt started.
+      contended: bool, Whether the lock was held by someone else.
+    """
+    waited = time.time() - start_time
+    if self._locked:
+      self._stats['acquired'] += 1
+    else:
+      self._stats['timeouts'] += 1
+    if contended:
+      self._stats['contended'] += 1
+    self._stats['lock_wait'] += waited
+    self._stats['max_lock_wait'] = max(self._stats['max_lock_wait'], waited)
+
+  def _is_current(self):
+    """Whether the open file is still the one at filename."""
+    return os.path.samestat(os.fstat(self._fh.fileno()),
+                            os.stat(self._filename))
+
 
 class _PosixOpener(_Opener):
   """Lock files using Posix advisory lock files."""
@@ -104,10 +193,12 @@ class _PosixOpener(_Opener):
     """Open the file and lock it.
 
     Tries to create a .lock file next to the file we're trying to open.
+    The .lock file can't be waited on, so retries back off from a
+    millisecond up to delay.
 
     Args:
       timeout: float, How long to try to lock for.
-      delay: float, How long to wait between retries.
+      delay: float, The longest to wait between retries.
 
     Raises:
       AlreadyLockedException: if the lock is already acquired.
@@ -130,25 +221,35 @@ class _PosixOpener(_Opener):
 
     lock_filename = self._posix_lockfile(self._filename)
     start_time = time.time()
+    contended = False
+    sleep = min(delay, 0.001)
     while True:
       try:
         self._lock_fd = os.open(lock_filename,
                                 os.O_CREAT|os.O_EXCL|os.O_RDWR)
         self._locked = True
+        self._record_lock(start_time, contended)
+        if not self._is_current():
+          # The file was replaced while we were waiting for the lock.
+          self._fh.close()
+          self._fh = open(self._filename, self._mode)
         break
 
       except OSError, e:
         if e.errno != errno.EEXIST:
           raise
+        contended = True
         if (time.time() - start_time) >= timeout:
           logger.warn('Could not acquire lock %s in %s seconds' % (
               lock_filename, timeout))
+          self._record_lock(start_time, contended)
           # Close the file and open in fallback_mode.
           if self._fh:
             self._fh.close()
           self._fh = open(self._filename, self._fallback_mode)
           return
-        time.sleep(delay)
+        time.sleep(sleep)
+        sleep = min(delay, sleep * 2)
 
   def unlock_and_close(self):
     """Unlock a file by removing the .lock file, and close the handle."""
@@ -161,6 +262,32 @@ class _PosixOpener(_Opener):
     if self._fh:
       self._fh.close()
 
+  def replace_contents(self, data):
+    """Atomically replace the file by renaming a new one over it.
+
+    The lock lives in the separate .lock file, so it survives the rename.
+    The file is rewritten in place when no file can be created next to it or
+    renamed over it, or when it belongs to another user.
+
+    Args:
+      data: string, The new contents of the file.
+    """
+    if not self._locked or not _owns_file(self._fh):
+      return _Opener.replace_contents(self, data)
+    try:
+      fd, temp_filename = _write_temp_file(self._filename, self._fh, data)
+    except OSError:
+      return _Opener.replace_contents(self, data)
+    try:
+      os.rename(temp_filename, self._filename)
+    except OSError:
+      # e.g. the file is a mount point, which can't be renamed over.
+      os.close(fd)
+      os.unlink(temp_filename)
+      return _Opener.replace_contents(self, data)
+    self._fh.close()
+    self._fh = os.fdopen(fd, self._mode)
+
   def _posix_lockfile(self, filename):
     """The name of the lock file to use for posix locking."""
     return '%s.lock' % filename
@@ -169,15 +296,144 @@ class _PosixOpener(_Opener):
 try:
   import fcntl
 
+  # The most helper threads of _flock_within left waiting for a lock after
+  # their caller gave up. Past it, waits poll for the lock instead.
+  MAX_ABANDONED_FLOCK_WAITERS = 8
+  _abandoned_flock_waiters = 0
+  _abandoned_flock_waiters_lock = threading.Lock()
+
+  def _flock_polling(fh, timeout, delay):
+    """Try to exclusively lock fh every delay seconds until timeout passes.
+
+    Args:
+      fh: file, The open file to lock.
+      timeout: float, The number of seconds to wait.
+      delay: float, The number of seconds to wait between attempts.
+
+    Returns:
+      True if fh was locked, False if the timeout passed first.
+
+    Raises:
+      IOError: if flock() fails for a reason other than contention.
+    """
+    deadline = time.time() + timeout
+    while True:
+      try:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+        return True
+      except IOError, e:
+        if e.errno not in (errno.EACCES, errno.EAGAIN):
+          raise
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      time.sleep(min(delay, remaining))
+
+  def _flock_within(fh, timeout, delay):
+    """Block until fh is exclusively locked or timeout seconds pass.
+
+    flock() itself can't time out, so a helper thread blocks in it while
+    the caller waits on a pipe that the thread closes once it is done. The
+    thread locks a duplicate of the descriptor, which shares the flock()
+    lock with fh but stays open if fh is closed.
+
+    If the caller gives up first, the thread and its descriptor are left
+    waiting for the lock, and drop it as soon as they get it; the caller
+    must close fh. At most MAX_ABANDONED_FLOCK_WAITERS threads are left
+    waiting in the process, further waits poll for the lock every delay
+    seconds instead.
+
+    Args:
+      fh: file, The open file to lock.
+      timeout: float, The number of seconds to wait.
+      delay: float, The number of seconds between attempts when polling.
+
+    Returns:
+      True if fh was locked, False if the timeout passed first.
+
+    Raises:
+      IOError: if flock() fails for a reason other than contention.
+    """
+    global _abandoned_flock_waiters
+    if timeout <= 0:
+      return False
+    if _abandoned_flock_waiters >= MAX_ABANDONED_FLOCK_WAITERS:
+      return _flock_polling(fh, timeout, delay)
+    fd = os.dup(fh.fileno())
+    read_fd, write_fd = os.pipe()
+    state = {'done': False, 'abandoned': False, 'error': None}
+    state_lock = threading.Lock()
+
+    def lock():
+      global _abandoned_flock_waiters
+      try:
+        try:
+          fcntl.flock(fd, fcntl.LOCK_EX)
+        except IOError, e:
+          state['error'] = e
+        state_lock.acquire()
+        try:
+          state['done'] = True
+          if state['abandoned']:
+            _abandoned_flock_waiters_lock.acquire()
+            try:
+              _abandoned_flock_waiters -= 1
+            finally:
+              _abandoned_flock_waiters_lock.release()
+        finally:
+          state_lock.release()
+      finally:
+        # Closing the duplicate, with fh closed, drops an abandoned lock.
+        # Unlocking it first would let another file of this process lock it
+        # before the close, which drops that file's lockf() lock.
+        os.close(fd)
+        os.close(write_fd)
+
+    thread = threading.Thread(target=lock, name='flock-%d' % fd)
+    thread.daemon = True
+    thread.start()
+    deadline = time.time() + timeout
+    try:
+      while True:
+        try:
+          select.select([read_fd], [], [], max(0, deadline - time.time()))
+          break
+        except select.error, e:
+          if e[0] != errno.EINTR:
+            raise
+    finally:
+      os.close(read_fd)
+    state_lock.acquire()
+    try:
+      if not state['done']:
+        state['abandoned'] = True
+        _abandoned_flock_waiters_lock.acquire()
+        try:
+          _abandoned_flock_waiters += 1
+        finally:
+          _abandoned_flock_waiters_lock.release()
+        return False
+    finally:
+      state_lock.release()
+    if state['error']:
+      raise state['error']
+    return True
+
   class _FcntlOpener(_Opener):
-    """Open, lock, and unlock a file using fcntl.lockf."""
+    """Open, lock, and unlock a file using fcntl.flock and fcntl.lockf."""
 
     def open_and_lock(self, timeout, delay):
       """Open the file and lock it.
 
+      Waiting for a contended lock blocks until it is released rather than
+      polling for it, see _flock_within. A timeout of 0 waits forever.
+
+      Once locked with flock(), the file is also locked with lockf(), which
+      older clients of the file lock it with.
+
       Args:
         timeout: float, How long to try to lock for.
-        delay: float, How long to wait between retries
+        delay: float, How long to wait between retries, when polling.
 
       Raises:
         AlreadyLockedException: if the lock is already acquired.
@@ -199,34 +455,89 @@ try:
           return
 
       # We opened in _mode, try to lock the file.
+      contended = False
       while True:
         try:
-          fcntl.lockf(self._fh.fileno(), fcntl.LOCK_EX)
-          self._locked = True
-          return
+          fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
         except IOError, e:
-          # If not retrying, then just pass on the error.
-          if timeout == 0:
-            raise e
-          if e.errno != errno.EACCES:
+          if e.errno not in (errno.EACCES, errno.EAGAIN):
             raise e
-          # We could not acquire the lock. Try again.
-          if (time.time() - start_time) >= timeout:
+          # Someone else holds the lock; wait for them to release it.
+          contended = True
+          if timeout == 0:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+          elif not _flock_within(self._fh,
+                                 start_time + timeout - time.time(), delay):
             logger.warn('Could not lock %s in %s seconds' % (
                 self._filename, timeout))
+            self._record_lock(start_time, contended)
             if self._fh:
               self._fh.close()
             self._fh = open(self._filename, self._fallback_mode)
             return
-          time.sleep(delay)
+        if not self._is_current():
+          # Another process renamed a new file into place while we were
+          # waiting, so the lock we got protects nothing. Lock that one.
+          fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+          self._fh.close()
+          self._fh = open(self._filename, self._mode)
+          continue
+        # Older clients only hold it briefly, so this wait is not timed.
+        fcntl.lockf(self._fh.fileno(), fcntl.LOCK_EX)
+        self._locked = True
+        self._record_lock(start_time, contended)
+        return
 
     def unlock_and_close(self):
-      """Close and unlock the file using the fcntl.lockf primitive."""
+      """Close and unlock the file using the fcntl.flock primitive."""
       if self._locked:
         fcntl.lockf(self._fh.fileno(), fcntl.LOCK_UN)
+        fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
       self._locked = False
       if self._fh:
         self._fh.close()
+
+    def replace_contents(self, data):
+      """Atomically replace the file by renaming a new one over it.
+
+      The new file is locked before it is renamed into place, so the lock is
+      never given up; processes blocked on the old file notice the rename
+      once they get its lock and move on to the new one. The file is
+      rewritten in place when no file can be created next to it or renamed
+      over it, or when it belongs to another user.
+
+      Args:
+        data: string, The new contents of the file.
+      """
+      if not self._locked or not _owns_file(self._fh):
+        return _Opener.replace_contents(self, data)
+      try:
+        fd, temp_filename = _write_temp_file(self._filename, self._fh, data)
+      except OSError:
+        return _Opener.replace_contents(self, data)
+      try:
+        fh = os.fdopen(fd, self._mode)
+      except:
+        os.close(fd)
+        os.unlink(temp_filename)
+        raise
+      try:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        fcntl.lockf(fh.fileno(), fcntl.LOCK_EX)
+        os.rename(temp_filename, self._filename)
+      except OSError:
+        # e.g. the file is a mount point, which can't be renamed over.
+        fh.close()
+        os.unlink(temp_filename)
+        return _Opener.replace_contents(self, data)
+      except:
+        fh.close()
+        os.unlink(temp_filename)
+        raise
+      fcntl.lockf(self._fh.fileno(), fcntl.LOCK_UN)
+      fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+      self._fh.close()
+      self._fh = fh
 except ImportError:
   _FcntlOpener = None
 
@@ -274,6 +585,7 @@ try:
           return
 
       # We opened in _mode, try to lock the file.
+      contended = False
       while True:
         try:
           hfile = win32file._get_osfhandle(self._fh.fileno())
@@ -283,6 +595,7 @@ try:
                win32con.LOCKFILE_EXCLUSIVE_LOCK), 0, -0x10000,
               pywintypes.OVERLAPPED())
           self._locked = True
+          self._record_lock(start_time, contended)
           return
         except pywintypes.error, e:
           if timeout == 0:
@@ -293,9 +606,11 @@ try:
             raise
 
           # We could not acquire the lock. Try again.
+          contended = True
           if (time.time() - start_time) >= timeout:
             logger.warn('Could not lock %s in %s seconds' % (
                 self._filename, timeout))
+            self._record_lock(start_time, contended)
             if self._fh:
               self._fh.close()
             self._fh = open(self._filename, self._fallback_mode)
@@ -355,6 +670,17 @@ class LockedFile(object):
     """Return whether we successfully locked the file."""
     return self._opener.is_locked()
 
+  def get_stats(self):
+    """Return statistics about attempts to lock the file.
+
+    Returns:
+      A dict with the number of times the lock was acquired ('acquired'),
+      had to be waited for ('contended') or could not be acquired in time
+      ('timeouts'), and the total and longest time spent acquiring it in
+      seconds ('lock_wait' and 'max_lock_wait').
+    """
+    return self._opener.get_stats()
+
   def open_and_lock(self, timeout=0, delay=0.05):
     """Open the file, trying to lock it.
 
@@ -371,3 +697,15 @@ class LockedFile(object):
   def unlock_and_close(self):
     """Unlock and close a file."""
     self._opener.unlock_and_close()
+
+  def replace_contents(self, data):
+    """Replace the contents of the locked file.
+
+    Where the platform allows it, a new file is renamed over the old one so
+    that readers never see a partial write. Files that can't be replaced,
+    or belong to another user, are rewritten in place.
+
+    Args:
+      data: string, The new contents of the file.
+    """
+    self._opener.replace_contents(data)
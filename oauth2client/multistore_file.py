@@ -48,6 +48,7 @@ import errno
 import logging
 import os
 import threading
+import time
 
 from anyjson import simplejson
 from oauth2client.client import Storage as BaseStorage
@@ -61,6 +62,13 @@ logger = logging.getLogger(__name__)
 _multistores = {}
 _multistores_lock = threading.Lock()
 
+# Holding the store lock longer than this many seconds is logged.
+LOCK_HOLD_WARNING_SECS = 1.0
+
+# Modification times are only trusted to tell writes apart once they are at
+# least this many seconds old, to cover filesystems with coarse timestamps.
+MTIME_GRANULARITY_SECS = 1.0
+
 
 class Error(Exception):
   """Base error for this module."""
@@ -163,6 +171,26 @@ def get_all_credential_keys(filename, warn_on_readonly=True):
     multistore._unlock()
 
 
+def get_store_stats(filename):
+  """Gets lock and I/O statistics for the given Multistore.
+
+  Args:
+    filename: The JSON file storing a set of credentials
+
+  Returns:
+    A dict with the number of times the store was locked ('locks'), the total
+    and longest time the lock was held in seconds ('lock_hold' and
+    'max_lock_hold'), the number of times the file was parsed ('reads') or
+    found unchanged since it was last parsed ('cache_hits'), and the number of
+    times it was written ('writes'), along with the contention statistics of
+    LockedFile.get_stats().
+  """
+  multistore = _get_multistore(filename)
+  stats = dict(multistore._stats)
+  stats.update(multistore._file.get_stats())
+  return stats
+
+
 @util.positional(1)
 def _get_multistore(filename, warn_on_readonly=True):
   """A helper method to initialize the multistore with proper locking.
@@ -209,6 +237,20 @@ class _MultiStore(object):
     # If this is None, then the store hasn't been read yet.
     self._data = None
 
+    # The JSON serialization of each credential in _data, under the same
+    # keys, so that updating one credential doesn't re-serialize the others.
+    self._raw_data = None
+
+    # (st_dev, st_ino, st_size, st_mtime) of the file when _data was last read
+    # or written, and the time that happened. If the file still matches, it
+    # doesn't need to be parsed again.
+    self._signature = None
+    self._signature_time = None
+
+    self._locked_at = None
+    self._stats = {'locks': 0, 'lock_hold': 0.0, 'max_lock_hold': 0.0,
+                   'reads': 0, 'cache_hits': 0, 'writes': 0}
+
   class _Storage(BaseStorage):
     """A Storage object that knows how to read/write a single credential."""
 
@@ -287,23 +329,66 @@ class _MultiStore(object):
         logger.warn('The credentials file (%s) is not writable. Opening in '
                     'read-only mode. Any refreshed credentials will only be '
                     'valid for this run.' % self._file.filename())
-    if os.path.getsize(self._file.filename()) == 0:
+    self._locked_at = time.time()
+    self._stats['locks'] += 1
+    if os.fstat(self._file.file_handle().fileno()).st_size == 0:
       logger.debug('Initializing empty multistore file')
       # The multistore is empty so write out an empty file.
       self._data = {}
+      self._raw_data = {}
       self._write()
-    elif not self._read_only or self._data is None:
+    elif self._data is None or (not self._read_only and
+                                not self._is_data_current()):
       # Only refresh the data if we are read/write or we haven't
       # cached the data yet. If we are readonly, we assume is isn't
       # changing out from under us and that we only have to read it
       # once. This prevents us from whacking any new access keys that
       # we have cached in memory but were unable to write out.
       self._refresh_data_cache()
+    else:
+      self._stats['cache_hits'] += 1
 
   def _unlock(self):
     """Release the lock on the multistore."""
     self._file.unlock_and_close()
+    held = time.time() - self._locked_at
+    self._stats['lock_hold'] += held
+    self._stats['max_lock_hold'] = max(self._stats['max_lock_hold'], held)
     self._thread_lock.release()
+    if held > LOCK_HOLD_WARNING_SECS:
+      logger.info('Held the lock on credentials file %s for %.2f seconds' %
+                  (self._file.filename(), held))
+
+  def _file_signature(self):
+    """Describe the version of the store file that is open.
+
+    The multistore must be locked when this is called.
+    """
+    st = os.fstat(self._file.file_handle().fileno())
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+  def _remember_file_signature(self):
+    """Note that the cached data matches the open store file.
+
+    The multistore must be locked when this is called.
+    """
+    self._signature = self._file_signature()
+    self._signature_time = time.time()
+
+  def _is_data_current(self):
+    """Whether the cached data still matches the store file.
+
+    The file counts as unchanged when its inode, size and mtime are the same
+    as when it was last read or written, unless that was so soon after its
+    mtime that another write could have landed within the same timestamp.
+
+    The multistore must be locked when this is called.
+    """
+    if self._signature is None:
+      return False
+    mtime = self._signature[3]
+    return (self._file_signature() == self._signature and
+            self._signature_time - mtime >= MTIME_GRANULARITY_SECS)
 
   def _locked_json_read(self):
     """Get the raw content of the multistore file.
@@ -314,6 +399,7 @@ class _MultiStore(object):
       The contents of the multistore decoded as JSON.
     """
     assert self._thread_lock.locked()
+    self._stats['reads'] += 1
     self._file.file_handle().seek(0)
     return simplejson.load(self._file.file_handle())
 
@@ -328,9 +414,10 @@ class _MultiStore(object):
     assert self._thread_lock.locked()
     if self._read_only:
       return
-    self._file.file_handle().seek(0)
-    simplejson.dump(data, self._file.file_handle(), sort_keys=True, indent=2)
-    self._file.file_handle().truncate()
+    self._stats['writes'] += 1
+    self._file.replace_contents(
+        simplejson.dumps(data, sort_keys=True, indent=2))
+    self._remember_file_signature()
 
   def _refresh_data_cache(self):
     """Refresh the contents of the multistore.
@@ -342,6 +429,8 @@ class _MultiStore(object):
         store.
     """
     self._data = {}
+    self._raw_data = {}
+    self._signature = None
     try:
       raw_data = self._locked_json_read()
     except Exception:
@@ -370,9 +459,11 @@ class _MultiStore(object):
       try:
         (key, credential) = self._decode_credential_from_json(cred_entry)
         self._data[key] = credential
+        self._raw_data[key] = cred_entry['credential']
       except:
         # If something goes wrong loading a credential, just ignore it
         logger.info('Error decoding credential, skipping', exc_info=True)
+    self._remember_file_signature()
 
   def _decode_credential_from_json(self, cred_entry):
     """Load a credential from our JSON serialization.
@@ -398,9 +489,8 @@ class _MultiStore(object):
     raw_data = {'file_version': 1}
     raw_creds = []
     raw_data['data'] = raw_creds
-    for (cred_key, cred) in self._data.items():
+    for (cred_key, raw_cred) in self._raw_data.items():
       raw_key = dict(cred_key)
-      raw_cred = simplejson.loads(cred.to_json())
       raw_creds.append({'key': raw_key, 'credential': raw_cred})
     self._locked_json_write(raw_data)
 
@@ -435,6 +525,7 @@ class _MultiStore(object):
       cred: The OAuth2Credential to update/set
     """
     self._data[key] = cred
+    self._raw_data[key] = simplejson.loads(cred.to_json())
     self._write()
 
   def _delete_credential(self, key):
@@ -447,6 +538,7 @@ class _MultiStore(object):
     """
     try:
       del self._data[key]
+      del self._raw_data[key]
     except KeyError:
       pass
     self._write()
@@ -0,0 +1,359 @@
+"""An in-process fake of the Google Cloud Storage XML API for load tests.
+
+FakeGcs answers the requests of cloudstorage from memory, after a latency
+drawn from a configurable distribution, failing a configurable fraction of
+them with throttling or server errors, or with timeouts. Together with the
+synthetic billing exports of WriteSyntheticExports, it lets ingestion be
+measured offline against realistic GCS behavior and bucket sizes.
+
+For example:
+  fake = fake_gcs.FakeGcs(latency=fake_gcs.LogNormalLatency(0.05, 0.5),
+                          error_rate=0.01)
+  fake.Install()
+  fake_gcs.WriteSyntheticExports(fake, main.BUCKET, projects=10, days=90,
+                                 skus=40)
+  main.GetDataTableData('project-0')
+  fake.Uninstall()
+
+It needs the App Engine SDK for ndb, like the cloudstorage library.
+"""
+import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import time
+import urllib
+import urlparse
+import xml.etree.cElementTree as ET
+from xml.sax import saxutils
+
+from cloudstorage import common
+from cloudstorage import storage_api
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+# Products and skus of synthetic exports, see WriteSyntheticExports.
+PRODUCTS = ['app-engine', 'bigquery', 'cloud-sql', 'cloud-storage',
+            'compute-engine']
+
+_MAX_KEYS = 1000
+
+
+def LogNormalLatency(median, sigma):
+  """Returns a latency function of a log-normal distribution.
+
+  Args:
+    median: median latency in seconds.
+    sigma: standard deviation of the log of the latency, 0.5 gives a p99
+      about 3 times the median.
+  """
+  mu = math.log(median)
+  return lambda: random.lognormvariate(mu, sigma)
+
+
+class FakeResponse(object):
+  """A urlfetch response of FakeGcs."""
+
+  def __init__(self, status_code, headers=None, content=''):
+    self.status_code = status_code
+    self.headers = headers or {}
+    self.content = content
+
+
+class _Object(object):
+  """An object stored in FakeGcs."""
+
+  def __init__(self, data, content_type=None, metadata=None):
+    self.data = data
+    self.etag = hashlib.md5(data).hexdigest()
+    self.ctime = time.time()
+    self.content_type = content_type or 'binary/octet-stream'
+    self.metadata = metadata or {}
+
+
+class FakeGcs(object):
+  """In memory GCS, serving the requests of cloudstorage._StorageApi."""
+
+  def __init__(self, latency=None, error_rate=0.0, error_statuses=(429, 503),
+               timeout_rate=0.0, seed=None, max_keys=_MAX_KEYS):
+    """Constructor.
+
+    Args:
+      latency: seconds each request takes, a number or a function returning
+        one, like LogNormalLatency. None for no latency.
+      error_rate: fraction of requests failing with one of error_statuses.
+      error_statuses: HTTP statuses of the failed requests.
+      timeout_rate: fraction of requests failing with a urlfetch
+        DownloadError, like a deadline exceeded.
+      seed: seed of the random errors.
+      max_keys: the most entries of a page of a bucket listing.
+    """
+    if latency is None or callable(latency):
+      self._latency = latency
+    else:
+      self._latency = lambda: latency
+    self.error_rate = error_rate
+    self.error_statuses = error_statuses
+    self.timeout_rate = timeout_rate
+    self._random = random.Random(seed)
+    self.max_keys = max_keys
+    self._objects = {}
+    self._uploads = {}
+    # requests served, by method, and requests failed on purpose.
+    self.requests = {}
+    self.errors = 0
+    self._installed = None
+
+  def Install(self):
+    """Serve the requests of the cloudstorage library from now on."""
+    self._installed = (storage_api._StorageApi.urlfetch_async,
+                       common.get_access_token())
+    fake = self
+
+    def UrlfetchAsync(api, url, **kwds):
+      return fake.FetchAsync(url, **kwds)
+
+    storage_api._StorageApi.urlfetch_async = UrlfetchAsync
+    # a token keeps the library off the local stub and app_identity.
+    common.set_access_token('fake-gcs')
+
+  def Uninstall(self):
+    """Restore the cloudstorage library."""
+    urlfetch_async, access_token = self._installed
+    storage_api._StorageApi.urlfetch_async = urlfetch_async
+    common.set_access_token(access_token)
+
+  def Put(self, filename, data, content_type=None):
+    """Store an object directly, without latency or errors.
+
+    Args:
+      filename: a filename of form '/bucket/filename'.
+      data: content of the object. str.
+      content_type: content type of the object.
+    """
+    self._objects[filename] = _Object(data, content_type)
+
+  def Get(self, filename):
+    """Returns the content of an object, None if it doesn't exist."""
+    stored = self._objects.get(filename)
+    return stored and stored.data
+
+  @ndb.tasklet
+  def FetchAsync(self, url, method='GET', headers=None, payload=None,
+                 **unused_kwds):
+    """Serve a request of the XML API, like ndb's urlfetch.
+
+    Returns:
+      A FakeResponse.
+
+    Raises:
+      urlfetch.DownloadError: on an injected timeout.
+    """
+    if self._latency:
+      yield ndb.sleep(self._latency())
+    self.requests[method] = self.requests.get(method, 0) + 1
+    if self._random.random() < self.timeout_rate:
+      self.errors += 1
+      raise urlfetch.DownloadError('Deadline exceeded (injected).')
+    if self._random.random() < self.error_rate:
+      self.errors += 1
+      raise ndb.Return(FakeResponse(self._random.choice(self.error_statuses)))
+    headers = dict((k.lower(), v) for k, v in (headers or {}).iteritems())
+    _, _, path, query, _ = urlparse.urlsplit(url)
+    filename = urllib.unquote(path)
+    query = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+    if filename.count('/') == 1:
+      response = self._ListBucket(filename, query)
+    else:
+      handler = getattr(self, '_' + method.capitalize())
+      response = handler(filename, query, headers, payload)
+    raise ndb.Return(response)
+
+  def _Head(self, filename, unused_query, unused_headers, unused_payload):
+    stored = self._objects.get(filename)
+    if stored is None:
+      return FakeResponse(404)
+    return FakeResponse(200, self._ObjectHeaders(stored, len(stored.data)))
+
+  def _Get(self, filename, unused_query, headers, unused_payload):
+    stored = self._objects.get(filename)
+    if stored is None:
+      return FakeResponse(404)
+    data = stored.data
+    if 'range' not in headers:
+      return FakeResponse(200, self._ObjectHeaders(stored, len(data)), data)
+    start, end = [int(i) for i in
+                  re.match(r'bytes=(\d+)-(\d+)', headers['range']).groups()]
+    if start >= len(data):
+      return FakeResponse(416)
+    content = data[start:end + 1]
+    response_headers = self._ObjectHeaders(stored, len(content))
+    response_headers['content-range'] = 'bytes %d-%d/%d' % (
+        start, start + len(content) - 1, len(data))
+    return FakeResponse(206, response_headers, content)
+
+  def _Delete(self, filename, unused_query, unused_headers, unused_payload):
+    if self._objects.pop(filename, None) is None:
+      return FakeResponse(404)
+    return FakeResponse(204)
+
+  def _Post(self, filename, unused_query, headers, unused_payload):
+    if headers.get('x-goog-resumable') != 'start':
+      return FakeResponse(400)
+    upload_id = str(len(self._uploads))
+    self._uploads[upload_id] = (filename, [], headers)
+    return FakeResponse(201, {'location': 'https://storage.googleapis.com%s'
+                                          '?upload_id=%s' %
+                                          (urllib.quote(filename), upload_id)})
+
+  def _Put(self, filename, query, headers, payload):
+    payload = payload or ''
+    if 'upload_id' in query:
+      return self._PutChunk(query['upload_id'], headers, payload)
+    if 'compose' in query:
+      bucket = filename.split('/')[1]
+      names = [e.text for e in ET.fromstring(payload).getiterator()
+               if e.tag == 'Name']
+      components = [self._objects.get('/%s/%s' % (bucket, name))
+                    for name in names]
+      if None in components:
+        return FakeResponse(404)
+      payload = ''.join(component.data for component in components)
+    elif 'x-goog-copy-source' in headers:
+      source = self._objects.get(headers['x-goog-copy-source'])
+      if source is None:
+        return FakeResponse(404)
+      payload = source.data
+    self._objects[filename] = _Object(payload, headers.get('content-type'),
+                                      common.get_metadata(headers))
+    return FakeResponse(200)
+
+  def _PutChunk(self, upload_id, headers, payload):
+    filename, chunks, start_headers = self._uploads[upload_id]
+    chunks.append(payload)
+    total = headers['content-range'].rsplit('/', 1)[1]
+    if total == '*':
+      return FakeResponse(308)
+    del self._uploads[upload_id]
+    self._objects[filename] = _Object(''.join(chunks),
+                                      start_headers.get('content-type'),
+                                      common.get_metadata(start_headers))
+    return FakeResponse(200)
+
+  def _ListBucket(self, bucket, query):
+    prefix = query.get('prefix', '')
+    marker = query.get('marker', '')
+    delimiter = query.get('delimiter')
+    max_keys = min(int(query.get('max-keys', self.max_keys)), self.max_keys)
+    names = sorted(filename[len(bucket) + 1:] for filename in self._objects
+                   if filename.startswith(bucket + '/'))
+    entries = []
+    is_truncated = False
+    for name in names:
+      if not name.startswith(prefix) or name <= marker:
+        continue
+      if delimiter and delimiter in name[len(prefix):]:
+        name = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+        if (entries and entries[-1][0] == name) or name <= marker:
+          continue
+        entry = (name, None)
+      else:
+        entry = (name, self._objects[bucket + '/' + name])
+      if len(entries) == max_keys:
+        is_truncated = True
+        break
+      entries.append(entry)
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>'
+           '<ListBucketResult xmlns="%s">' % common.CS_XML_NS,
+           '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>' %
+           (bucket[1:], saxutils.escape(prefix), saxutils.escape(marker))]
+    if is_truncated:
+      xml.append('<NextMarker>%s</NextMarker>' %
+                 saxutils.escape(entries[-1][0]))
+    xml.append('<IsTruncated>%s</IsTruncated>' % str(is_truncated).lower())
+    for name, stored in entries:
+      if stored is not None:
+        xml.append(
+            '<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+            '<ETag>"%s"</ETag><Size>%d</Size></Contents>' %
+            (saxutils.escape(name),
+             datetime.datetime.utcfromtimestamp(stored.ctime).strftime(
+                 '%Y-%m-%dT%H:%M:%S.000Z'),
+             stored.etag, len(stored.data)))
+    for name, stored in entries:
+      if stored is None:
+        xml.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' %
+                   saxutils.escape(name))
+    xml.append('</ListBucketResult>')
+    return FakeResponse(200, {'content-type': 'application/xml'},
+                        ''.join(xml))
+
+  def _ObjectHeaders(self, stored, content_length):
+    headers = {'content-length': str(content_length),
+               'content-type': stored.content_type,
+               'etag': '"%s"' % stored.etag,
+               'last-modified': common.posix_time_to_http(stored.ctime)}
+    headers.update(stored.metadata)
+    return headers
+
+
+def SyntheticExport(project_number, day, skus, rand=random):
+  """Returns a billing export JSON of a project for a day.
+
+  Args:
+    project_number: project number of the line items. str.
+    day: date of the export.
+    skus: number of line items, spread across PRODUCTS.
+    rand: a random.Random to generate the charges with.
+  """
+  start = day.strftime('%Y-%m-%dT00:00:00-08:00')
+  end = (day + datetime.timedelta(1)).strftime('%Y-%m-%dT00:00:00-08:00')
+  items = []
+  for sku in range(skus):
+    line_item_id = 'com.google.cloud/services/%s/Sku%d' % (
+        PRODUCTS[sku % len(PRODUCTS)], sku)
+    usage = rand.randint(0, 10 ** 6)
+    items.append({
+        'lineItemId': line_item_id,
+        'startTime': start,
+        'endTime': end,
+        'projectNumber': project_number,
+        'measurements': [{'measurementId': line_item_id,
+                          'sum': str(usage),
+                          'unit': 'requests'}],
+        'cost': {'amount': '%.6f' % (usage * 1e-6), 'currency': 'USD'}})
+  return json.dumps(items, indent=2)
+
+
+def WriteSyntheticExports(fake, bucket, projects, days, skus, end=None,
+                          seed=0):
+  """Store billing exports of projects x days x skus in a FakeGcs.
+
+  The projects are named project-0 to project-<projects - 1>.
+
+  Args:
+    fake: the FakeGcs to store the exports in.
+    bucket: bucket path of form '/bucket'.
+    projects: number of projects.
+    days: number of days of exports of each project.
+    skus: number of line items in each export.
+    end: date of the last exports, today when None.
+    seed: seed of the random charges.
+
+  Returns:
+    The number of bytes of exports stored.
+  """
+  rand = random.Random(seed)
+  end = end or datetime.date.today()
+  total = 0
+  for project in range(projects):
+    for day in range(days):
+      export_date = end - datetime.timedelta(days - 1 - day)
+      data = SyntheticExport(str(10 ** 11 + project), export_date, skus, rand)
+      fake.Put('%s/project-%d-%s.json' % (bucket, project,
+                                          export_date.strftime('%Y-%m-%d')),
+               data, 'application/json')
+      total += len(data)
+  return total
@@ -0,0 +1,333 @@
+#!/usr/bin/python
+import datetime
+import optparse
+import os
+import random
+import subprocess
+import sys
+import time
+
+USAGE = """%prog [options] [BENCHMARK...]
+Run performance benchmarks for the billing export app.
+
+BENCHMARK   Name of a benchmark to run, all benchmarks run when omitted.
+
+For example:
+test/run_benchmarks.py serializers
+test/run_benchmarks.py --sdk_path ~/local/google-cloud-sdk/platform/google_appengine gcs_read
+test/run_benchmarks.py --sdk_path ... --latency_ms 80 --error_rate 0.02 ingest
+test/run_benchmarks.py --sdk_path ... cold_start
+"""
+
+
+def _Time(function, repeat=5):
+  """Returns the best wall time of repeat calls to function."""
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def _Report(name, count, unit, elapsed):
+  print '%-40s %10.0f %s/sec  (%.3f sec)' % (name, count / elapsed, unit,
+                                             elapsed)
+
+
+def _BillingDataTable(days, skus, density=0.3):
+  """Returns a DataTable shaped like the chart data of a large project."""
+  import gviz_api
+  random.seed(days * skus)
+  start = datetime.datetime(2014, 1, 1)
+  rows = []
+  for day in range(days):
+    rows.append([start + datetime.timedelta(day)] +
+                [random.random() < density and random.random() * 10 or None
+                 for _ in range(skus)])
+  data_table = gviz_api.DataTable(
+      [('Time', 'datetime', 'Time')] +
+      [('Cloud/sku-%d' % sku, 'number', 'sku-%d' % sku)
+       for sku in range(skus)])
+  data_table.LoadData(rows)
+  return data_table
+
+
+def BenchmarkSerializers(options):
+  """Cell throughput of the gviz_api.DataTable serializers."""
+  data_table = _BillingDataTable(options.days, options.skus, options.density)
+  cells = options.days * (options.skus + 1)
+  for method in ('ToJSon', 'ToJSonResponse', 'ToCsv', 'ToHtml'):
+    serialize = getattr(data_table, method)
+    _Report(method, cells, 'cells',
+            _Time(lambda: serialize(order_by='Time')))
+  _Report('ToJSCode', cells, 'cells',
+          _Time(lambda: data_table.ToJSCode('t', order_by='Time')))
+
+
+def _LocalGCS(options):
+  """Activates a testbed with the local GCS stub, returns the testbed."""
+  if not options.sdk_path:
+    print 'Error: --sdk_path is required for the local GCS stub.'
+    sys.exit(1)
+  sys.path.insert(0, options.sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  from google.appengine.ext import testbed
+  bed = testbed.Testbed()
+  bed.setup_env(app_id='_')
+  bed.activate()
+  bed.init_all_stubs()
+  return bed
+
+
+def BenchmarkGcsRead(options):
+  """Throughput of reading whole export objects from the local GCS stub."""
+  import cloudstorage as gcs
+  bed = _LocalGCS(options)
+  data = 'x' * (options.object_kb * 1024)
+  bucket = '/benchmark'
+  for day in range(options.objects):
+    with gcs.open('%s/project-%d.json' % (bucket, day), 'w') as gcs_file:
+      gcs_file.write(data)
+  total = options.objects * len(data) / 1024.0
+
+  def ReadBuffered():
+    for stat in gcs.listbucket(bucket):
+      with gcs.open(stat.filename) as gcs_file:
+        gcs_file.read()
+
+  def ReadWholeObject():
+    for stat in gcs.listbucket(bucket):
+      with gcs.open(stat.filename, file_stat=stat,
+                    whole_object=True) as gcs_file:
+        gcs_file.read()
+
+  _Report('buffered read', total, 'KiB', _Time(ReadBuffered))
+  _Report('whole object read', total, 'KiB', _Time(ReadWholeObject))
+  bed.deactivate()
+
+
+def BenchmarkGcsWrite(options):
+  """Throughput of writing a large object to the local GCS stub."""
+  import cloudstorage as gcs
+  bed = _LocalGCS(options)
+  chunk = 'x' * (256 * 1024)
+  chunks = options.write_mb * 4
+
+  def Write(**kwds):
+    with gcs.open('/benchmark/archive.csv', 'w', **kwds) as gcs_file:
+      for _ in range(chunks):
+        gcs_file.write(chunk)
+
+  _Report('resumable upload', options.write_mb, 'MiB', _Time(Write))
+  _Report('parallel upload', options.write_mb, 'MiB',
+          _Time(lambda: Write(parallel_upload=True)))
+  bed.deactivate()
+
+
+def BenchmarkIngest(options):
+  """Line item throughput of GetDataTableData over a fake GCS."""
+  bed = _LocalGCS(options)
+  import fake_gcs
+  import main as app
+  latency = None
+  if options.latency_ms:
+    latency = fake_gcs.LogNormalLatency(options.latency_ms / 1000.0, 0.5)
+  fake = fake_gcs.FakeGcs(latency=latency, error_rate=options.error_rate,
+                          seed=0)
+  fake.Install()
+  total = fake_gcs.WriteSyntheticExports(fake, app.BUCKET, options.projects,
+                                         options.days, options.skus)
+  print 'exports: %d objects, %.1f MiB' % (options.projects * options.days,
+                                          total / 1024.0 ** 2)
+
+  def Ingest():
+    for project in range(options.projects):
+      app.GetDataTableData('project-%d' % project)
+
+  _Report('GetDataTableData', options.projects * options.days * options.skus,
+          'line items', _Time(Ingest))
+  print 'requests: %r, injected errors: %d' % (fake.requests, fake.errors)
+  fake.Uninstall()
+  bed.deactivate()
+
+
+def BenchmarkEmailRender(options):
+  """Compiling and rendering the email template of a large sku table."""
+  bed = _LocalGCS(options)
+  import main as app
+  _Report('compile', 1, 'templates', _Time(
+      lambda: app.CreateTemplateEnvironment(False).get_template(
+          app.EMAIL_TEMPLATE_NAME)))
+  # the first load fills memcache, the best time is a bytecode cache hit.
+  _Report('bytecode cache load', 1, 'templates', _Time(
+      lambda: app.CreateTemplateEnvironment().get_template(
+          app.EMAIL_TEMPLATE_NAME)))
+  random.seed(options.skus)
+  columns = ['product-%d/sku-%d' % (sku % 10, sku)
+             for sku in range(options.skus)]
+  rows = [[datetime.datetime(2014, 1, 1)] +
+          [random.random() * 10 for _ in columns]]
+  context = {'project': 'benchmark',
+             'host_url': 'http://localhost/',
+             'project_url': 'http://localhost/#/Project/benchmark',
+             'unsubscribe_url': 'http://localhost/#/EditEmail/benchmark',
+             'alert_url': 'http://localhost/#/EditAlert/benchmark/',
+             'triggered_alerts': [],
+             'current_data': app.DataTableData(rows, columns)}
+  template = app.GetEmailTemplate()
+  _Report('render', options.skus, 'skus',
+          _Time(lambda: template.render(context)))
+  bed.deactivate()
+
+
+def _SelfSignedCert(name):
+  """Returns a private key and its self-signed X509 cert in PEM format."""
+  from OpenSSL import crypto
+  key = crypto.PKey()
+  key.generate_key(crypto.TYPE_RSA, 2048)
+  cert = crypto.X509()
+  cert.get_subject().CN = name
+  cert.set_serial_number(1)
+  cert.gmtime_adj_notBefore(0)
+  cert.gmtime_adj_notAfter(3600)
+  cert.set_issuer(cert.get_subject())
+  cert.set_pubkey(key)
+  cert.sign(key, 'sha256')
+  return key, crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+
+def BenchmarkIdToken(options):
+  """Throughput of verifying id tokens with oauth2client, needs PyOpenSSL."""
+  import json
+  import httplib2
+  from oauth2client import client
+  from oauth2client import crypt
+  # like the Google certs, the token is signed by the last of two keys.
+  certs = {}
+  for kid in ('key-0', 'key-1'):
+    key, certs[kid] = _SelfSignedCert(kid)
+  now = int(time.time())
+  segments = [crypt._urlsafe_b64encode(crypt._json_encode(data)) for data in (
+      {'typ': 'JWT', 'alg': 'RS256', 'kid': 'key-1'},
+      {'aud': 'benchmark', 'iat': now, 'exp': now + 3600})]
+  signature = crypt.OpenSSLSigner(key).sign('.'.join(segments))
+  token = '.'.join(segments + [crypt._urlsafe_b64encode(signature)])
+
+  class CertsHttp(object):
+
+    def request(self, uri):
+      return (httplib2.Response({'status': '200',
+                                 'cache-control': 'public, max-age=3600'}),
+              json.dumps(certs))
+
+  http = CertsHttp()
+
+  def Verify(cached):
+    for _ in range(options.tokens):
+      if not cached:
+        client._certs_cache.clear()
+        crypt._verifiers.clear()
+      client.verify_id_token(token, 'benchmark', http=http)
+
+  _Report('verify, certs parsed per token', options.tokens, 'tokens',
+          _Time(lambda: Verify(False)))
+  _Report('verify, cached certs', options.tokens, 'tokens',
+          _Time(lambda: Verify(True)))
+
+
+# Handlers timed by cold_start, the first request of a new instance.
+COLD_START_PATHS = ['/_ah/warmup', '/chart?project=benchmark&tqx=out:compact',
+                    '/projectList', '/getProfile']
+
+
+def _ColdStart(options):
+  """Prints the seconds to import main and to serve its first request."""
+  _LocalGCS(options).setup_env(user_email='benchmark@example.com',
+                               user_is_admin='1', overwrite=True)
+  start = time.time()
+  import main as app
+  imported = time.time()
+  import webapp2
+  response = webapp2.Request.blank(options.cold_start_path).get_response(
+      app.app)
+  print imported - start, time.time() - imported, response.status_int
+
+
+def BenchmarkColdStart(options):
+  """Latency of importing main and its first request, in new processes."""
+  if not options.sdk_path:
+    print 'Error: --sdk_path is required for the local GCS stub.'
+    sys.exit(1)
+  script = os.path.abspath(__file__)
+  for path in COLD_START_PATHS:
+    import_times = []
+    request_times = []
+    for _ in range(5):
+      output = subprocess.check_output(
+          [sys.executable, script, '--sdk_path', options.sdk_path,
+           '--cold_start_path', path],
+          cwd=os.path.dirname(os.path.dirname(script)))
+      import_time, request_time, status = output.split()[-3:]
+      import_times.append(float(import_time))
+      request_times.append(float(request_time))
+    print '%-40s import %.3f sec, first request %.3f sec (%s)' % (
+        path, min(import_times), min(request_times), status)
+
+
+BENCHMARKS = {'cold_start': BenchmarkColdStart,
+              'email_render': BenchmarkEmailRender,
+              'gcs_read': BenchmarkGcsRead,
+              'id_token': BenchmarkIdToken,
+              'gcs_write': BenchmarkGcsWrite,
+              'ingest': BenchmarkIngest,
+              'serializers': BenchmarkSerializers}
+
+
+def main(options, names):
+  sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+  for name in names or sorted(BENCHMARKS):
+    print '%s: %s' % (name, BENCHMARKS[name].__doc__)
+    BENCHMARKS[name](options)
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--days', type='int', default=90,
+                    help='rows of generated billing data.')
+  parser.add_option('--skus', type='int', default=400,
+                    help='sku columns of generated billing data.')
+  parser.add_option('--density', type='float', default=0.3,
+                    help='fraction of generated sku cells with a charge.')
+  parser.add_option('--sdk_path',
+                    help='path to the App Engine SDK, for the local GCS stub.')
+  parser.add_option('--objects', type='int', default=90,
+                    help='number of objects in the gcs benchmarks.')
+  parser.add_option('--object_kb', type='int', default=4096,
+                    help='size of the objects in the gcs benchmarks in KiB.')
+  parser.add_option('--write_mb', type='int', default=64,
+                    help='size of the object written by gcs_write in MiB.')
+  parser.add_option('--tokens', type='int', default=1000,
+                    help='id tokens verified by id_token.')
+  parser.add_option('--projects', type='int', default=4,
+                    help='projects of synthetic exports in ingest.')
+  parser.add_option('--latency_ms', type='float', default=50,
+                    help='median latency of fake GCS requests in ingest.')
+  parser.add_option('--error_rate', type='float', default=0.01,
+                    help='fraction of fake GCS requests failing in ingest.')
+  # internal, the request of a cold_start process.
+  parser.add_option('--cold_start_path', help=optparse.SUPPRESS_HELP)
+  options, args = parser.parse_args()
+  if options.cold_start_path:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    _ColdStart(options)
+    sys.exit(0)
+  for arg in args:
+    if arg not in BENCHMARKS:
+      print 'Error: unknown benchmark %s.' % arg
+      parser.print_help()
+      sys.exit(1)
+  main(options, args)
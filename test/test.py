@@ -1,15 +1,28 @@
+import base64
+import cStringIO
+import csv
 from datetime import date
+import gzip
 import json
 import logging
 import os
+import pickle
+import time
 import unittest
 
 import cloudstorage as gcs
+import fake_gcs
+import gviz_api
+import httplib2
 import main
 import webapp2
 import webtest
 
+from cloudstorage import api_utils
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
+from oauth2client import client
 
 
 class TestParseData(unittest.TestCase):
@@ -144,6 +157,290 @@ class TestParseData(unittest.TestCase):
     logging.debug(repr(response))
     self.assertEqual(response.status_int, 200)
 
+  def testStreamedJSonResponse(self):
+    data_table_data = main.GetDataTableData('google-platform-demo',
+                                            date(2014, 02, 01))
+    data_table = main.CreateDataTable(data_table_data)
+    self.assertTrue(data_table.NumberOfRows())
+    encoder = gviz_api.DataTableJSONEncoder()
+    expected_json = encoder.encode(data_table._ToJSonObj(order_by='Time'))
+    self.assertEqual(data_table.ToJSon(order_by='Time'), expected_json)
+    json_file = cStringIO.StringIO()
+    data_table.WriteJSon(json_file, order_by='Time')
+    self.assertEqual(json_file.getvalue(), expected_json)
+    response_file = cStringIO.StringIO()
+    data_table.WriteJSonResponse(response_file, req_id=7, order_by='Time')
+    self.assertEqual(response_file.getvalue(),
+                     data_table.ToJSonResponse(req_id=7, order_by='Time'))
+
+  def testCompactJSon(self):
+    data_table_data = main.GetDataTableData('google-platform-demo',
+                                            date(2014, 02, 01))
+    data_table = main.CreateDataTable(data_table_data)
+    full_json = json.loads(data_table.ToJSon(order_by='Time'))
+    compact_json = json.loads(data_table.ToCompactJSon(order_by='Time',
+                                                       precision=2))
+    self.assertEqual(compact_json['cols'], full_json['cols'])
+    self.assertEqual(len(compact_json['rows']), len(full_json['rows']))
+    for compact_row, full_row in zip(compact_json['rows'], full_json['rows']):
+      compact_cells = dict(zip(compact_row[::2], compact_row[1::2]))
+      # skip the time column.
+      for index, cell in enumerate(full_row['c'][1:], 1):
+        if cell is None:
+          self.assertNotIn(index, compact_cells)
+        else:
+          self.assertAlmostEqual(compact_cells[index], cell['v'], delta=0.0051)
+
+  def testProjectListConditionalGzipResponse(self):
+    testapp = webtest.TestApp(main.app)
+    response = testapp.get('/projectList',
+                           headers={'Accept-Encoding': 'gzip'})
+    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+    projects = json.loads(
+        gzip.GzipFile(fileobj=cStringIO.StringIO(response.body)).read())
+    self.assertIn('google-platform-demo', projects)
+    testapp.get('/projectList',
+                headers={'Accept-Encoding': 'gzip',
+                         'If-None-Match': response.headers['ETag']},
+                status=304)
+    response = testapp.get('/projectList',
+                           headers={'If-None-Match': response.headers['ETag']})
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual(json.loads(response.body), projects)
+
+  def testChartETagDependsOnReqId(self):
+    testapp = webtest.TestApp(main.app)
+    response = testapp.get('/chart', {'project': 'google-platform-demo',
+                                      'tqx': 'reqId:0'})
+    testapp.get('/chart', {'project': 'google-platform-demo',
+                           'tqx': 'reqId:0'},
+                headers={'If-None-Match': response.headers['ETag']},
+                status=304)
+    # the json response contains the reqId.
+    testapp.get('/chart', {'project': 'google-platform-demo',
+                           'tqx': 'reqId:1'},
+                headers={'If-None-Match': response.headers['ETag']},
+                status=200)
+    # the compact response doesn't.
+    response = testapp.get('/chart', {'project': 'google-platform-demo',
+                                      'tqx': 'reqId:0;out:compact',
+                                      'precision': '4'})
+    testapp.get('/chart', {'project': 'google-platform-demo',
+                           'tqx': 'reqId:1;out:compact', 'precision': '4'},
+                headers={'If-None-Match': response.headers['ETag']},
+                status=304)
+
+  def testMalformedChartParameters(self):
+    testapp = webtest.TestApp(main.app)
+    testapp.get('/chart', {'project': 'google-platform-demo',
+                           'tqx': 'out:compact;bad'}, status=400)
+    testapp.get('/chart', {'project': 'google-platform-demo',
+                           'tqx': 'out:compact', 'precision': 'x'},
+                status=400)
+    testapp.get('/chart', {'project': 'google-platform-demo',
+                           'tqx': 'reqId:x'}, status=400)
+
+  def testCsvExport(self):
+    testapp = webtest.TestApp(main.app)
+    response = testapp.get('/chart', {'project': 'google-platform-demo',
+                                      'tqx': 'out:csv',
+                                      'start': '2014-01-30',
+                                      'end': '2014-02-02'})
+    rows = list(csv.reader(cStringIO.StringIO(response.body)))
+    self.assertEqual(rows[0][0], 'Time')
+    self.assertEqual([row[0][:10] for row in rows[1:]],
+                     ['2014-01-30', '2014-01-31', '2014-02-01', '2014-02-02'])
+    for row in rows[1:]:
+      self.assertEqual(len(row), len(rows[0]))
+    # the export has the same sku and product columns as the chart data.
+    data_table_data = main.GetDataTableData('google-platform-demo',
+                                            date(2014, 02, 01))
+    data_table = main.CreateDataTable(data_table_data)
+    csv_row = dict(zip(rows[0], rows[3]))
+    table_rows = list(csv.reader(cStringIO.StringIO(data_table.ToCsv())))
+    for label, value in zip(table_rows[0][1:], table_rows[1][1:]):
+      if value:
+        self.assertEqual(float(csv_row[label]), float(value))
+
+  def testExportTooLarge(self):
+    testapp = webtest.TestApp(main.app)
+    params = {'project': 'google-platform-demo', 'tqx': 'out:csv',
+              'start': '2014-01-30', 'end': '2014-02-02'}
+    max_export_bytes = main.MAX_EXPORT_BYTES
+    max_export_read_bytes = main.MAX_EXPORT_READ_BYTES
+    try:
+      main.MAX_EXPORT_BYTES = 100
+      testapp.get('/chart', params, status=413)
+      main.MAX_EXPORT_BYTES = max_export_bytes
+      main.MAX_EXPORT_READ_BYTES = 100
+      testapp.get('/chart', params, status=413)
+    finally:
+      main.MAX_EXPORT_BYTES = max_export_bytes
+      main.MAX_EXPORT_READ_BYTES = max_export_read_bytes
+
+  def testFakeGcsRetriesInjectedErrors(self):
+    fake = fake_gcs.FakeGcs(error_rate=0.1, timeout_rate=0.05, seed=1)
+    fake.Install()
+    try:
+      fake_gcs.WriteSyntheticExports(fake, main.BUCKET, projects=2, days=30,
+                                     skus=12)
+      data_table_data = main.GetDataTableData('project-1')
+    finally:
+      fake.Uninstall()
+    self.assertTrue(fake.errors > 0)
+    self.assertEqual(len(data_table_data.rows), 30)
+    # 12 skus plus the total of each of the 5 products.
+    self.assertEqual(len(data_table_data.columns), 12 + 5)
+
+  def testStep2ExchangeExtractsIdToken(self):
+    payload = {'sub': '12345', 'aud': 'client-id'}
+    id_token = '.'.join([
+        'header',
+        base64.urlsafe_b64encode(json.dumps(payload)).rstrip('='),
+        'signature'])
+    token_response = json.dumps({'access_token': 'token',
+                                 'id_token': id_token})
+
+    class TokenHttp(object):
+      def request(self, uri, method='GET', body=None, headers=None):
+        return httplib2.Response({'status': 200}), token_response
+
+    flow = client.OAuth2WebServerFlow('client-id', 'secret', 'scope',
+                                      redirect_uri='urn:ietf:wg:oauth:2.0:oob')
+    credentials = flow.step2_exchange('code', http=TokenHttp())
+    self.assertEqual(credentials.access_token, 'token')
+    self.assertEqual(credentials.id_token, payload)
+    self.assertEqual(client._extract_id_token(unicode(id_token)), payload)
+
+  def testPartitionedListingPickledMidIteration(self):
+    fake = fake_gcs.FakeGcs(max_keys=3)
+    fake.Install()
+    try:
+      # names on, just before and just after the partition boundaries.
+      names = sorted(['a', 'b', 'b0', 'c', 'ca', 'd', 'e', 'ea', 'f', 'g',
+                      'h', 'i', 'j'])
+      for name in names:
+        fake.Put('/bucket/' + name, name)
+      partitions = ['/bucket/b', '/bucket/ca', '/bucket/e']
+      expected = ['/bucket/' + name for name in names]
+      self.assertEqual(list(gcs.listbucket('/bucket', partitions=partitions,
+                                           names_only=True)), expected)
+      for consumed in range(len(names) + 1):
+        listing = gcs.listbucket('/bucket', partitions=partitions,
+                                 names_only=True)
+        iterator = iter(listing)
+        first = [iterator.next() for _ in range(consumed)]
+        resumed = pickle.loads(pickle.dumps(listing))
+        self.assertEqual(first + list(resumed), expected)
+    finally:
+      fake.Uninstall()
+
+  def testRetryJitterBounds(self):
+    retry_params = gcs.RetryParams(initial_delay=0.1, max_delay=1.0,
+                                   jitter=True)
+    start_time = time.time()
+    for n in range(1, retry_params.max_retries + 1):
+      backoff = min(0.1 * 2 ** (n - 1), 1.0)
+      delays = [retry_params.delay(n, start_time) for _ in range(100)]
+      self.assertTrue(all(0 <= delay <= backoff for delay in delays))
+      # full jitter spreads the delays over the whole backoff.
+      self.assertTrue(min(delays) < backoff / 2 < max(delays))
+    self.assertEqual(
+        retry_params.delay(retry_params.max_retries + 1, start_time), -1)
+
+  def testRetryBudgetExhaustion(self):
+    self.testbed.setup_env(request_log_id='budget', overwrite=True)
+    fake = fake_gcs.FakeGcs(error_rate=1.0, error_statuses=(503,))
+    fake.Put('/bucket/a', 'a')
+    fake.Install()
+    gcs.set_default_retry_params(
+        gcs.RetryParams(initial_delay=0.001, retry_budget=3))
+    try:
+      for _ in range(3):
+        self.assertRaises(gcs.ServerError, gcs.stat, '/bucket/a')
+    finally:
+      gcs.set_default_retry_params(None)
+      fake.Uninstall()
+    # the first request spends the budget, the others aren't retried.
+    self.assertEqual(fake.requests['HEAD'], 3 + 3)
+    stats = gcs.get_retry_stats()
+    self.assertEqual((stats['requests'], stats['retries'], stats['exhausted']),
+                     (3, 3, 1))
+
+  def testHedgedReads(self):
+    self.testbed.setup_env(request_log_id='hedges', overwrite=True)
+    api_utils._read_latencies.clear()
+    # seconds of the requests in turn, 0.01 once they run out.
+    latencies = [0.01] * 20 + [0.5, 0.5, 0.01, 0.5]
+    fake = fake_gcs.FakeGcs(
+        latency=lambda: latencies.pop(0) if latencies else 0.01)
+    fake.Put('/bucket/a', 'a')
+    fake.Install()
+    gcs.set_default_retry_params(
+        gcs.RetryParams(retry_budget=1, hedge_percentile=90))
+    try:
+      for _ in range(20):
+        gcs.stat('/bucket/a')
+      # listings have latencies of their own, none yet, and aren't hedged.
+      self.assertEqual(list(gcs.listbucket('/bucket', names_only=True)),
+                       ['/bucket/a'])
+      self.assertEqual(fake.requests['GET'], 1)
+      self.assertEqual(gcs.get_retry_stats()['hedges'], 0)
+      # the hedge answers before the slow HEAD.
+      start_time = time.time()
+      self.assertEqual(gcs.stat('/bucket/a').st_size, 1)
+      self.assertTrue(time.time() - start_time < 0.5)
+      self.assertEqual(gcs.get_retry_stats()['hedges'], 1)
+      # the hedge spent the budget, the next slow HEAD is waited on.
+      start_time = time.time()
+      gcs.stat('/bucket/a')
+      self.assertTrue(time.time() - start_time >= 0.5)
+      self.assertEqual(gcs.get_retry_stats()['hedges'], 1)
+      self.assertEqual(fake.requests['HEAD'], 20 + 2 + 1)
+    finally:
+      gcs.set_default_retry_params(None)
+      fake.Uninstall()
+
+  def testParallelUpload(self):
+    fake = fake_gcs.FakeGcs()
+    fake.Install()
+    gcs.set_default_retry_params(gcs.RetryParams(max_retries=0))
+    try:
+      # a little more than one part.
+      data = ''.join('%07d\n' % i for i in range(1024 * 1024 + 1000))
+      with gcs.open('/bucket/large', 'w', parallel_upload=True) as f:
+        for i in range(0, len(data), 1000 * 1000):
+          f.write(data[i:i + 1000 * 1000])
+      with gcs.open('/bucket/small', 'w', parallel_upload=True) as f:
+        f.write('small')
+      self.assertEqual(gcs.open('/bucket/large').read(), data)
+      self.assertEqual(gcs.open('/bucket/small').read(), 'small')
+      # two parts and their compose, and the small object.
+      self.assertEqual(fake.requests['PUT'], 2 + 1 + 1)
+      self.assertEqual([stat.filename for stat in gcs.listbucket('/bucket')],
+                       ['/bucket/large', '/bucket/small'])
+
+      fetch_async = fake.FetchAsync
+
+      @ndb.tasklet
+      def FailingFetchAsync(url, method='GET', **kwds):
+        if method == 'PUT' and url.endswith('?compose'):
+          raise ndb.Return(fake_gcs.FakeResponse(403))
+        if method == 'DELETE':
+          raise urlfetch.DownloadError('Deadline exceeded (injected).')
+        response = yield fetch_async(url, method=method, **kwds)
+        raise ndb.Return(response)
+
+      fake.FetchAsync = FailingFetchAsync
+      f = gcs.open('/bucket/failed', 'w', parallel_upload=True)
+      f.write(data)
+      # the failed compose is raised, not the failed cleanup.
+      self.assertRaises(gcs.ForbiddenError, f.close)
+      self.assertEqual(fake.Get('/bucket/failed'), None)
+    finally:
+      gcs.set_default_retry_params(None)
+      fake.Uninstall()
+
   def tearDown(self):
     # for gcs_object in gcs.listbucket(main.BUCKET):
     #  gcs.delete(gcs_object.filename)
@@ -0,0 +1,126 @@
+import BaseHTTPServer
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+import httplib2
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves /redirect, /hang and any other path, counting the requests."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    server = self.server
+    with server.lock:
+      server.active += 1
+      server.max_active = max(server.max_active, server.active)
+    try:
+      if self.path == '/redirect':
+        self.send_response(302)
+        self.send_header('Location', '/redirected')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      if self.path == '/hang':
+        time.sleep(1)
+      else:
+        time.sleep(0.01)
+      body = 'ok ' + self.path
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+    finally:
+      with server.lock:
+        server.active -= 1
+
+  def log_message(self, *unused_args):
+    pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+    self.lock = threading.Lock()
+    self.active = 0
+    self.max_active = 0
+
+  def handle_error(self, request, client_address):
+    # clients closing kept alive connections aren't errors.
+    pass
+
+
+class TestConnectionPool(unittest.TestCase):
+  """Tests sharing the connections of an Http between threads."""
+
+  def setUp(self):
+    self.server = Server()
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def Http(self, max_per_host, timeout=None):
+    return httplib2.Http(
+        timeout=timeout, proxy_info=None,
+        connection_pool=httplib2.ConnectionPool(max_per_host=max_per_host))
+
+  def RunThreads(self, target, count):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join(10)
+      self.assertFalse(thread.isAlive(), 'deadlocked')
+
+  def testThreadsShareConnections(self):
+    http = self.Http(max_per_host=2)
+    contents = []
+
+    def Get():
+      for i in range(5):
+        contents.append(http.request('%s/%d' % (self.url, i))[1])
+
+    self.RunThreads(Get, 8)
+    self.assertEqual(sorted(contents),
+                     sorted(['ok /%d' % i for i in range(5)] * 8))
+    self.assertTrue(self.server.max_active <= 2)
+    stats = http.connection_pool.get_stats()
+    self.assertTrue(stats['created'] <= 2)
+    self.assertEqual(stats['created'] + stats['reused'], 8 * 5)
+    self.assertTrue(stats['waits'] > 0)
+    self.assertEqual(stats['open'], stats['idle'])
+
+  def testRedirectDoesNotDeadlock(self):
+    http = self.Http(max_per_host=1)
+    contents = []
+
+    def Get():
+      contents.append(http.request(self.url + '/redirect')[1])
+
+    self.RunThreads(Get, 3)
+    self.assertEqual(contents, ['ok /redirected'] * 3)
+    stats = http.connection_pool.get_stats()
+    self.assertEqual(stats['open'], stats['idle'])
+
+  def testRaisedRequestIsDiscarded(self):
+    http = self.Http(max_per_host=1, timeout=0.2)
+    self.assertRaises(socket.timeout, http.request, self.url + '/hang')
+    stats = http.connection_pool.get_stats()
+    self.assertEqual((stats['open'], stats['idle']), (0, 0))
+    # the discarded connection isn't reused, nor counted against the limit.
+    self.assertEqual(http.request(self.url + '/ok')[1], 'ok /ok')
+    stats = http.connection_pool.get_stats()
+    self.assertEqual((stats['created'], stats['reused']), (2, 0))
+    self.assertEqual((stats['open'], stats['idle']), (1, 1))
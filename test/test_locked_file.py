@@ -0,0 +1,226 @@
+import errno
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from oauth2client import client
+from oauth2client import locked_file
+from oauth2client import multistore_file
+
+
+def IncrementCounter(filename, times, use_native_locking):
+  """Add one to the number in filename, times times, under its lock."""
+  for _ in range(times):
+    f = locked_file.LockedFile(filename, 'r+b', 'rb',
+                               use_native_locking=use_native_locking)
+    f.open_and_lock(timeout=10)
+    try:
+      assert f.is_locked()
+      count = int(f.file_handle().read() or 0)
+      f.replace_contents(str(count + 1))
+    finally:
+      f.unlock_and_close()
+
+
+def ExitIfNotLockfLocked(filename):
+  """Exit with status 1 unless filename is locked like older clients do."""
+  import fcntl
+  with open(filename, 'r+b') as f:
+    try:
+      fcntl.lockf(f.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError:
+      return
+  raise SystemExit(1)
+
+
+class TestLockedFile(unittest.TestCase):
+  """Tests locking files and replacing their contents."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.tempdir, 'file')
+    with open(self.filename, 'w') as f:
+      f.write('old')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def ReplaceContents(self, data, use_native_locking):
+    f = locked_file.LockedFile(self.filename, 'r+b', 'rb',
+                               use_native_locking=use_native_locking)
+    f.open_and_lock()
+    try:
+      self.assertTrue(f.is_locked())
+      f.replace_contents(data)
+    finally:
+      f.unlock_and_close()
+    with open(self.filename) as f:
+      self.assertEqual(f.read(), data)
+
+  def testReplaceContentsRenames(self):
+    for use_native_locking in (True, False):
+      inode = os.stat(self.filename).st_ino
+      self.ReplaceContents('new', use_native_locking)
+      self.assertNotEqual(os.stat(self.filename).st_ino, inode)
+      self.assertEqual(os.listdir(self.tempdir), ['file'])
+
+  def testReplaceContentsInPlaceWithoutTempFile(self):
+    def Mkstemp(*unused_args, **unused_kwds):
+      raise OSError(errno.EACCES, 'Permission denied')
+
+    mkstemp = tempfile.mkstemp
+    tempfile.mkstemp = Mkstemp
+    try:
+      for use_native_locking in (True, False):
+        inode = os.stat(self.filename).st_ino
+        self.ReplaceContents('a longer content', use_native_locking)
+        self.ReplaceContents('new', use_native_locking)
+        self.assertEqual(os.stat(self.filename).st_ino, inode)
+    finally:
+      tempfile.mkstemp = mkstemp
+
+  @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+                       'only root can give a file to another user')
+  def testReplaceContentsKeepsOwner(self):
+    os.chown(self.filename, 12345, 12345)
+    for use_native_locking in (True, False):
+      inode = os.stat(self.filename).st_ino
+      self.ReplaceContents('new', use_native_locking)
+      self.assertEqual(os.stat(self.filename).st_ino, inode)
+      self.assertEqual(os.stat(self.filename).st_uid, 12345)
+
+  def testReplaceContentsFromTwoProcesses(self):
+    for use_native_locking in (True, False):
+      with open(self.filename, 'w') as f:
+        f.write('0')
+      processes = [
+          multiprocessing.Process(target=IncrementCounter,
+                                  args=(self.filename, 50, use_native_locking))
+          for _ in range(2)]
+      for process in processes:
+        process.start()
+      for process in processes:
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+      with open(self.filename) as f:
+        self.assertEqual(f.read(), '100')
+      self.assertEqual(os.listdir(self.tempdir), ['file'])
+
+  def testUnchangedStoreIsNotReread(self):
+    mtime_granularity_secs = multistore_file.MTIME_GRANULARITY_SECS
+    multistore_file.MTIME_GRANULARITY_SECS = 0
+    try:
+      os.unlink(self.filename)
+      storage = multistore_file.get_credential_storage(
+          self.filename, 'client_id', 'user_agent', 'scope')
+      storage.put(client.OAuth2Credentials(
+          'token', 'client_id', 'secret', 'refresh_token', None,
+          'https://token_uri', 'user_agent'))
+      stats = multistore_file.get_store_stats(self.filename)
+      for _ in range(3):
+        self.assertEqual(storage.get().access_token, 'token')
+      unchanged_stats = multistore_file.get_store_stats(self.filename)
+      self.assertEqual(unchanged_stats['reads'], stats['reads'])
+      self.assertEqual(unchanged_stats['cache_hits'], stats['cache_hits'] + 3)
+
+      # another writer replaces the file, the store reads it again.
+      other = multistore_file._MultiStore(self.filename)
+      other._get_storage(storage._key).put(client.OAuth2Credentials(
+          'new_token', 'client_id', 'secret', 'refresh_token', None,
+          'https://token_uri', 'user_agent'))
+      self.assertEqual(storage.get().access_token, 'new_token')
+      changed_stats = multistore_file.get_store_stats(self.filename)
+      self.assertEqual(changed_stats['reads'], stats['reads'] + 1)
+    finally:
+      multistore_file.MTIME_GRANULARITY_SECS = mtime_granularity_secs
+
+  def Lock(self, timeout):
+    f = locked_file.LockedFile(self.filename, 'r+b', 'rb')
+    f.open_and_lock(timeout=timeout, delay=0.01)
+    return f
+
+  def WaitForAbandonedWaiters(self):
+    deadline = time.time() + 5
+    while locked_file._abandoned_flock_waiters and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(locked_file._abandoned_flock_waiters, 0)
+
+  @unittest.skipUnless(locked_file._FcntlOpener, 'needs fcntl')
+  def testLockExcludesLockfClients(self):
+    f = self.Lock(10)
+    try:
+      process = multiprocessing.Process(target=ExitIfNotLockfLocked,
+                                        args=(self.filename,))
+      process.start()
+      process.join()
+      self.assertEqual(process.exitcode, 0)
+    finally:
+      f.unlock_and_close()
+
+  @unittest.skipUnless(locked_file._FcntlOpener, 'needs fcntl')
+  def testLockTimesOut(self):
+    holder = self.Lock(10)
+    try:
+      start_time = time.time()
+      waiter = self.Lock(0.2)
+      waited = time.time() - start_time
+      self.assertFalse(waiter.is_locked())
+      waiter.unlock_and_close()
+    finally:
+      holder.unlock_and_close()
+    self.assertTrue(0.2 <= waited < 2)
+    self.assertEqual(waiter.get_stats()['timeouts'], 1)
+    self.WaitForAbandonedWaiters()
+
+  @unittest.skipUnless(locked_file._FcntlOpener, 'needs fcntl')
+  def testWaitWakesOnRelease(self):
+    holder = self.Lock(10)
+    threading.Timer(0.2, holder.unlock_and_close).start()
+    start_time = time.time()
+    waiter = self.Lock(10)
+    waited = time.time() - start_time
+    self.assertTrue(waiter.is_locked())
+    waiter.unlock_and_close()
+    self.assertTrue(0.1 < waited < 2)
+    stats = waiter.get_stats()
+    self.assertEqual((stats['acquired'], stats['contended']), (1, 1))
+
+  @unittest.skipUnless(locked_file._FcntlOpener, 'needs fcntl')
+  def testLockAbandonedAfterTimeout(self):
+    holder = self.Lock(10)
+    waiter = self.Lock(0.1)
+    self.assertFalse(waiter.is_locked())
+    waiter.unlock_and_close()
+    self.assertEqual(locked_file._abandoned_flock_waiters, 1)
+    holder.unlock_and_close()
+    # the abandoned waiter drops the lock as soon as it gets it.
+    start_time = time.time()
+    f = self.Lock(5)
+    self.assertTrue(f.is_locked())
+    f.unlock_and_close()
+    self.assertTrue(time.time() - start_time < 2)
+    self.WaitForAbandonedWaiters()
+
+  @unittest.skipUnless(locked_file._FcntlOpener, 'needs fcntl')
+  def testAbandonedWaitersAreCapped(self):
+    max_waiters = locked_file.MAX_ABANDONED_FLOCK_WAITERS
+    locked_file.MAX_ABANDONED_FLOCK_WAITERS = 0
+    try:
+      holder = self.Lock(10)
+      threads = threading.active_count()
+      waiter = self.Lock(0.1)
+      self.assertFalse(waiter.is_locked())
+      waiter.unlock_and_close()
+      self.assertEqual(threading.active_count(), threads)
+      self.assertEqual(locked_file._abandoned_flock_waiters, 0)
+      # waits poll for the lock instead.
+      threading.Timer(0.1, holder.unlock_and_close).start()
+      waiter = self.Lock(5)
+      self.assertTrue(waiter.is_locked())
+      waiter.unlock_and_close()
+    finally:
+      locked_file.MAX_ABANDONED_FLOCK_WAITERS = max_waiters
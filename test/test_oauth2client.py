@@ -0,0 +1,120 @@
+import datetime
+import json
+import socket
+import threading
+import time
+import unittest
+
+import httplib2
+from oauth2client import client
+
+TOKEN_URI = 'https://token_uri'
+
+
+class FakeHttp(object):
+  """Grants 'new' tokens, and serves requests with the valid tokens.
+
+  The content of a response is the token the request was made with.
+  """
+
+  def __init__(self, valid_tokens, token_error=None):
+    self.valid_tokens = valid_tokens
+    self.token_error = token_error
+    # set to let token requests complete.
+    self.granting = threading.Event()
+    self.granting.set()
+    self.token_requests = 0
+    self._lock = threading.Lock()
+
+  def request(self, uri, method='GET', body=None, headers=None,
+              redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+              connection_type=None):
+    if uri == TOKEN_URI:
+      with self._lock:
+        self.token_requests += 1
+      self.granting.wait(10)
+      if self.token_error:
+        raise self.token_error
+      return (httplib2.Response({'status': 200}),
+              json.dumps({'access_token': 'new', 'expires_in': 3600}))
+    token = headers['Authorization'].split(' ', 1)[1]
+    if token not in self.valid_tokens:
+      return httplib2.Response({'status': 401}), ''
+    return httplib2.Response({'status': 200}), token
+
+
+class TestOAuth2Credentials(unittest.TestCase):
+  """Tests refreshing the access_token of credentials shared by threads."""
+
+  def Authorize(self, http, expires_in):
+    credentials = client.OAuth2Credentials(
+        'old', 'client_id', 'secret', 'refresh_token',
+        datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in),
+        TOKEN_URI, None)
+    credentials.authorize(http)
+    return credentials
+
+  def StartThreads(self, target, count):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    return threads
+
+  def WaitForTokenRequests(self, http, count):
+    deadline = time.time() + 10
+    while http.token_requests < count and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(http.token_requests, count)
+
+  def testUnauthorizedThreadsRefreshOnce(self):
+    http = FakeHttp(valid_tokens=['new'])
+    credentials = self.Authorize(http, 3600)
+    contents = []
+
+    def Get():
+      contents.append(http.request('https://resource')[1])
+
+    http.granting.clear()
+    threads = self.StartThreads(Get, 10)
+    self.WaitForTokenRequests(http, 1)
+    # the other threads get their 401 and wait for the refresh.
+    time.sleep(0.2)
+    http.granting.set()
+    for thread in threads:
+      thread.join(10)
+    self.assertEqual(contents, ['new'] * 10)
+    self.assertEqual(http.token_requests, 1)
+    self.assertEqual(credentials.access_token, 'new')
+
+  def testRefreshAheadDoesNotBlock(self):
+    http = FakeHttp(valid_tokens=['old', 'new'])
+    credentials = self.Authorize(http, client.REFRESH_AHEAD_SECS / 2)
+    contents = []
+
+    def Get():
+      contents.append(http.request('https://resource')[1])
+
+    http.granting.clear()
+    refreshing, = self.StartThreads(Get, 1)
+    self.WaitForTokenRequests(http, 1)
+    # other requests keep using the current token meanwhile.
+    for _ in range(5):
+      self.assertEqual(http.request('https://resource')[1], 'old')
+    self.assertTrue(refreshing.isAlive())
+    http.granting.set()
+    refreshing.join(10)
+    self.assertEqual(contents, ['new'])
+    self.assertEqual(http.request('https://resource')[1], 'new')
+    self.assertEqual(http.token_requests, 1)
+    self.assertEqual(credentials.access_token, 'new')
+
+  def testRefreshAheadErrorKeepsToken(self):
+    http = FakeHttp(valid_tokens=['old'],
+                    token_error=socket.error('Connection reset'))
+    credentials = self.Authorize(http, client.REFRESH_AHEAD_SECS / 2)
+    for _ in range(2):
+      self.assertEqual(http.request('https://resource')[1], 'old')
+    # each request tries again, a 401 would wait for the refresh.
+    self.assertEqual(http.token_requests, 2)
+    self.assertEqual(credentials.access_token, 'old')